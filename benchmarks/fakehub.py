@@ -0,0 +1,59 @@
+"""An in-process stand-in for the huggingface api, serving what a synthetic store's manifest says is on the hub. It has the methods of llm_layers.layers.HubClient, so it can be handed to RepoResolver, and sleeps for a configurable latency on every call, like a round trip to the hub would take."""
+import time, random, threading
+from llm_layers.layers import RepoUnavailable
+from llm_layers.profile import count
+
+class FakeHub(object):
+    """Answers search and paths_info from manifest, as written by benchmarks/synthetic.py. Every call sleeps latency seconds, plus up to jitter seconds more. calls counts the requests, like HubClient does."""
+    def __init__(self, manifest, latency=0.05, jitter=0.0, seed=0):
+        self.repos = {repo["id"] : repo for repo in manifest["repos"]}
+        self.lowered = [(repo_id.lower(), repo) for (repo_id, repo) in self.repos.items()]
+        self.latency = latency
+        self.jitter = jitter
+        self.random = random.Random(seed)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _roundTrip(self):
+        with self.lock:
+            self.calls += 1
+            delay = self.latency + (self.random.random() * self.jitter if self.jitter else 0)
+        count("http calls")
+        if delay > 0:
+            time.sleep(delay)
+
+    def search(self, query):
+        """Returns the repositories whose id contains query, ignoring case, like the hub's model search."""
+        self._roundTrip()
+        query = query.lower()
+        return [{"id" : repo["id"], "author" : repo["author"], "downloads" : repo["downloads"], "likes" : repo["likes"]} for (lowered, repo) in self.lowered if query in lowered]
+
+    def paths_info(self, repo_id, paths):
+        self._roundTrip()
+        repo = self.repos.get(repo_id, None)
+        if repo is None:
+            raise RepoUnavailable(repo_id, "error")
+        if repo["gated"]:
+            raise RepoUnavailable(repo_id, "gated")
+        files = {f["path"] : f for f in repo["files"]}
+        return [{"path" : path, "size" : files[path]["size"], "sha256" : files[path]["sha256"]} for path in paths if path in files]
+
+    def list_files(self, repo_id):
+        self._roundTrip()
+        repo = self.repos.get(repo_id, None)
+        if repo is None:
+            raise RepoUnavailable(repo_id, "error")
+        if repo["gated"]:
+            raise RepoUnavailable(repo_id, "gated")
+        return [dict(f) for f in repo["files"]]
+
+    def filenames(self):
+        """Returns the names of all gguf files on the hub that a layers file could ask for, i.e. no READMEs and only first shards."""
+        from llm_layers.gguf import shardInfo
+        names = set()
+        for repo in self.repos.values():
+            for f in repo["files"]:
+                info = shardInfo(f["path"])
+                if f["path"].endswith(".gguf") and (info is None or info[1] == 1):
+                    names.add(f["path"])
+        return sorted(names)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Measures how long it takes to start the llm-layers command line tool.
+Runs a fresh interpreter several times, importing the modules the CLI needs, and fails if the median time is above the target or if a heavy dependency got imported."""
+import sys, subprocess, time, argparse, statistics
+
+heavy_modules = ["torch", "huggingface_hub", "tabulate", "requests"]
+
+def measure(module, runs):
+    times = []
+    code = "import sys, " + module + "; print(' '.join(m for m in " + repr(heavy_modules) + " if m in sys.modules))"
+    for i in range(0, runs):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True)
+        times.append(time.perf_counter() - start)
+    return (times, out.stdout.split())
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark llm-layers startup time.")
+    parser.add_argument("--module", type=str, default="llm_layers.generate", help="Module to import.")
+    parser.add_argument("--runs", type=int, default=10, help="Number of interpreter starts to measure.")
+    parser.add_argument("--target", type=float, default=0.3, help="Maximum allowed median time in seconds.")
+    args = parser.parse_args()
+
+    (baseline, _) = measure("os", args.runs)
+    (times, loaded) = measure(args.module, args.runs)
+    median = statistics.median(times)
+    overhead = median - statistics.median(baseline)
+    print("import " + args.module + ": median " + str(round(median * 1000)) + "ms, " + str(round(overhead * 1000)) + "ms above a bare interpreter, target " + str(round(args.target * 1000)) + "ms")
+    failed = False
+    if loaded != []:
+        print("error: Heavy modules imported at startup: " + ", ".join(loaded))
+        failed = True
+    if median > args.target:
+        print("error: Startup is slower than the target.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
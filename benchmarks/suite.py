@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+"""Benchmarks the hot paths of llm-layers against a synthetic model store and a fake hub, so performance work has numbers to go by.
+  suite.py generate DIR --files 10000   makes a synthetic store, see synthetic.py
+  suite.py run --store DIR -o new.json  times the scenarios and writes the results as json
+  suite.py compare old.json new.json    flags scenarios that got slower
+Everything runs in process, against the llm_layers of this working tree, with caches in a temporary directory, so nothing in your home is touched."""
+import os, sys, io, json, time, shutil, random, argparse, platform, tempfile, statistics, contextlib, datetime
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+from fakehub import FakeHub
+
+results_format = 1
+
+class Scenario(object):
+    """A named piece of work that is timed runs times. prepare is called once before the first run, setup before every run and isn't timed, run is what gets timed. All of them get the Bench."""
+    def __init__(self, name, description, run, setup=None, prepare=None):
+        self.name = name
+        self.description = description
+        self.run = run
+        self.setup = setup
+        self.prepare = prepare
+
+class Bench(object):
+    """What scenarios share: the store, the fake hub, the settings and a scratch directory."""
+    def __init__(self, store, args):
+        self.store = store
+        self.args = args
+        self.manifest = synthetic.loadManifest(store)
+        self.hub = FakeHub(self.manifest, latency=args.latency, jitter=args.jitter, seed=args.seed)
+        self.scratch = tempfile.mkdtemp(prefix="llm-layers-bench.")
+        self.n = 0
+        self.state = {}
+
+    def fresh(self, name):
+        """Returns a new, empty directory in the scratch directory."""
+        self.n += 1
+        dir = os.path.join(self.scratch, name + "." + str(self.n))
+        os.makedirs(dir)
+        return dir
+
+    def useCacheDir(self, dir):
+        """Points llm_layers' cache directory at dir, see llm_layers.cache.getCacheDir."""
+        os.environ["XDG_CACHE_HOME"] = dir
+
+    def scanArgs(self):
+        return argparse.Namespace(context=2048, layers=1, fit_vram=self.args.vram, fit_devices=[self.args.vram], max_context=8192, memory="auto")
+
+    def generateArgv(self, layersfile, output, extra=[]):
+        return ["llm-layers", "--model_directory", self.store, "--output_directory", output, "-f", layersfile, "-V", str(self.args.vram) + "mb", "--no-best_for_machine", "--no-download", "--offline", "-x", "/usr/bin/llama-server", "--log_directory", os.path.join(self.scratch, "logs")] + extra
+
+    def cleanup(self):
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+@contextlib.contextmanager
+def quiet():
+    """Swallows what llm-layers prints, which would otherwise be timed along with everything else."""
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        yield
+
+def runGenerate(argv):
+    from llm_layers import generate
+    saved = sys.argv
+    sys.argv = argv
+    try:
+        with quiet():
+            generate.main()
+    except SystemExit:
+        pass
+    finally:
+        sys.argv = saved
+
+# scenarios
+
+def scanCold(bench):
+    from llm_layers.generate import getGGUFFiles
+    from llm_layers.scan import ScanIndex
+    index = ScanIndex(dir=bench.state["cache"])
+    with quiet():
+        getGGUFFiles(bench.store, bench.scanArgs(), index=index)
+    index.save()
+
+def scanWarm(bench):
+    from llm_layers.generate import getGGUFFiles
+    from llm_layers.scan import ScanIndex
+    # a new index, so it's loaded from disk like in a fresh process
+    with quiet():
+        getGGUFFiles(bench.store, bench.scanArgs(), index=ScanIndex(dir=bench.state["warm cache"]))
+
+def prepareScanWarm(bench):
+    bench.state["warm cache"] = bench.fresh("scan")
+    bench.state["cache"] = bench.state["warm cache"]
+    scanCold(bench)
+
+def prepareReadmes(bench):
+    readmes = []
+    for (dir, dirs, files) in os.walk(bench.store):
+        for f in files:
+            if f.lower() == "readme.md":
+                readmes.append(open(os.path.join(dir, f), "r", errors="replace").read())
+    bench.state["readmes"] = readmes
+
+def readmeFormats(bench):
+    from llm_layers.classify import guessPromptFormat
+    for w in bench.state["readmes"]:
+        guessPromptFormat(w)
+
+def setupGenerateCold(bench):
+    cache = bench.fresh("cache")
+    bench.useCacheDir(cache)
+    bench.state["layers file"] = os.path.join(bench.fresh("layers"), "llm_layers")
+    bench.state["scripts"] = bench.fresh("scripts")
+
+def dryRun(bench):
+    runGenerate(bench.generateArgv(bench.state["layers file"], bench.state["scripts"], ["-d"]))
+
+def generateCold(bench):
+    runGenerate(bench.generateArgv(bench.state["layers file"], bench.state["scripts"], ["-g"]))
+
+def prepareGenerateWarm(bench):
+    bench.state["warm generate"] = (bench.fresh("cache"), os.path.join(bench.fresh("layers"), "llm_layers"), bench.fresh("scripts"))
+    setupGenerateWarm(bench)
+    generateWarm(bench)
+
+def setupGenerateWarm(bench):
+    (cache, layersfile, scripts) = bench.state["warm generate"]
+    bench.useCacheDir(cache)
+    bench.state["layers file"] = layersfile
+    bench.state["scripts"] = scripts
+
+def generateWarm(bench):
+    runGenerate(bench.generateArgv(bench.state["layers file"], bench.state["scripts"], ["-g"]))
+
+def prepareIncludes(bench):
+    """Writes args.includes layers files, each with settings for a random half of the models, like loadouts and hand maintained files that overlap."""
+    from llm_layers.generate import getGGUFFiles
+    from llm_layers.scan import ScanIndex
+    from llm_layers.layers import LayersFile
+    with quiet():
+        models = getGGUFFiles(bench.store, bench.scanArgs(), index=ScanIndex(dir=bench.fresh("cache")))
+    rng = random.Random(bench.args.seed)
+    dir = bench.fresh("includes")
+    includes = []
+    for i in range(0, bench.args.includes):
+        lf = LayersFile()
+        for model in rng.sample(models, len(models) // 2):
+            lf.merge([{"name" : model["name"], "gpu_layers" : rng.randint(1, 99), "context" : rng.choice([2048, 4096, 8192]), "type" : model["type"]}], "include")
+        file = os.path.join(dir, "include." + str(i))
+        lf.write(file)
+        includes.append(file)
+    bench.state["models"] = models
+    bench.state["includes"] = includes
+
+def setupIncludeMerge(bench):
+    bench.state["layers file"] = os.path.join(bench.fresh("layers"), "llm_layers")
+
+def includeMerge(bench):
+    from llm_layers.generate import doLayersFile
+    from llm_layers.layers import LayersFile
+    lf = LayersFile().merge(bench.state["models"], "filesystem")
+    for file in bench.state["includes"]:
+        lf.merge(LayersFile.read(file), "include")
+    with quiet():
+        doLayersFile(bench.state["layers file"], lf, argparse.Namespace(dry_run=False))
+
+def prepareResolve(bench):
+    rng = random.Random(bench.args.seed)
+    names = bench.hub.filenames()
+    bench.state["filenames"] = rng.sample(names, min(len(names), bench.args.resolve))
+
+def setupResolveCold(bench):
+    bench.state["resolution"] = os.path.join(bench.fresh("cache"), "resolution.json")
+
+def resolve(bench):
+    from llm_layers.layers import RepoResolver
+    from llm_layers.cache import ResolutionCache
+    cache = ResolutionCache(file=bench.state["resolution"])
+    with quiet():
+        RepoResolver(hub=bench.hub, cache=cache, max_workers=bench.args.workers).resolve_many(bench.state["filenames"])
+    cache.save()
+
+def prepareResolveWarm(bench):
+    prepareResolve(bench)
+    setupResolveCold(bench)
+    resolve(bench)
+
+scenarios = [Scenario("scan_cold", "getGGUFFiles with an empty scan index: every directory listed, every README and gguf header read.", scanCold, setup=lambda bench: bench.state.update({"cache" : bench.fresh("scan")})),
+             Scenario("scan_warm", "getGGUFFiles with the scan index from a previous scan loaded from disk, nothing changed.", scanWarm, prepare=prepareScanWarm),
+             Scenario("readme_formats", "guessPromptFormat over every README in the store, already in memory.", readmeFormats, prepare=prepareReadmes),
+             Scenario("dry_run", "llm-layers -d with empty caches and no layers file.", dryRun, setup=setupGenerateCold),
+             Scenario("generate_cold", "llm-layers -g with empty caches: layers file, lookup files and all scripts written.", generateCold, setup=setupGenerateCold),
+             Scenario("generate_warm", "llm-layers -g again over its own output, nothing changed.", generateWarm, setup=setupGenerateWarm, prepare=prepareGenerateWarm),
+             Scenario("include_merge", "Merging the scanned models with --includes overlapping include files and writing the layers file.", includeMerge, setup=setupIncludeMerge, prepare=prepareIncludes),
+             Scenario("resolve_cold", "Resolving --resolve filenames to repositories through the fake hub, with an empty resolution cache.", resolve, setup=setupResolveCold, prepare=prepareResolve),
+             Scenario("resolve_warm", "Resolving the same filenames again, all from the resolution cache on disk.", resolve, prepare=prepareResolveWarm)]
+
+def timeScenario(bench, scenario, runs):
+    """Returns the results of running scenario runs times: a dictionary with the times of all runs and their median, min and max in seconds, plus the profiler's counters and cache statistics of the last run."""
+    from llm_layers.profile import enableProfiler
+    if scenario.prepare is not None:
+        scenario.prepare(bench)
+    seconds = []
+    for i in range(0, runs):
+        if scenario.setup is not None:
+            scenario.setup(bench)
+        profiler = enableProfiler()
+        start = time.perf_counter()
+        scenario.run(bench)
+        seconds.append(time.perf_counter() - start)
+    d = profiler.asDict()
+    return {"description" : scenario.description,
+            "runs" : runs,
+            "seconds" : [round(s, 5) for s in seconds],
+            "median" : round(statistics.median(seconds), 5),
+            "min" : round(min(seconds), 5),
+            "max" : round(max(seconds), 5),
+            "counters" : d["counters"],
+            "caches" : d["caches"]}
+
+def machine():
+    return {"python" : platform.python_version(), "platform" : platform.platform(), "cpus" : os.cpu_count()}
+
+def run(args):
+    names = [s.name for s in scenarios]
+    unknown = [name for name in args.scenario if name not in names]
+    if unknown != []:
+        print("error: Unknown scenarios " + ", ".join(unknown) + ". Try one of " + ", ".join(names), file=sys.stderr)
+        sys.exit(1)
+    chosen = [s for s in scenarios if args.scenario == [] or s.name in args.scenario]
+
+    store = args.store
+    generated = None
+    if store == "":
+        generated = tempfile.mkdtemp(prefix="llm-layers-store.")
+        store = generated
+        print("Generating a store with " + str(args.files) + " files in " + store, file=sys.stderr)
+        synthetic.generate(store, files=args.files, seed=args.seed)
+    if not(os.path.isfile(os.path.join(store, synthetic.manifest_name))):
+        print("error: " + store + " has no " + synthetic.manifest_name + ". Make one with 'suite.py generate'.", file=sys.stderr)
+        sys.exit(1)
+
+    saved = os.environ.get("XDG_CACHE_HOME", None)
+    bench = Bench(store, args)
+    # scenarios that don't pick a cache directory themselves still shouldn't touch the real one
+    bench.useCacheDir(bench.fresh("cache"))
+    results = {"format" : results_format,
+               "created" : datetime.datetime.now().isoformat(timespec="seconds"),
+               "machine" : machine(),
+               "store" : {"files" : bench.manifest["files"], "repos" : len(bench.manifest["repos"]), "seed" : bench.manifest["seed"]},
+               "settings" : {"runs" : args.runs, "latency" : args.latency, "jitter" : args.jitter, "vram" : args.vram, "resolve" : args.resolve, "includes" : args.includes, "workers" : args.workers},
+               "scenarios" : {}}
+    try:
+        for scenario in chosen:
+            r = timeScenario(bench, scenario, args.runs)
+            results["scenarios"][scenario.name] = r
+            print(scenario.name.ljust(18) + ("%.4fs" % r["median"]).rjust(10) + "  (min " + ("%.4f" % r["min"]) + ", max " + ("%.4f" % r["max"]) + ")", file=sys.stderr)
+    finally:
+        bench.cleanup()
+        if generated is not None and not(args.keep):
+            shutil.rmtree(generated, ignore_errors=True)
+        if saved is None:
+            del os.environ["XDG_CACHE_HOME"]
+        else:
+            os.environ["XDG_CACHE_HOME"] = saved
+
+    w = json.dumps(results, indent=2) + "\n"
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(w)
+    else:
+        sys.stdout.write(w)
+
+def compareResults(old, new, threshold=0.1, min_seconds=0.005):
+    """Compares two results dictionaries, as written by run. Returns a list of dictionaries with keys name, old, new, change and verdict, one per scenario in both. A scenario regressed if its median got slower by more than threshold, relative, and min_seconds, absolute, so noise in tiny scenarios doesn't count."""
+    rows = []
+    for (name, n) in new["scenarios"].items():
+        if name not in old["scenarios"]:
+            continue
+        o = old["scenarios"][name]
+        change = (n["median"] - o["median"]) / o["median"] if o["median"] > 0 else 0.0
+        verdict = "same"
+        if abs(n["median"] - o["median"]) >= min_seconds:
+            if change > threshold:
+                verdict = "REGRESSION"
+            elif change < -threshold:
+                verdict = "faster"
+        rows.append({"name" : name, "old" : o["median"], "new" : n["median"], "change" : round(change, 4), "verdict" : verdict})
+    return rows
+
+def compare(args):
+    (old, new) = [json.load(open(file, "r")) for file in [args.old, args.new]]
+    for key in ["store", "settings"]:
+        if old.get(key, None) != new.get(key, None):
+            print("warning: The runs differ in " + key + ", so they may not be comparable.", file=sys.stderr)
+    if old.get("machine", None) != new.get("machine", None):
+        print("warning: The runs were made on different machines or pythons.", file=sys.stderr)
+    rows = compareResults(old, new, threshold=args.threshold, min_seconds=args.min_seconds)
+    print("scenario                old        new    change")
+    for row in rows:
+        print(row["name"].ljust(18) + ("%.4f" % row["old"]).rjust(10) + ("%.4f" % row["new"]).rjust(11) + ("%+.1f%%" % (100 * row["change"])).rjust(10) + "  " + row["verdict"])
+    missing = [name for name in old["scenarios"].keys() if name not in new["scenarios"]]
+    if missing != []:
+        print("Not in " + args.new + ": " + ", ".join(missing))
+    regressions = [row for row in rows if row["verdict"] == "REGRESSION"]
+    if regressions != []:
+        print(str(len(regressions)) + " of " + str(len(rows)) + " scenarios regressed by more than " + str(round(100 * args.threshold)) + "%.")
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark llm-layers against a synthetic model store and a fake hub.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("generate", help="Generate a synthetic store shaped like the huggingface cache.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("directory", help="Where to put the store. The model directory to benchmark is this directory.")
+    p.add_argument("--files", type=int, default=1000, help="Approximate number of files in the store, gguf files, READMEs and clutter together.")
+    p.add_argument("--seed", type=int, default=0, help="Seed for everything random, the same seed gives the same store.")
+    p.add_argument("--readme_kb", type=float, default=4, help="Approximate size of every README in kilobytes.")
+    p.add_argument("--split_fraction", type=float, default=0.05, help="Fraction of models that are split into shards.")
+    p.add_argument("--mirror_fraction", type=float, default=0.3, help="Fraction of repositories that have a reupload on the fake hub.")
+    p.add_argument("--gated_fraction", type=float, default=0.05, help="Fraction of repositories that are gated on the fake hub.")
+    p.add_argument("--vocab", type=int, default=64, help="Number of tokens in every gguf header's vocabulary.")
+    p.add_argument("--symlinks", action=argparse.BooleanOptionalAction, default=True, help="Link snapshot files to blobs, like the huggingface cache does.")
+
+    p = sub.add_parser("run", help="Time the scenarios and write the results as json.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("--store", type=str, default="", help="Store made with 'generate'. By default, a temporary one with --files files is generated.")
+    p.add_argument("--files", type=int, default=1000, help="Size of the temporary store if no --store is given.")
+    p.add_argument("--keep", action=argparse.BooleanOptionalAction, default=False, help="Keep the temporary store.")
+    p.add_argument("-s", "--scenario", action="append", default=[], help="Scenario to run, may be given several times. By default, all are run. See 'suite.py list'.")
+    p.add_argument("--runs", type=int, default=5, help="Number of timed runs per scenario.")
+    p.add_argument("--latency", type=float, default=0.05, help="Seconds every fake hub request takes.")
+    p.add_argument("--jitter", type=float, default=0.0, help="Up to this many seconds are added to the latency at random.")
+    p.add_argument("--resolve", type=int, default=50, help="Number of filenames the resolve scenarios resolve.")
+    p.add_argument("--workers", type=int, default=8, help="Threads for resolving, like RepoResolver's max_workers.")
+    p.add_argument("--includes", type=int, default=3, help="Number of include layers files in include_merge.")
+    p.add_argument("-V", "--vram", type=int, default=24000, help="Vram budget in MB for fitting gpu_layers and context.")
+    p.add_argument("--seed", type=int, default=0, help="Seed for the temporary store, the fake hub's jitter and sampling.")
+    p.add_argument("-o", "--output", type=str, default="", help="File to write the results to. By default, they go to standard output.")
+
+    p = sub.add_parser("compare", help="Compare two results files and fail if a scenario got slower.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("old", help="Results of the baseline run.")
+    p.add_argument("new", help="Results of the run to check.")
+    p.add_argument("--threshold", type=float, default=0.1, help="Relative slowdown of the median that counts as a regression.")
+    p.add_argument("--min_seconds", type=float, default=0.005, help="Slowdowns smaller than this many seconds never count, they're noise.")
+
+    sub.add_parser("list", help="List the scenarios.")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        m = synthetic.generate(args.directory, files=args.files, seed=args.seed, readme_kb=args.readme_kb, split_fraction=args.split_fraction, mirror_fraction=args.mirror_fraction, gated_fraction=args.gated_fraction, vocab=args.vocab, symlinks=args.symlinks)
+        print("Wrote " + str(m["files"]) + " files in " + str(len([r for r in m["repos"] if os.path.isdir(os.path.join(args.directory, "hub", "models--" + r["id"].replace("/", "--")))])) + " repositories to " + args.directory)
+    elif args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        compare(args)
+    elif args.command == "list":
+        for s in scenarios:
+            print(s.name.ljust(18) + s.description)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""Generates a synthetic model store shaped like the huggingface cache, for benchmarking.
+Every repository gets gguf files with real headers but no weights, since the files are sparse, plus READMEs and the usual clutter of config files. A manifest.json next to the tree describes what the hub would know about it, including mirror repositories that only exist on the hub, so llm_layers can be exercised against benchmarks/fakehub.py without any network. The same seed always gives the same tree."""
+import os, json, struct, random, hashlib
+
+manifest_name = "manifest.json"
+
+# (name, architecture, parameter counts in billions, prompt format of the chat template)
+families = [("llama-2", "llama", [7, 13, 70], "user-assistant-newlines"),
+            ("mistral", "llama", [7], "mistral"),
+            ("mixtral-8x7b", "llama", [47], "mistral"),
+            ("codellama", "llama", [7, 13, 34], "alpaca"),
+            ("qwen2", "qwen2", [0.5, 1.5, 7, 72], "chat-ml"),
+            ("gemma-2", "gemma2", [2, 9, 27], ""),
+            ("phi-3-mini", "phi3", [3.8], "chat-ml"),
+            ("starcoder2", "starcoder2", [3, 7, 15], ""),
+            ("tinyllama", "llama", [1.1], "chat-ml"),
+            ("deepseek-coder", "llama", [1.3, 6.7, 33], "alpaca")]
+variants = ["instruct", "chat", "base", "dpo", "uncensored"]
+authors = ["TheBloke", "bartowski", "QuantFactory", "mradermacher", "second-state", "lmstudio-community"]
+# quantization -> (general.file_type, bits per weight)
+quants = {"Q2_K" : (10, 2.6), "Q3_K_M" : (12, 3.9), "Q4_0" : (2, 4.5), "Q4_K_M" : (15, 4.8), "Q5_K_M" : (17, 5.7), "Q6_K" : (18, 6.6), "Q8_0" : (7, 8.5)}
+clutter = ["config.json", "tokenizer.json", "tokenizer_config.json", "generation_config.json", ".gitattributes", "LICENSE"]
+templates = {"chat-ml" : "{% for m in messages %}<|im_start|>{{ m.role }}\n{{ m.content }}<|im_end|>\n{% endfor %}",
+             "mistral" : "{% for m in messages %}[INST] {{ m.content }} [/INST]{% endfor %}",
+             "alpaca" : "{% for m in messages %}### Instruction:\n{{ m.content }}\n\n### Response:\n{% endfor %}",
+             "user-assistant-newlines" : "{% for m in messages %}### User:\n{{ m.content }}\n\n### Assistant:\n{% endfor %}",
+             "" : ""}
+filler = "This model was quantized with llama.cpp. It is provided as is, and the usual caveats about large language models apply: it may produce inaccurate, biased or otherwise objectionable output. "
+
+def ggufString(w):
+    b = w.encode("utf-8")
+    return struct.pack("<Q", len(b)) + b
+
+def ggufValue(key, value):
+    """Encodes a metadata key-value pair. Strings, unsigned ints and lists of strings are all the generator needs."""
+    w = ggufString(key)
+    if isinstance(value, str):
+        return w + struct.pack("<I", 8) + ggufString(value)
+    if isinstance(value, list):
+        return w + struct.pack("<IIQ", 9, 8, len(value)) + b"".join([ggufString(v) for v in value])
+    return w + struct.pack("<II", 4, value)
+
+def writeGGUF(path, metadata, tensors):
+    """Writes a gguf file with metadata, a list of (key, value) pairs, and tensors, a list of (name, bytes) pairs. Only the header is written, the tensor data is a hole, so the file has its full size without taking up the space."""
+    infos = b""
+    offset = 0
+    for (name, size) in tensors:
+        infos += ggufString(name) + struct.pack("<IQQIQ", 2, 1, size, 0, offset)
+        offset += size
+    header = b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(metadata)) + b"".join([ggufValue(k, v) for (k, v) in metadata]) + infos
+    header += b"\0" * ((32 - len(header) % 32) % 32)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + offset)
+    return len(header) + offset
+
+def modelTensors(billions, bits, blocks):
+    """Returns the tensor list of a model with billions of parameters at bits per weight, spread over blocks, embeddings and output."""
+    total = int(billions * 1e9 * bits / 8)
+    other = total // (blocks + 2)
+    layer = (total - 2 * other) // blocks
+    return [("token_embd.weight", other)] + [("blk." + str(i) + ".weight", layer) for i in range(0, blocks)] + [("output.weight", other)]
+
+def readme(rng, model, prompt_format, kb):
+    """Returns a README of about kb kilobytes. Like real ones, the prompt template is sometimes named, sometimes only shown, and sometimes missing."""
+    lines = ["# " + model, "", filler]
+    style = rng.random()
+    if prompt_format and style < 0.4:
+        lines += ["", "## Prompt template: " + prompt_format, "", templates[prompt_format]]
+    elif prompt_format and style < 0.7:
+        lines += ["", "## Usage", "", "```", templates[prompt_format], "```"]
+    w = "\n".join(lines) + "\n"
+    # the padding goes in the middle, so a matcher has to read all of it
+    pad = (filler + "\n") * max(0, int(kb * 1024 / (len(filler) + 1)))
+    return w + pad + "\n## License\n\nSee the original model.\n"
+
+def writeText(path, w):
+    with open(path, "w") as f:
+        f.write(w)
+    return os.path.getsize(path)
+
+def fakeSha(repo_id, path, size):
+    """A stand-in for the lfs sha256, since hashing gigabytes of holes tells nobody anything."""
+    return hashlib.sha256((repo_id + "/" + path + "/" + str(size)).encode("utf-8")).hexdigest()
+
+def generate(root, files=1000, seed=0, readme_kb=4, split_fraction=0.05, mirror_fraction=0.3, gated_fraction=0.05, vocab=64, symlinks=True):
+    """Generates a synthetic huggingface cache under root/hub with about files files in total, and writes the manifest. Returns the manifest."""
+    rng = random.Random(seed)
+    hub = os.path.join(root, "hub")
+    os.makedirs(hub, exist_ok=True)
+    repos = []
+    written = 0
+    n = 0
+    while written < files:
+        (family, arch, sizes, prompt_format) = rng.choice(families)
+        billions = rng.choice(sizes)
+        # the tag keeps names unique, like the countless finetunes of the same base model
+        base = family + "-" + str(billions) + "b-" + rng.choice(variants) + "-t" + str(n)
+        author = rng.choice(authors)
+        repo_id = author + "/" + base.title() + "-GGUF"
+        revision = hashlib.sha1((repo_id + str(seed)).encode("utf-8")).hexdigest()
+        repo_dir = os.path.join(hub, "models--" + repo_id.replace("/", "--"))
+        snapshot = os.path.join(repo_dir, "snapshots", revision)
+        blobs = os.path.join(repo_dir, "blobs")
+        os.makedirs(snapshot, exist_ok=True)
+        os.makedirs(blobs, exist_ok=True)
+        os.makedirs(os.path.join(repo_dir, "refs"), exist_ok=True)
+        with open(os.path.join(repo_dir, "refs", "main"), "w") as f:
+            f.write(revision)
+
+        blocks = max(4, int(8 * billions ** 0.4))
+        metadata = [("general.architecture", arch), ("general.name", base), ("general.size_label", str(billions) + "B"),
+                    (arch + ".block_count", blocks), (arch + ".context_length", rng.choice([2048, 4096, 8192, 32768])),
+                    (arch + ".embedding_length", 1024 * max(1, int(billions ** 0.5))), (arch + ".attention.head_count", 32), (arch + ".attention.head_count_kv", 8),
+                    ("tokenizer.ggml.tokens", ["t" + str(i) for i in range(0, vocab)])]
+        if templates[prompt_format]:
+            metadata.append(("tokenizer.chat_template", templates[prompt_format]))
+
+        entries = []
+        def add(path, writer):
+            target = os.path.join(snapshot, path)
+            if symlinks:
+                blob = os.path.join(blobs, hashlib.sha256((repo_id + path).encode("utf-8")).hexdigest())
+                size = writer(blob)
+                os.symlink(os.path.relpath(blob, os.path.dirname(target)), target)
+            else:
+                size = writer(target)
+            entries.append({"path" : path, "size" : size, "sha256" : fakeSha(repo_id, path, size)})
+
+        for quant in rng.sample(sorted(quants.keys()), rng.randint(1, 4)):
+            (file_type, bits) = quants[quant]
+            name = base + "." + quant
+            tensors = modelTensors(billions, bits, blocks)
+            shards = rng.randint(2, 4) if rng.random() < split_fraction else 1
+            if shards == 1:
+                add(name + ".gguf", lambda p: writeGGUF(p, metadata + [("general.file_type", file_type)], tensors))
+                continue
+            per = -(-len(tensors) // shards)
+            for i in range(0, shards):
+                shard = name + "-" + str(i + 1).zfill(5) + "-of-" + str(shards).zfill(5) + ".gguf"
+                md = metadata + [("general.file_type", file_type)] if i == 0 else [("split.count", shards)]
+                add(shard, lambda p, md=md, i=i: writeGGUF(p, md, tensors[i * per:(i + 1) * per]))
+        text = readme(rng, base, prompt_format, readme_kb)
+        add("README.md", lambda p: writeText(p, text))
+        for extra in rng.sample(clutter, rng.randint(0, len(clutter))):
+            add(extra, lambda p: writeText(p, "{}\n"))
+
+        repos.append({"id" : repo_id, "author" : author, "downloads" : rng.randint(0, 100000), "likes" : rng.randint(0, 500), "gated" : rng.random() < gated_fraction, "files" : entries})
+        # reuploads of the same files under other names, which only the hub knows about
+        if rng.random() < mirror_fraction:
+            mirror = rng.choice([a for a in authors if a != author])
+            repos.append({"id" : mirror + "/" + base + "-gguf", "author" : mirror, "downloads" : rng.randint(0, 1000), "likes" : rng.randint(0, 50), "gated" : False, "files" : [{"path" : e["path"], "size" : e["size"], "sha256" : fakeSha(mirror, e["path"], e["size"])} for e in entries]})
+        written += len(entries)
+        n += 1
+
+    manifest = {"version" : 1, "seed" : seed, "files" : written, "repos" : repos}
+    with open(os.path.join(root, manifest_name), "w") as f:
+        json.dump(manifest, f)
+    return manifest
+
+def loadManifest(root):
+    with open(os.path.join(root, manifest_name), "r") as f:
+        return json.load(f)
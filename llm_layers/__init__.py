@@ -1,4 +1,8 @@
-from llm_layers.layers import get_hf_repo_for_file, load_layers_file, download_for_layers_file, get_total_vram_mb
+import time
+# read by llm_layers.profile, which reports the time spent importing as a phase
+import_started = time.perf_counter()
+
+from llm_layers.layers import get_hf_repo_for_file, load_layers_file, download_for_layers_file, get_total_vram_mb, get_devices
 import os
 
 _ROOT = os.path.abspath(os.path.dirname(__file__))
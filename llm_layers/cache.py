@@ -0,0 +1,128 @@
+import os, json, time, tempfile, threading, traceback, sys
+import appdirs
+
+def printerr(w):
+    print(w, file=sys.stderr)
+
+def getCacheDir():
+    return appdirs.user_cache_dir() + "/llm_layers"
+
+def writeFileAtomic(file, content, mode=None):
+    """Writes content to file by writing a temporary file in the same directory and renaming it over the target. Readers will either see the old or the new file, never a half-written one."""
+    dir = os.path.dirname(os.path.abspath(file))
+    if not(os.path.isdir(dir)):
+        os.makedirs(dir)
+    fd, tmp = tempfile.mkstemp(dir=dir, prefix="." + os.path.basename(file) + ".")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, file)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+class JsonCache(object):
+    """A small persistent key-value store backed by a json file. Every entry carries the time it was stored, so entries can expire after ttl seconds. Safe to use from several threads."""
+    def __init__(self, file, ttl=None):
+        self.file = file
+        self.ttl = ttl
+        self.data = None
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+
+    def _load(self):
+        if self.data is not None:
+            return
+        self.data = {}
+        if not(os.path.isfile(self.file)):
+            return
+        try:
+            self.data = json.load(open(self.file, "r"))
+        except:
+            printerr("warning: Ignoring unreadable cache file " + self.file + "\n" + traceback.format_exc())
+            self.data = {}
+
+    def get(self, key, ttl=None):
+        """Returns the value stored for key, or None if there is no entry or it is older than ttl seconds (defaults to the cache's ttl)."""
+        with self.lock:
+            self._load()
+            entry = self.data.get(key, None)
+            if ttl is None:
+                ttl = self.ttl
+            if entry is None or (ttl is not None and time.time() - entry["time"] > ttl):
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, key, value):
+        with self.lock:
+            self._load()
+            self.data[key] = {"time" : time.time(), "value" : value}
+            self.dirty = True
+
+    def remove(self, key):
+        with self.lock:
+            self._load()
+            if key in self.data:
+                del self.data[key]
+                self.dirty = True
+
+    def keys(self):
+        with self.lock:
+            self._load()
+            return list(self.data.keys())
+
+    def save(self):
+        """Writes the cache back to disk if anything changed. Returns True on error."""
+        with self.lock:
+            if not(self.dirty):
+                return False
+            try:
+                writeFileAtomic(self.file, json.dumps(self.data))
+            except:
+                printerr("warning: Could not write cache file " + self.file + "\n" + traceback.format_exc())
+                return True
+            self.dirty = False
+        return False
+
+class ResolutionCache(JsonCache):
+    """Maps filenames to the huggingface repository they were resolved to. Entries are dictionaries with keys repo, candidates, score, size, sha256 and shards. Failed resolutions are stored as well, with an empty repo and a reason like 'missing' or 'gated', and expire sooner."""
+    def __init__(self, file=None, ttl=7*24*3600, negative_ttl=24*3600):
+        if file is None:
+            file = getCacheDir() + "/resolution.json"
+        super().__init__(file, ttl=ttl)
+        self.negative_ttl = negative_ttl
+
+    def lookup(self, filename, offline=False):
+        """Returns the cached resolution for filename or None. In offline mode, expired entries are still returned, since a stale answer beats no answer."""
+        if offline:
+            return self.get(filename, ttl=float("inf"))
+        entry = self.get(filename)
+        if entry is not None and entry["repo"] == "":
+            with self.lock:
+                if time.time() - self.data[filename]["time"] > self.negative_ttl:
+                    self.hits -= 1
+                    self.misses += 1
+                    return None
+        return entry
+
+    def store(self, filename, repo, candidates=[], score=0, size=None, sha256=None, shards=None):
+        """Stores a successful resolution. For split models, size is the size of all shards together, and shards maps every shard's name to a dictionary with its size and sha256."""
+        self.put(filename, {"repo" : repo, "candidates" : list(candidates), "score" : score, "size" : size, "sha256" : sha256, "shards" : shards})
+
+    def storeNegative(self, filename, reason, candidates=[]):
+        self.put(filename, {"repo" : "", "reason" : reason, "candidates" : list(candidates), "score" : 0, "size" : None, "sha256" : None, "shards" : None})
+
+_resolution_cache = None
+def getResolutionCache():
+    """Returns the process wide resolution cache, creating it on first use."""
+    global _resolution_cache
+    if _resolution_cache is None:
+        _resolution_cache = ResolutionCache()
+    return _resolution_cache
@@ -0,0 +1,94 @@
+import re, functools
+
+# prompt formats that can be told apart by text, in order of preference when several show up
+prompt_formats = "chat-ml alpaca user-assistant-newlines mistral".split(" ")
+
+# markers that give away a prompt format, in chat templates and READMEs alike. All of a format's markers have to show up.
+format_markers = {"chat-ml" : [r"<\|im_start\|>"],
+                  "alpaca" : [r"### instruction:"],
+                  "user-assistant-newlines" : [r"### user:"],
+                  "mistral" : [r"\[inst\]", r"\[/inst\]"]}
+
+# architectures that only make sense for code
+code_architectures = ["starcoder", "starcoder2", "codeshell", "refact"]
+code_pattern = re.compile(r"cod(e|er|ing)\b|coder|codellama|codestral|codegemma|codeqwen|starcoder|wizardcoder|phind", re.IGNORECASE)
+# parameter counts like 7b, 1.5B or 8x7b in model names and general.size_label
+params_pattern = re.compile(r"(?:(\d+)x)?(\d+(?:\.\d+)?)b\b", re.IGNORECASE)
+mini_pattern = re.compile(r"\b(mini|tiny|small)\b", re.IGNORECASE)
+# models up to this many billion parameters count as mini
+mini_max_billions = 4
+
+@functools.lru_cache(maxsize=None)
+def readmeMatcher(formats):
+    """Returns a compiled pattern that finds, in a single pass over a README, both lines that name one of formats next to something like 'prompt template', and the markers of format_markers. formats is a tuple."""
+    names = "|".join([re.escape(f) for f in formats])
+    alternatives = [r"^(?=[^\n]*prompt[ _](?:template|format))[^\n]*?(?P<named>" + names + ")"]
+    return re.compile("|".join(alternatives + markerAlternatives()), re.IGNORECASE | re.MULTILINE)
+
+def markerAlternatives():
+    """Returns a list of regex alternatives, one per marker of format_markers, in groups named m<format index>_<marker index>."""
+    return ["(?P<m" + str(i) + "_" + str(j) + ">" + marker + ")" for (i, format) in enumerate(prompt_formats) for (j, marker) in enumerate(format_markers[format])]
+
+def foundMarker(group):
+    """Returns the pair (format, marker index) for a group named by markerAlternatives."""
+    (i, j) = group[1:].split("_")
+    return (prompt_formats[int(i)], int(j))
+
+def markerFormat(found):
+    """Returns the preferred prompt format all of whose markers are in found, a set of pairs (format, marker index). Mistral, for instance, needs both [INST] and [/INST]."""
+    for format in prompt_formats:
+        if all([(format, j) in found for j in range(0, len(format_markers[format]))]):
+            return format
+    return ""
+
+def guessPromptFormat(w, formats=prompt_formats):
+    """Guesses the prompt format from the text of a README. A line that names a format along with 'prompt template' or 'prompt format' wins, otherwise tell-tale markers decide. Returns the empty string if there's no clue."""
+    found = set()
+    for match in readmeMatcher(tuple(formats)).finditer(w):
+        if match.lastgroup == "named":
+            return match.group("named").lower()
+        found.add(foundMarker(match.lastgroup))
+    return markerFormat(found)
+
+template_matcher = re.compile("|".join(markerAlternatives()), re.IGNORECASE)
+
+def templateFormat(template):
+    """Returns the prompt format a gguf chat template implements, or the empty string if it's none of the known ones."""
+    found = set()
+    for match in template_matcher.finditer(template):
+        found.add(foundMarker(match.lastgroup))
+    return markerFormat(found)
+
+def billions(w):
+    """Returns the parameter count in billions mentioned in w, like 7 for mistral-7b or 56 for 8x7B, or None."""
+    match = params_pattern.search(w)
+    if match is None:
+        return None
+    experts = int(match.group(1)) if match.group(1) else 1
+    return experts * float(match.group(2))
+
+def modelType(name, facts, mmproj=""):
+    """Returns the type of a model: multimodal if it can see, code if it is made for programming, mini if it is small, and default otherwise. name is the filename, facts as returned by llm_layers.gguf.ggufFacts or None, and mmproj the projector file found next to it, if any."""
+    if mmproj or (facts is not None and facts.get("vision", False)):
+        return "multimodal"
+    names = [name]
+    if facts is not None:
+        names += [facts.get("general_name", ""), facts.get("size_label", "")]
+        if facts["architecture"] in code_architectures:
+            return "code"
+    if any([code_pattern.search(w) for w in names]):
+        return "code"
+    counts = [billions(w) for w in names if w]
+    counts = [n for n in counts if n is not None]
+    if (counts != [] and counts[-1] <= mini_max_billions) or mini_pattern.search(name):
+        return "mini"
+    return "default"
+
+def classifyModel(name, facts, readme_format="", mmproj=""):
+    """Returns a pair (prompt_format, type) for a model. The chat template in the gguf header decides the prompt format if it is a known one, otherwise readme_format, the guess from the README, is used."""
+    prompt_format = ""
+    if facts is not None and facts.get("chat_template", ""):
+        prompt_format = templateFormat(facts["chat_template"])
+    if prompt_format == "":
+        prompt_format = readme_format
+    return (prompt_format, modelType(name, facts, mmproj))
@@ -0,0 +1,246 @@
+import os, sys, glob, time, shutil, threading, traceback, queue
+from llm_layers.layers import RepoResolver, printerr
+from llm_layers.gguf import shardNames
+from llm_layers.profile import phase, count
+from llm_layers.verify import verifyModels, getHashCache, removeFile, formatProblems
+
+# files we get alongside every model
+extra_patterns = ["*README*", "*readme*", "*LICENSE*", "*license*", "*.txt", "*.md", "*.json", "*mmproj*"]
+
+def getHubCacheDir():
+    from huggingface_hub import constants
+    return constants.HF_HUB_CACHE
+
+def repoCacheDir(repo, cache_dir=None):
+    """Returns the directory huggingface_hub keeps repo in."""
+    if cache_dir is None:
+        cache_dir = getHubCacheDir()
+    return os.path.join(cache_dir, "models--" + repo.replace("/", "--"))
+
+def bytesOnDisk(dir, files, shas=[]):
+    """Returns the number of bytes of files in the huggingface cache directory dir of a repository, including their partial downloads. Blobs are named after their sha256, so shas, the sha256 sums the hub gave for files, find them, including the .incomplete ones. Files without a known sha256 are found through the snapshot links to their blobs, which only exist once they are complete. Other files of the repository, like other quants, are not counted."""
+    blobs = set([sha for sha in shas if sha])
+    for file in files:
+        for link in glob.glob(os.path.join(glob.escape(dir), "snapshots", "*", glob.escape(file))):
+            real = os.path.realpath(link)
+            if os.path.dirname(real) == os.path.join(os.path.realpath(dir), "blobs"):
+                blobs.add(os.path.basename(real))
+    total = 0
+    for blob in blobs:
+        for path in [os.path.join(dir, "blobs", blob), os.path.join(dir, "blobs", blob + ".incomplete")]:
+            try:
+                total += os.stat(path).st_size
+            except FileNotFoundError:
+                # renamed from .incomplete while we were looking
+                continue
+    return total
+
+def localBytesOnDisk(dir, files):
+    """Returns the number of bytes of files in the local directory dir, including their partial downloads, which huggingface_hub keeps below .cache in dir."""
+    total = 0
+    partial = os.path.join(dir, ".cache", "huggingface", "download")
+    for file in files:
+        for path in [os.path.join(dir, file)] + glob.glob(os.path.join(glob.escape(partial), glob.escape(file) + ".*incomplete")):
+            try:
+                total += os.stat(path).st_size
+            except FileNotFoundError:
+                continue
+    return total
+
+def entrySha256s(entry, name):
+    """Returns the sha256 sums a resolution entry has for the files of the model name, all shards for split models."""
+    if entry.get("shards", None):
+        return [info.get("sha256", None) for info in entry["shards"].values()]
+    return [entry.get("sha256", None)]
+
+def formatBytes(n):
+    return str(round(n / 1e6)) + "MB"
+
+class DownloadScheduler(object):
+    """Downloads models from huggingface, several at once.
+    Filenames are resolved to repositories concurrently, and every model goes into the transfer queue as soon as its repository is known, so resolution overlaps with transfers. Up to jobs transfers run at the same time. With order='priority', models are transferred in the order given, with order='smallest', smaller models go first.
+    Finished transfers are checked against the sizes and sha256 sums the hub has for them, unless verify is False, and corrupt files are deleted and transferred again.
+    Before a transfer starts, its resolved file size is reserved against the free space of the huggingface cache. Models that don't fit are skipped instead of failing halfway through. Failed transfers are retried, and since huggingface_hub keeps partial files as .incomplete blobs, a retry (or a later run after an interruption) resumes where the transfer stopped.
+    With local_dir, models are put into that directory by their plain filenames instead of into the huggingface cache, so their paths are known before they are downloaded.
+    While running, aggregate progress and throughput is reported every report_interval seconds."""
+    def __init__(self, jobs=3, order="priority", resolver=None, retries=3, report_interval=10, cache_dir=None, reserve_disk=1e9, verify=True, local_dir=None):
+        if order not in ["priority", "smallest"]:
+            raise ValueError("order must be 'priority' or 'smallest', not " + str(order))
+        self.jobs = max(1, jobs)
+        self.order = order
+        self.resolver = resolver if resolver is not None else RepoResolver()
+        self.retries = retries
+        self.report_interval = report_interval
+        self.cache_dir = cache_dir
+        self.reserve_disk = reserve_disk
+        self.verify = verify
+        self.local_dir = local_dir
+        self.hash_cache = getHashCache()
+        self.lock = threading.Lock()
+        self.results = {}
+        self.active = {}
+        self.reserved = 0
+        self.total = 0
+        self.done_bytes = 0
+
+    def _priority(self, job):
+        if self.order == "smallest":
+            size = job["size"] if job["size"] is not None else float("inf")
+            return (size, job["index"])
+        return (job["index"],)
+
+    def _reserve(self, job):
+        """Reserves disk space for job. Returns False if it won't fit."""
+        if job["size"] is None:
+            return True
+        dir = self.local_dir or (self.cache_dir if self.cache_dir is not None else getHubCacheDir())
+        # the partial file counts as already reserved
+        needed = max(0, job["size"] - job["present"])
+        probe = os.path.abspath(dir)
+        while not(os.path.isdir(probe)):
+            probe = os.path.dirname(probe)
+        free = shutil.disk_usage(probe).free
+        with self.lock:
+            if self.reserved + needed + self.reserve_disk > free:
+                return False
+            self.reserved += needed
+            job["reserved"] = needed
+        return True
+
+    def _release(self, job):
+        with self.lock:
+            self.reserved -= job.get("reserved", 0)
+            job["reserved"] = 0
+
+    def _transfer(self, job):
+        from huggingface_hub import snapshot_download
+        for attempt in range(0, self.retries + 1):
+            try:
+                # the shards of a split model are fetched concurrently by snapshot_download
+                if self.local_dir:
+                    folder = snapshot_download(job["repo"], allow_patterns=job["allow_patterns"], local_dir=self.local_dir, max_workers=max(8, len(job["files"])))
+                else:
+                    folder = snapshot_download(job["repo"], allow_patterns=job["allow_patterns"], cache_dir=self.cache_dir, max_workers=max(8, len(job["files"])))
+                missing = [file for file in job["files"] if not(os.path.isfile(os.path.join(folder, file)))]
+                if missing != []:
+                    printerr("error: Transfer of " + job["name"] + " from " + job["repo"] + " is incomplete, missing " + ", ".join(missing) + " (attempt " + str(attempt+1) + ").")
+                elif not(self.verify):
+                    return "done"
+                else:
+                    with phase("verify"):
+                        result = verifyModels([{"name" : job["name"], "file" : os.path.join(folder, job["name"]), "shards" : [os.path.join(folder, file) for file in job["files"]]}], cache=self.hash_cache, resolutions=self.resolver.cache)[0]
+                    if result["status"] != "corrupt":
+                        return "done"
+                    printerr("error: Transfer of " + job["name"] + " from " + job["repo"] + " is corrupt, " + formatProblems(result) + " (attempt " + str(attempt+1) + ").")
+                    for (file, reason) in result["problems"]:
+                        removeFile(file)
+            except KeyboardInterrupt:
+                raise
+            except:
+                printerr("error: Transfer of " + job["name"] + " from " + job["repo"] + " failed (attempt " + str(attempt+1) + "):\n" + traceback.format_exc())
+            time.sleep(min(30, 2 ** attempt))
+        return "failed"
+
+    def _worker(self, jobs):
+        while True:
+            (_, _, job) = jobs.get()
+            if job is None:
+                return
+            try:
+                fits = self._reserve(job)
+            except Exception:
+                printerr("error: Could not check the disk space for " + job["name"] + ":\n" + traceback.format_exc())
+                self.results[job["name"]] = "failed"
+                continue
+            if not(fits):
+                printerr("error: Not enough disk space for " + job["name"] + " (" + formatBytes(job["size"]) + "). Skipping.")
+                self.results[job["name"]] = "no space"
+                continue
+            printerr("Getting " + job["name"] + " from " + job["repo"] + " ...")
+            with self.lock:
+                self.active[job["name"]] = job
+            try:
+                with phase("transfer"):
+                    self.results[job["name"]] = self._transfer(job)
+            finally:
+                with self.lock:
+                    del self.active[job["name"]]
+                    self.done_bytes += self._progress(job)
+                self._release(job)
+
+    def _bytesOnDisk(self, job):
+        if self.local_dir:
+            return localBytesOnDisk(self.local_dir, job["files"])
+        return bytesOnDisk(job["dir"], job["files"], job["shas"])
+
+    def _progress(self, job):
+        return max(0, self._bytesOnDisk(job) - job["baseline"])
+
+    def _report(self, start, stop):
+        while not(stop.wait(self.report_interval)):
+            with self.lock:
+                done = self.done_bytes + sum([self._progress(job) for job in self.active.values()])
+                names = list(self.active.keys())
+                total = self.total
+            elapsed = time.time() - start
+            rate = done / elapsed if elapsed > 0 else 0
+            printerr("Downloaded " + formatBytes(done) + " of " + formatBytes(total) + " at " + formatBytes(rate) + "/s. Active: " + ", ".join(names))
+
+    def makeJob(self, name, entry, index):
+        """Returns a dictionary describing the transfer of the model file name, given its resolution entry. index is the position in the original list. For split models, name is the first shard, and the job covers all of them."""
+        dir = self.local_dir or repoCacheDir(entry["repo"], self.cache_dir)
+        job = {"name" : name,
+                "repo" : entry["repo"],
+                "size" : entry["size"],
+                "index" : index,
+                "dir" : dir,
+                "files" : shardNames(name),
+                "shas" : entrySha256s(entry, name),
+                "allow_patterns" : shardNames(name) + extra_patterns}
+        job["baseline"] = job["present"] = self._bytesOnDisk(job)
+        return job
+
+    def run(self, names):
+        """Downloads the model files in names. Returns a dictionary mapping each name to 'done', 'failed', 'no space' or 'not found'."""
+        start = time.time()
+        indices = {name : i for (i, name) in enumerate(names)}
+        jobs = queue.PriorityQueue()
+        workers = [threading.Thread(target=self._worker, args=(jobs,), daemon=True) for i in range(0, self.jobs)]
+        for worker in workers:
+            worker.start()
+        stop = threading.Event()
+        reporter = threading.Thread(target=self._report, args=(start, stop), daemon=True)
+        reporter.start()
+        try:
+            for (name, entry) in self.resolver.resolve_iter(names):
+                if entry is None or entry["repo"] == "":
+                    printerr("warning: Could not find a repository for " + name)
+                    self.results[name] = "not found"
+                    continue
+                job = self.makeJob(name, entry, indices[name])
+                with self.lock:
+                    self.total += job["size"] if job["size"] is not None else 0
+                jobs.put((self._priority(job), job["index"], job))
+        except BaseException:
+            # on errors and ctrl+c, transfers that haven't started are dropped, so the workers stop after their current one
+            while True:
+                try:
+                    jobs.get_nowait()
+                except queue.Empty:
+                    break
+            raise
+        finally:
+            for i in range(0, len(workers)):
+                jobs.put(((float("inf"),), len(names) + i, None))
+            for worker in workers:
+                worker.join()
+            stop.set()
+            reporter.join()
+            self.hash_cache.save()
+
+        elapsed = time.time() - start
+        done = [name for name in names if self.results.get(name, "") == "done"]
+        count("bytes downloaded", self.done_bytes)
+        count("models downloaded", len(done))
+        printerr("Finished " + str(len(done)) + " of " + str(len(names)) + " downloads, " + formatBytes(self.done_bytes) + " in " + str(round(elapsed)) + "s (" + formatBytes(self.done_bytes / elapsed if elapsed > 0 else 0) + "/s).")
+        return self.results
@@ -0,0 +1,149 @@
+# Estimates how much vram a model needs for a given number of offloaded layers and context size, and solves for the largest settings that fit a budget.
+# All of this is an estimate of what llama.cpp allocates. It errs on the side of caution.
+
+# what llama.cpp means by 'all layers'. We write this instead of the exact number, like the loadouts do.
+ALL_LAYERS = 999
+
+# cuda context, cublas workspace and friends
+fixed_overhead_bytes = 400 * 10**6
+# the kv cache is f16 by default
+kv_bytes_per_element = 2
+# used when a model's header can't be read
+default_block_count = 32
+default_kv_width = 1024
+# contexts are searched in steps of this
+context_step = 256
+
+def modelEstimate(facts=None, size=None):
+    """Returns a dictionary describing the memory layout of a model, with keys block_count, layer_bytes (list with bytes per block), output_bytes, kv_width (kv cache elements per token per layer, for both k and v) and embedding_length.
+    facts is a dictionary as returned by llm_layers.gguf.ggufFacts. If that's None, the estimate is based on the file size alone, assuming the file is mostly evenly sized blocks."""
+    if facts is not None and facts["block_count"] > 0 and sum(facts["layer_bytes"]) > 0:
+        block_count = facts["block_count"]
+        layer_bytes = facts["layer_bytes"]
+        output_bytes = facts.get("output_bytes", facts["other_bytes"] // 2)
+    else:
+        if size is None:
+            size = facts["size"] if facts is not None else 0
+        block_count = facts["block_count"] if facts is not None and facts["block_count"] > 0 else default_block_count
+        # one extra share for embeddings and output
+        share = size // (block_count + 1)
+        layer_bytes = [share] * block_count
+        output_bytes = share // 2
+
+    kv_width = default_kv_width * 2
+    embedding_length = 4096
+    if facts is not None and facts.get("embedding_length", 0) and facts.get("head_count", None):
+        embedding_length = facts["embedding_length"]
+        head_count_kv = facts["head_count_kv"] if facts.get("head_count_kv", None) else facts["head_count"]
+        # k and v, each embedding_length wide, divided among the kv heads
+        kv_width = 2 * embedding_length * head_count_kv // facts["head_count"]
+    return {"block_count" : block_count, "layer_bytes" : layer_bytes, "output_bytes" : output_bytes, "kv_width" : kv_width, "embedding_length" : embedding_length}
+
+def vramNeeded(estimate, layers, context):
+    """Returns the estimated bytes of vram needed to run the model described by estimate (see modelEstimate) with layers offloaded blocks and a context of the given size. layers above the block count mean the output layer is offloaded as well, which is what llama.cpp does."""
+    n = min(layers, estimate["block_count"])
+    if n <= 0:
+        return 0
+    total = fixed_overhead_bytes
+    total += sum(estimate["layer_bytes"][:n])
+    total += n * estimate["kv_width"] * kv_bytes_per_element * context
+    # scratch buffers for the computation graph grow with the context
+    total += context * estimate["embedding_length"] * 4
+    if layers > estimate["block_count"]:
+        total += estimate["output_bytes"]
+    return total
+
+def splitNeeded(estimate, layers, context, shares, main_gpu=0):
+    """Like vramNeeded, but returns the bytes needed on each of several devices when the blocks are split among them in the proportions given by shares, as llama.cpp's --tensor-split does. Every device with a share pays the fixed overhead, the main gpu holds the scratch buffers and the last device with a share the output layer. With a single share, this is vramNeeded."""
+    n = min(layers, estimate["block_count"])
+    needed = [0] * len(shares)
+    used = [i for i in range(0, len(shares)) if shares[i] > 0]
+    if n <= 0 or used == []:
+        return needed
+    blocks = sum(estimate["layer_bytes"][:n]) + n * estimate["kv_width"] * kv_bytes_per_element * context
+    for i in used:
+        needed[i] = fixed_overhead_bytes + blocks * shares[i] // sum(shares)
+    needed[main_gpu] += context * estimate["embedding_length"] * 4
+    if layers > estimate["block_count"]:
+        needed[used[-1]] += estimate["output_bytes"]
+    return needed
+
+def maxLayers(estimate, budget_bytes, context):
+    """Returns the largest number of layers that fit into budget_bytes at the given context. Returns block_count + 1 if everything fits."""
+    best = 0
+    for layers in range(1, estimate["block_count"] + 2):
+        if vramNeeded(estimate, layers, context) > budget_bytes:
+            break
+        best = layers
+    return best
+
+def maxContext(estimate, budget_bytes, layers, limit):
+    """Returns the largest context up to limit, in steps of context_step, that still fits into budget_bytes with layers offloaded. Returns 0 if even the smallest context doesn't fit."""
+    lo = 0
+    hi = limit // context_step
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if vramNeeded(estimate, layers, mid * context_step) <= budget_bytes:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo * context_step
+
+def fitModel(facts, budget_mb, context=2048, max_context=8192, size=None):
+    """Solves for gpu_layers and context of a model, given a vram budget in MB. Returns a pair (gpu_layers, context).
+    First, as many layers as possible are offloaded at the requested context (capped at the model's trained context length). If everything fits, the context is grown as far as the budget allows, up to max_context or the trained context length, whichever is smaller. gpu_layers is ALL_LAYERS if the whole model fits."""
+    estimate = modelEstimate(facts, size=size)
+    budget = budget_mb * 10**6
+    trained = facts["context_length"] if facts is not None and facts.get("context_length", 0) else max_context
+    context = min(context, trained)
+    layers = maxLayers(estimate, budget, context)
+    if layers <= estimate["block_count"]:
+        return (layers, context)
+    context = max(context, maxContext(estimate, budget, layers, min(max_context, trained)))
+    return (ALL_LAYERS, context)
+
+def deviceLayers(estimate, budgets_bytes, context, main_gpu=0):
+    """Distributes layers over several devices the way llama.cpp does with its default layer split: contiguous runs of blocks, the first device getting the first blocks. Every device pays the fixed overhead, and the main gpu also holds the scratch buffers. The output layer goes to the device holding the last block.
+    Returns a pair (counts, output), where counts is a list with the number of blocks per device and output is True if the output layer fits as well."""
+    per_layer = [b + estimate["kv_width"] * kv_bytes_per_element * context for b in estimate["layer_bytes"]]
+    free = [budget - fixed_overhead_bytes for budget in budgets_bytes]
+    free[main_gpu] -= context * estimate["embedding_length"] * 4
+    counts = [0] * len(budgets_bytes)
+    j = 0
+    last = None
+    for i in range(0, len(free)):
+        while j < estimate["block_count"] and per_layer[j] <= free[i]:
+            free[i] -= per_layer[j]
+            counts[i] += 1
+            j += 1
+            last = i
+    output = j == estimate["block_count"] and last is not None and free[last] >= estimate["output_bytes"]
+    return (counts, output)
+
+def fitDevices(facts, budgets_mb, context=2048, max_context=8192, size=None):
+    """Like fitModel, but for several devices with a vram budget in MB each, given in device order. The device with the largest budget becomes the main gpu. Returns a dictionary with keys gpu_layers, context, tensor_split (blocks per device, comma separated, as llama.cpp's --tensor-split takes it) and main_gpu."""
+    estimate = modelEstimate(facts, size=size)
+    budgets = [mb * 10**6 for mb in budgets_mb]
+    main_gpu = budgets.index(max(budgets))
+    trained = facts["context_length"] if facts is not None and facts.get("context_length", 0) else max_context
+    context = min(context, trained)
+    (counts, output) = deviceLayers(estimate, budgets, context, main_gpu)
+    if output:
+        lo = context // context_step
+        hi = min(max_context, trained) // context_step
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if deviceLayers(estimate, budgets, mid * context_step, main_gpu)[1]:
+                lo = mid
+            else:
+                hi = mid - 1
+        context = max(context, lo * context_step)
+        (counts, output) = deviceLayers(estimate, budgets, context, main_gpu)
+    return {"gpu_layers" : ALL_LAYERS if output else sum(counts),
+            "context" : context,
+            "tensor_split" : ",".join([str(n) for n in counts]),
+            "main_gpu" : main_gpu}
+
+def effectiveVramMb(budgets_mb):
+    """Returns what several devices with budgets_mb are worth as a single card, for choosing a loadout. Every extra device pays for its own cuda context."""
+    return sum(budgets_mb) - max(len(budgets_mb) - 1, 0) * fixed_overhead_bytes // 10**6
@@ -1,7 +1,15 @@
 #!/usr/bin/env python
-import sys, os, stat, glob, argparse, appdirs, traceback, datetime, re, csv, tempfile, random
+import sys, os, stat, glob, argparse, appdirs, traceback, datetime, re, csv, tempfile, random, importlib, shlex, time, hashlib
 from llm_layers import getData
 from llm_layers.layers import *
+from llm_layers.scan import scanModels, ScanIndex
+from llm_layers.classify import guessPromptFormat
+from llm_layers.fit import fitModel, fitDevices, effectiveVramMb
+from llm_layers.memory import memory_strategies, memory_options, memoryStrategy, systemMemoryMb, lockLimitMb, headroom_mb
+from llm_layers.verify import verifyModels, getHashCache, formatProblems
+from llm_layers.history import log_keep, checkLogArguments
+from llm_layers.cache import writeFileAtomic
+from llm_layers.profile import phase, count, enableProfiler, getProfiler
 from functools import *
 
 def printerr(w):
@@ -14,36 +22,74 @@ printerr_enabled = True
 # global scope for a temp file we want to stick around for program lifetime
 temp_layersfile = None
 
+# llm-layers SUBCOMMAND ... is handed to the main function of these modules
+subcommands = {"plan" : "llm_layers.plan",
+               "launch" : "llm_layers.launch",
+               "tune" : "llm_layers.tune",
+               "serve" : "llm_layers.serve",
+               "prefetch" : "llm_layers.memory",
+               "verify" : "llm_layers.verify",
+               "pick" : "llm_layers.quant",
+               "place" : "llm_layers.place",
+               "stats" : "llm_layers.history"}
+
+default_additional_arguments = "-fa --parallel 1 --mlock --no-mmap --log-format text"
+
 def main():
-    parser = argparse.ArgumentParser(description="ghostbox-generate-startup-scripts - Create server startup scripts for GGUF file directory.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    if len(sys.argv) > 1 and sys.argv[1] in subcommands:
+        return importlib.import_module(subcommands[sys.argv[1]]).main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description="ghostbox-generate-startup-scripts - Create server startup scripts for GGUF file directory.", epilog="Subcommands, see llm-layers SUBCOMMAND --help: " + ", ".join(subcommands.keys()), formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     #parser.add_argument("--color", action=argparse.BooleanOptionalAction, default=True, help="Enable colored output.")
     parser.add_argument("--pretty", action=argparse.BooleanOptionalAction, default=True, help="Enable prettier output using tabular. Disable this alongside -d for copy/pastable output.")
     parser.add_argument("--download", action=argparse.BooleanOptionalAction, default=True, help="Download models in layers file from huggingface. -d or --dry_run implies --no-download.")
     parser.add_argument("-g", "--generate", action=argparse.BooleanOptionalAction, default=False, help="Generate a layers file and run scripts. This will never overwrite settings in an existing layers file, but may add new entries. Existing scripts will be overwritten without mercy.")
-    parser.add_argument("-d", "--dry_run", action=argparse.BooleanOptionalAction, default=True, help="Will not write anything to disk, but print a sample layers file to stdout. This is the default when run without either -d or -g. If both parameters are provided, -g will dominate.")
+    parser.add_argument("-d", "--dry_run", action=argparse.BooleanOptionalAction, default=True, help="Will not write the layers file, scripts or the scan index to disk, but print a sample layers file to stdout. Hub lookups and file hashes are still cached. This is the default when run without either -d or -g. If both parameters are provided, -g will dominate.")
     parser.add_argument("--model_directory", type=str, default="~/.cache/huggingface", help="Directory where you store your GGUF files or repositories. This will be searched recursively. If you have a folder full of huggingface repositories, that is what this parameter wants.")
     parser.add_argument("--output_directory", type=str, default="~/.local/bin", help="Directory to put generated scripts into. Existing scripts will be overriden.")
     parser.add_argument("-l", '--layers', type=int, default=1, help="Default number of layers to offload to GPU by default. You can just open the generated script afterwards and change this easily, or you can adjust the LLM_LAYERS environment variable. Will also be written to the llm_layers file.")
     parser.add_argument("--context", type=int, default=2048, help="Default context size for loaded models. You can change this via the LLM_MAX_CONTEXT_LENGTH environment variable for all scripts. Will also be written to the llm_layers file.")
     parser.add_argument("-f", "--layers_file", type=str, default=getLayersFile(), help="File to write individual model loading information to. This file will be checked by the generated scripts for layers and context to use. You can still override these settings by supplying your own command line parameters. If this file already exists, it will not be overwritten, though new entries may be added to it. Also, it will be used as a --include_layers_file. The default value is platform dependent, often ~/.config/llm_layers. It is quit reasonable to leave the default and keep regenerating that file.")
-    parser.add_argument("-V", "--vram", type=str, default="", help="Set vram amount for loadout recommendation with -b. By default, vram is determined from hardware. Without -b, this parameter has no effect.")
+    parser.add_argument("-V", "--vram", type=str, default="", help="Set vram amount for loadout recommendation with -b and for computing gpu_layers and context with --fit. Give one amount per GPU for several, like '-V 8gb,8gb', to get a --tensor-split in the scripts. By default, vram is determined from hardware.")
+    parser.add_argument("--fit", action=argparse.BooleanOptionalAction, default=True, help="Compute gpu_layers and context for newly found models from their gguf header and the vram budget, instead of using -l and --context for everything. Models that fit entirely get 999 layers and as much context as fits, up to --max_context. Existing entries in the layers file are never changed.")
+    parser.add_argument("--memory", type=str, choices=["auto", "off"] + memory_strategies, default="auto", help="How backends hold the part of a model that stays in system memory, recorded per model in the layers file. 'auto' picks mmap, no-mmap or mlock from model size, offloaded layers and system ram. Run scripts then use that instead of the memory options in --additional_arguments. 'off' leaves it to --additional_arguments.")
+    parser.add_argument("--max_context", type=int, default=8192, help="Largest context size --fit will choose for models that fit into vram entirely.")
     parser.add_argument("-b", "--best_for_machine", action=argparse.BooleanOptionalAction, default=False, help="Include models based on the current system hardware. The selection is highly opinionated and subject to change over time. This option is disabled by default, unless the --layers_file does not exist, in which case the program assumes it's the first time you are running it, enabling -b. You can disable this behaviour by passing --no-best_for_machine explicitly.")
+    parser.add_argument("--offline", "--cache-only", dest="offline", action=argparse.BooleanOptionalAction, default=False, help="Resolve huggingface repositories purely from the resolution cache and never touch the network. Models that aren't present locally are listed, but not downloaded.")
+    parser.add_argument("-j", "--download_jobs", type=int, default=3, help="Number of models to download at the same time.")
+    parser.add_argument("--download_order", type=str, choices=["priority", "smallest"], default="priority", help="Order in which models are downloaded. 'priority' follows the layers file, 'smallest' gets small models first.")
+    parser.add_argument("--download_directory", type=str, default="", help="Put downloaded gguf files straight into this directory under their plain filenames, instead of into the huggingface cache. Usually the --model_directory. See llm-layers place.")
     parser.add_argument("--force_redownload", action=argparse.BooleanOptionalAction, default=False, help="Forces redownload of models when downloading is enabled. By default, models that are found in the model_directory will skip the download.")
+    parser.add_argument("--verify", action=argparse.BooleanOptionalAction, default=False, help="Check all models against the sizes and sha256 sums the huggingface hub has for them before writing scripts, and skip the corrupt ones. Hashes are cached, so only the first run reads everything. Downloads are always checked. See llm-layers verify.")
+    parser.add_argument("--pick", action="append", default=[], help="Model family like mistral-7b-instruct, or huggingface repository, to add the best quant of to the layers file, chosen for the vram budget and system ram. See llm-layers pick. This option can be supplied multiple times.")
+    parser.add_argument("--offload", type=float, default=1.0, help="Fraction of a --pick model that should be on the GPU. Lower values trade speed for a better quant.")
     parser.add_argument("-I", '--include_layers_file', action="append", default=[], help="Additional layer files to source from. Data will be gathered and added to the resulting --layer_file. Include layer files will not be written to. If multiple layer files contain entires with the same 'name' field, the result is undefined. This option can be supplied multiple times.")
     parser.add_argument("-p", "--prefix", type=str, default="run.", help="String to prepend each script's filename. Hint: Try putting the number of layers here.")
     parser.add_argument("-s", "--suffix", type=str, default=".sh", help="String to append to each resulting string.")
     parser.add_argument("-x","--executable", type=str, default="", help="Path to a backend (e.g. llama.cpp) executable. Server or main usually work. You can adjust this later with the LLM_SERVER environment variable.")
-    parser.add_argument("--log_directory", type=str, default=appdirs.user_log_dir(), help="Folder where to store the log files llm.1.log and llm.2.log, which will contain the executables standard output and standard error, respectively.")
-    parser.add_argument("--additional_arguments", type=str, default="-fa --parallel 1 --mlock --no-mmap --log-format text --log-disable", help="Any additional arguments that will be passed onto the server executable.")
+    parser.add_argument("--log_directory", type=str, default=appdirs.user_log_dir(), help="Folder where to store the log files MODEL.1.log and MODEL.2.log, which will contain the executables standard output and standard error, respectively. Every model gets its own, and the logs of the last few runs are kept as MODEL.1.log.1 and so on. llm-layers stats reads the timings in them.")
+    parser.add_argument("--additional_arguments", type=str, default=default_additional_arguments, help="Any additional arguments that will be passed onto the server executable.")
+    parser.add_argument("--watch", action=argparse.BooleanOptionalAction, default=False, help="Keep running after generating, and pick up models that appear in or disappear from the model directory. Only new models get a layers file entry and a script, and scripts of removed models are deleted. Needs -g.")
+    parser.add_argument("--watch_interval", type=float, default=2.0, help="Seconds between checks of the model directory with --watch.")
+    parser.add_argument("--debounce", type=float, default=5.0, help="With --watch, changes are only acted on once the model directory has been quiet for this many seconds, so e.g. a download of several shards is handled in one go.")
+    parser.add_argument("--profile", type=str, choices=["table", "json", "trace"], default=None, help="Report where the time went at the end: wall time per phase, counts like files scanned, http calls and bytes downloaded, and cache hit rates. 'trace' is a chrome trace for chrome://tracing or perfetto.")
+    parser.add_argument("--profile_file", type=str, default="", help="Write the --profile report to this file instead of standard error.")
     args = parser.parse_args()
+    if args.profile is not None:
+        enableProfiler()
     args.layers_file = os.path.expanduser(args.layers_file)
     if args.executable:
         args.executable = os.path.abspath(args.executable)
 
+    args.vram_devices = []
     if args.vram != "":
-        args.vram = megabyteIntFromVRamString(args.vram)
-        if args.vram <= 0:
-            fail("error: Nonsense or negative vram specified. Please specify vram amount like '-V 6gb' or '-V 6000MB' or similar.")
+        try:
+            args.vram_devices = [megabyteIntFromVRamString(w) for w in args.vram.split(",")]
+        except ValueError:
+            args.vram_devices = [0]
+        if [mb for mb in args.vram_devices if mb <= 0] != []:
+            fail("error: Nonsense or negative vram specified. Please specify vram amount like '-V 6gb' or '-V 6000MB' or similar, or '-V 8gb,8gb' for several GPUs.")
+        args.vram = sum(args.vram_devices)
 
     if args.log_directory:
         # ensure it exists
@@ -61,6 +107,9 @@ def main():
             
     if args.generate and args.dry_run:
         args.dry_run = False
+
+    if args.watch and not(args.generate):
+        fail("error: --watch only makes sense with -g.")
         
     if args.dry_run:
         if "--download" not in sys.argv:
@@ -76,6 +125,7 @@ def main():
         global temp_layersfile
         temp_layersfile = tempfile.NamedTemporaryFile()
         
+    checkLogArguments(args.additional_arguments)
     if args.executable == "" and args.generate:
         printerr("warning: No executable provided. You will either have to set LLM_SERVER in the environment or regenerate the scripts with --executable set. Otherwise the scripts won't work.")
 
@@ -90,16 +140,28 @@ def main():
     if not(os.path.isdir(mdir)):
         fail("Not a directory: " + mdir)
 
-    models = getGGUFFiles(mdir, args)
-    # recommendations
-    include_models = []
+    args.fit_vram = 0
+    args.fit_devices = []
+    if args.fit:
+        with phase("devices"):
+            args.fit_devices = args.vram_devices if args.vram else [d["total_mb"] for d in get_devices()]
+        args.fit_vram = sum(args.fit_devices)
+        if not(args.fit_vram):
+            printerr("warning: No GPU found and no vram given with -V. Using -l and --context for all models.")
+
+    with phase("scan"):
+        models = getGGUFFiles(mdir, args)
+    # everything that should end up in the layers file, see LayersFile.precedence for who wins on duplicates
+    include_models = LayersFile().merge(models, "filesystem")
     if args.best_for_machine:
         printout("Determining hardware...")
-        if not(args.vram):
-            vram = get_total_vram_mb()
+        with phase("devices"):
+            budgets = args.vram_devices if args.vram else [d["total_mb"] for d in get_devices()]
+        vram = effectiveVramMb(budgets)
+        if len(budgets) > 1:
+            printout("Found " + str(len(budgets)) + " GPUs with " + ", ".join([str(mb) + "MB" for mb in budgets]) + " of video ram, worth about " + str(vram) + "MB on a single card.\nChoosing appropriate loadout...")
         else:
-            vram = args.vram
-        printout("Found " + str(vram) + "MB of maximum video ram.\nChoosing appropriate loadout...")
+            printout("Found " + str(vram) + "MB of maximum video ram.\nChoosing appropriate loadout...")
         choice = choiceForVRam(vram)
         if choice is not None:
             if "id" in choice:
@@ -109,19 +171,28 @@ def main():
             printout("Done. Chose the '" + cool_name + "' loadout for your hardware.")
             if "description" in choice.keys():
                 printout("Description: " + choice["description"])
-            best_models = load_layers_file(choice["file"])
-            include_models += best_models
+            include_models.merge(LayersFile.read(choice["file"]), "loadout")
         else:
             printerr("error: No loadouts found. Failed to select a loadout for your machine.")
 
+    if args.pick != []:
+        from llm_layers.quant import pickRows
+        with phase("devices"):
+            budgets = args.vram_devices if args.vram else [d["total_mb"] for d in get_devices()]
+        with phase("pick"):
+            include_models.merge(pickRows(args.pick, budgets, systemMemoryMb()[0] - headroom_mb, offload=args.offload, context=args.context, max_context=args.max_context, offline=args.offline, report=printout), "loadout")
+
     # we always write this, though it might be a temp file
     if args.layers_file != "":
         # get the includes
         for includefile in args.include_layers_file:
-            # note the dry=true, this is not real writing layers file yet, we just want the include list
-            include_models += doLayersFile(includefile, ensureUniqueModels(models + include_models), args, dry=True)
+            try:
+                include_models.merge(LayersFile.read(os.path.expanduser(includefile)), "include")
+            except:
+                printerr("error reading " + includefile + ": \n" + traceback.format_exc())
             
-        layers_models = doLayersFile(args.layers_file, ensureUniqueModels(models + include_models), args, cmd=cmd)
+        with phase("layers file"):
+            layers_models = doLayersFile(args.layers_file, include_models, args, cmd=cmd)
     else:
         layers_models = []
 
@@ -138,14 +209,21 @@ def main():
             exclude = []
         else:
             exclude=[m["name"] for m in models]
-        download_for_layers_file(layersfile, exclude=exclude)
+        with phase("download"):
+            download_for_layers_file(layersfile, exclude=exclude, offline=args.offline, jobs=args.download_jobs, order=args.download_order, local_dir=os.path.expanduser(args.download_directory) or None)
         # regenerate file based models
-        models = getGGUFFiles(mdir, args)
+        with phase("scan"):
+            models = getGGUFFiles(mdir, args)
 
         
         # writing the scripts - need to do this *after* downloading. Also note that we only write scripts for models that actually exist and have been found bygetGGUFFiles
+    if args.verify:
+        with phase("verify"):
+            models = verifiedModels(models)
+
     if args.generate:
-        writeScriptFiles(models, sdir, args)
+        with phase("scripts"):
+            writeScriptFiles(models, sdir, args)
         
     printout("""If you want, add the following lines to your ~/.bashrc to set the values for all scripts.
 
@@ -166,6 +244,12 @@ Happy hacking!""")
             printout(drymsg + "\n" + show(temp_layersfile.name))
         else:
             printout(drymsg + open(temp_layersfile.name, "r").read())
+
+    if args.profile is not None:
+        getProfiler().report(args.profile, file=os.path.expanduser(args.profile_file))
+
+    if args.watch:
+        watchModels(mdir, sdir, args, cmd=cmd)
         
         
         
@@ -176,8 +260,8 @@ def doLayersFile(layersfile, models, args, cmd="", dry=False):
     Parameter
     layersfile : str
     A filename with model data, that will be both read from and written to.
-    models : list
-    A list of dictionaries containing model data
+    models : LayersFile or list
+    Model data to add. A list of dictionaries is merged like ensureUniqueModels does. Entries already in the layersfile always win, though empty cells in them are filled in from models.
     args : namespace
     An argparse command line argument object.
     cmd : str
@@ -186,69 +270,54 @@ def doLayersFile(layersfile, models, args, cmd="", dry=False):
     A list of dictionaries with model data of only the models found in the layersfile."""
     if os.path.isdir(layersfile):
         printerr("Layers file " + layersfile + " is a directory. What is this nonsense?")
+        return []
+
+    data = LayersFile()
+    if os.path.isfile(layersfile):
+        try:
+            data = LayersFile.read(layersfile)
+        except:
+            printerr("error reading " + layersfile + ": \n" + traceback.format_exc())
+
+    if isinstance(models, LayersFile):
+        result = LayersFile().mergeFile(models)
     else:
-        if os.path.isfile(layersfile):
-            # dictionaries of model data
-            data = []
-            try:
-                data = list(csv.DictReader(filter(lambda line: line[0] != "#", open(layersfile, "r")), delimiter="\t"))
-            except:
-                printerr("error reading " + layersfile + ": \n" + traceback.format_exc())
-        else:
-            data = []
-        newData = []
-        for model in models:
-            if "file" in model:
-                file = model["file"]
-                model["name"] = os.path.basename(os.path.normpath(file))
-            if list(filter(lambda d: d["name"] == model["name"], data)) != []:
-                # don't override anything
-                continue
-            newData.append(model)
+        result = modelsToLayersFile(models)
+    result.mergeFile(data)
 
-    if writeLayersConfig(layersfile, data + newData, cmd=cmd, dry=(args.dry_run or dry)):
+    if writeLayersConfig(layersfile, result, cmd=cmd, dry=(args.dry_run or dry)):
         printerr("Could not write layersfile " + layersfile)
     else:
         printout("Wrote layers to " + layersfile)
         printout("You can edit the layers file to adjust the context size and number of layers offloaded to the GPU on an individual, per-model basis. Changes will take effect without needing to regenerate the run scripts.")
-    return data
+    return list(data)
     
 def makeScriptName(modelfile, prefix="", suffix=""):
     return prefix + os.path.basename(modelfile) + suffix
 
-def getGGUFFiles(mdir, args, extensions=["gguf"]):
-    """Recursively walks through directories collecting gguf models. Returns a list of dictionaries with key "name" being the gguf model filename."""
-    models = []
-    seen = set()
-    files = glob.glob(mdir + "/*")
-    # filter out mmrpoj files. This is a heuristic, but it usually works
-    mmproj = ""
-    candidates = list(filter(lambda w: "mmproj" in w.lower() and os.path.isfile(w) and w.lower().endswith(".gguf"), files))
-    if candidates != []:
-        # just pick the first one
-        mmproj = candidates[0]
-        for c in candidates:
-            seen.add(c)
-
-    # try to guess prompt format
-    prompt_format = ""
-    for file in files:
-        if os.path.basename(file).lower() == "readme.md":
-            prompt_format = guessPromptFormat(open(file, "r").read())
-            # FIXME: new, we also want to figure out model type. No idea how yet.
-        model_type = "default"
-            
-
-    # now go through the remaining ones
-    for file in files:
-        if os.path.isfile(file):
-            if file.lower().endswith(".gguf") and not(file in seen):
-                d = { "file" : file, "name" : os.path.basename(file), "mmproj" : mmproj, "prompt_format" : prompt_format, "type" : model_type, "context" : args.context, "gpu_layers" : args.layers}
-
-                seen.add(file)
-                models.append(d)
-        else:
-            models = models + getGGUFFiles(file, args, extensions=extensions)
+def getGGUFFiles(mdir, args, extensions=["gguf"], index=None):
+    """Recursively walks through directories collecting gguf models. Returns a list of dictionaries with key "name" being the gguf model filename. If args.fit_vram is set, gpu_layers and context are solved for that budget, see llm_layers.fit. Directory listings and README prompt formats are kept in a persistent index, so unchanged parts of the tree aren't read again. See llm_layers.scan. On a dry run, the index is used but not saved."""
+    if index is None and args.dry_run:
+        index = ScanIndex()
+    models = scanModels(mdir, defaults={"context" : args.context, "gpu_layers" : args.layers}, extensions=extensions, index=index)
+    if args.fit_vram:
+        for model in models:
+            if model["facts"] is None:
+                continue
+            if len(args.fit_devices) > 1:
+                model.update(fitDevices(model["facts"], args.fit_devices, context=args.context, max_context=args.max_context))
+            else:
+                (model["gpu_layers"], model["context"]) = fitModel(model["facts"], args.fit_vram, context=args.context, max_context=args.max_context)
+    if args.memory in memory_strategies:
+        for model in models:
+            model["memory"] = args.memory
+    elif args.memory == "auto":
+        (total, available) = systemMemoryMb()
+        lock_limit = lockLimitMb()
+        for model in models:
+            if model["facts"] is not None:
+                # decided for a system that isn't running anything else yet, launch decides again for the situation at hand
+                model["memory"] = memoryStrategy(round(model["facts"]["size"] / 1e6), model["gpu_layers"], model["facts"]["block_count"], total, lock_limit_mb=lock_limit)
     return models
                 
 
@@ -256,28 +325,18 @@ def getGGUFFiles(mdir, args, extensions=["gguf"]):
 
 
 def writeLayersConfig(layersfile, data, cmd="", dry=False):
+    """Writes data, a LayersFile or a list of dictionaries, to layersfile, or to the temporary layers file if dry is True. Returns True on error."""
     header = "# Generated on " + datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S") + " with\n# " + cmd + "\n# Listed values are what will be used for a particular model by the backend, not the maximum model capability. Regenrating this file will keep existing settings, though your comments will be lost"
     header += "\n"
-    fields = "name gpu_layers context prompt_format type".split(" ")
-    # csv is such a joy, it will throw if the dict has more keys than defined fields
-    goodData = []
-    for d in data:
-        goodD = {}
-        for key in fields:
-            goodD[key] = d[key]
-        goodData.append(goodD)
-        
+    if not(isinstance(data, LayersFile)):
+        data = LayersFile().merge(data, "layersfile")
     try:
         if dry:
             global temp_layersfile
-            f = open(temp_layersfile.name, "w")
+            data.write(temp_layersfile.name, header=header)
         else:
-            f = open(layersfile, "w")
-        f.write(header)
-        writer = csv.DictWriter(f, fields, delimiter="\t")
-        writer.writeheader()
-        writer.writerows(sorted(goodData, key=lambda d: d["name"]))
-        f.close()
+            data.write(layersfile, header=header)
+            writeLookupFiles(layersfile, data)
     except:
         printerr("Caught exception\n" + traceback.format_exc())
         return True
@@ -289,15 +348,25 @@ def mkBashScript(modelData, layersfile, layers=1, server="server", additional_ar
     # watch out bash script begins here
     w = """#!/bin/bash
 MODEL=XXX_THE_MODEL_XXX
-CONFIGLAYERS=$( cat 'XXX_THE_LAYERSFILE_XXX' | grep -P "XXX_THE_MODELNAME_XXX\\t" | awk {'print $2'} )
-CONFIGCONTEXT=$( cat 'XXX_THE_LAYERSFILE_XXX' | grep -P "XXX_THE_MODELNAME_XXX\\t" | awk {'print $3'} )
+RAWNAME=XXX_THE_RAWNAME_XXX
+LAYERSFILE=${LLM_LAYERS_FILE:-'XXX_THE_LAYERSFILE_XXX'}
+# settings for this model are looked up once and kept in a small file next to the layers file, which is refreshed whenever the layers file is newer
+LOOKUPFILE="${LAYERSFILE}.d/${RAWNAME}.env"
+if [ "$LOOKUPFILE" -nt "$LAYERSFILE" ]
+then
+    . "$LOOKUPFILE"
+else
+    LOOKUP=$( awk -F '\t' -v name="$RAWNAME" 'XXX_THE_LOOKUP_PROGRAM_XXX' "$LAYERSFILE" 2>/dev/null )
+    mkdir -p "${LAYERSFILE}.d" 2>/dev/null && echo "$LOOKUP" > "${LOOKUPFILE}.$$" 2>/dev/null && mv -f "${LOOKUPFILE}.$$" "$LOOKUPFILE" 2>/dev/null
+    eval "$LOOKUP"
+fi
 MMPROJ_FILE=XXX_THE_MMPROJ_FILE_XXX
 LOG_DIR=XXX_THE_LOG_DIR_XXX
 
 echo "Starting run script for ${MODEL}"    
 if [ -n "$CONFIGLAYERS" ]
 then
-    echo "Found layers in layers file XXX_THE_LAYERSFILE_XXX"
+    echo "Found layers in layers file $LAYERSFILE"
     LAYERS=$CONFIGLAYERS
 elif [ -n "$LLM_LAYERS" ]
 then
@@ -312,7 +381,7 @@ echo "Setting layers to $LAYERS"
 
 if [ -n "$CONFIGCONTEXT" ]
 then
-    echo "Found context length in layers file XXX_THE_LAYERSFILE_XXX"
+    echo "Found context length in layers file $LAYERSFILE"
     MAX_CONTEXT_LENGTH=$CONFIGCONTEXT
 elif [ -n "$LLM_MAX_CONTEXT_LENGTH" ]
 then
@@ -325,6 +394,20 @@ fi
 
 echo "Setting Context to $MAX_CONTEXT_LENGTH"
 
+if [ -n "$CONFIGTENSORSPLIT" ]
+then
+    SPLIT_ARGS="--tensor-split $CONFIGTENSORSPLIT --main-gpu ${CONFIGMAINGPU:-0}"
+    echo "Found tensor split in layers file $LAYERSFILE, passing $SPLIT_ARGS to server."
+fi
+
+case "$CONFIGMEMORY" in
+    mmap) MEMORY_ARGS="" ;;
+    no-mmap) MEMORY_ARGS="--no-mmap" ;;
+    mlock) MEMORY_ARGS="--mlock" ;;
+    *) MEMORY_ARGS="XXX_THE_MEMORYARGS_XXX" ;;
+esac
+echo "Memory strategy ${CONFIGMEMORY:-default}, passing '$MEMORY_ARGS' to server."
+
 if [ -n "$MMPROJ_FILE" ]
 then
     MMPROJ_ARGS="--mmproj $MMPROJ_FILE"
@@ -343,16 +426,64 @@ echo "Setting SERVER to $SERVER"
 
 if [ -n "$LOG_DIR" ]
 then
-    LOG_STDOUT="${LOG_DIR}/llm.1.log"
-    LOG_STDERR="${LOG_DIR}/llm.2.log"
+    mkdir -p "$LOG_DIR"
+    LOG_STDOUT="${LOG_DIR}/${RAWNAME}.1.log"
+    LOG_STDERR="${LOG_DIR}/${RAWNAME}.2.log"
+    # keep the logs of the last few runs, .1 being the one before this
+    for LOG in "$LOG_STDOUT" "$LOG_STDERR"
+    do
+        for (( i = ${LLM_LOG_KEEP:-XXX_THE_LOGKEEP_XXX}; i > 1; i-- ))
+        do
+            [ -f "${LOG}.$((i - 1))" ] && mv -f "${LOG}.$((i - 1))" "${LOG}.$i"
+        done
+        [ -f "$LOG" ] && mv -f "$LOG" "${LOG}.1"
+    done
     echo "Logging to ${LOG_STDOUT} and ${LOG_STDERR}"
 fi
     
 echo "End of run script. Starting server."
+# tells llm-layers stats what the timings in the log belong to
+echo "# llm-layers run model=${RAWNAME} gpu_layers=$LAYERS context=$MAX_CONTEXT_LENGTH host=${HOSTNAME:-$(uname -n)} started=$(date +%s)" > "${LOG_STDERR}"
 PATH=./:$PATH
-$SERVER -c $MAX_CONTEXT_LENGTH -m $MODEL -ngl $LAYERS $MMPROJ_ARGS XXX_THE_ADDITIONALARGS_XXX $@ > "${LOG_STDOUT}" 2> "${LOG_STDERR}" &
+$SERVER -c $MAX_CONTEXT_LENGTH -m "$MODEL" -ngl $LAYERS $SPLIT_ARGS $MEMORY_ARGS $MMPROJ_ARGS XXX_THE_ADDITIONALARGS_XXX $@ > "${LOG_STDOUT}" 2>> "${LOG_STDERR}" &
 """
-    return w.replace("XXX_THE_MODEL_XXX", os.path.expanduser(modelpath)).replace("XXX_THE_LAYERS_XXX", str(layers)).replace("XXX_THE_SERVER_XXX", os.path.expanduser(server)).replace("XXX_THE_MODELNAME_XXX", re.escape(os.path.basename(os.path.expanduser(modelpath)))).replace("XXX_THE_LAYERSFILE_XXX", layersfile).replace("XXX_THE_ADDITIONALARGS_XXX", additional_arguments).replace("XXX_THE_MMPROJ_FILE_XXX", modelData["mmproj"]).replace("XXX_THE_LOG_DIR_XXX", logdir)
+    return w.replace("XXX_THE_MODEL_XXX", shlex.quote(os.path.expanduser(modelpath))).replace("XXX_THE_LAYERS_XXX", str(layers)).replace("XXX_THE_SERVER_XXX", os.path.expanduser(server)).replace("XXX_THE_MODELNAME_XXX", re.escape(os.path.basename(os.path.expanduser(modelpath)))).replace("XXX_THE_LAYERSFILE_XXX", layersfile).replace("XXX_THE_ADDITIONALARGS_XXX", " ".join([w for w in additional_arguments.split(" ") if w not in memory_options])).replace("XXX_THE_MEMORYARGS_XXX", " ".join([w for w in additional_arguments.split(" ") if w in memory_options])).replace("XXX_THE_MMPROJ_FILE_XXX", modelData["mmproj"]).replace("XXX_THE_LOG_DIR_XXX", logdir).replace("XXX_THE_RAWNAME_XXX", shlex.quote(os.path.basename(os.path.expanduser(modelpath)))).replace("XXX_THE_LOOKUP_PROGRAM_XXX", mkLookupProgram()).replace("XXX_THE_LOGKEEP_XXX", str(log_keep))
+
+# layers file columns and the variables the run scripts get them in
+lookup_variables = [("gpu_layers", "CONFIGLAYERS"), ("context", "CONFIGCONTEXT"), ("tensor_split", "CONFIGTENSORSPLIT"), ("main_gpu", "CONFIGMAINGPU"), ("memory", "CONFIGMEMORY")]
+
+def mkLookupProgram():
+    """Returns an awk program that finds the row of the model given in the awk variable name in a layers file, and prints the shell assignments for lookup_variables. Columns are found by header, not by position."""
+    prints = "; ".join(["print \"" + var + "=\\047\" ((\"" + col + "\" in col) ? $col[\"" + col + "\"] : \"\") \"\\047\"" for (col, var) in lookup_variables])
+    return "{ sub(/\\r$/, \"\") } /^#/ { next } !header { for (i = 1; i <= NF; i++) col[$i] = i; header = 1; next } $1 == name { " + prints + "; exit }"
+
+def mkLookupFile(row):
+    """Returns the contents of the lookup file for a layers file row, as written by mkLookupProgram."""
+    return "".join([var + "=" + shlex.quote(str(row.get(col, ""))) + "\n" for (col, var) in lookup_variables])
+
+def writeLookupFiles(layersfile, data):
+    """Writes a lookup file for every row in the LayersFile data into layersfile.d, and removes lookup files of models that are gone. The run scripts read these instead of searching the layers file. Must be called after the layers file was written, since lookup files older than the layers file are ignored."""
+    dir = layersfile + ".d"
+    if not(os.path.isdir(dir)):
+        os.makedirs(dir)
+    # the run scripts need lookup files strictly newer than the layers file, which the clock's granularity doesn't guarantee
+    stamp = max(time.time_ns(), os.stat(layersfile).st_mtime_ns + 1)
+    names = set()
+    for row in data:
+        names.add(row["name"] + ".env")
+        file = dir + "/" + row["name"] + ".env"
+        content = mkLookupFile(row)
+        try:
+            with open(file, "r") as f:
+                unchanged = f.read() == content
+        except OSError:
+            unchanged = False
+        if not(unchanged):
+            writeFileAtomic(file, content)
+        os.utime(file, ns=(stamp, stamp))
+    for file in os.listdir(dir):
+        if file.endswith(".env") and file not in names:
+            os.remove(dir + "/" + file)
 
 def fail(w):
     printerr(w)
@@ -367,35 +498,6 @@ def printout(w, **kwargs):
 
 
 
-def guessPromptFormat(w, formats="chat-ml alpaca user-assistant-newlines mistral".split(" ")):
-    ws = w.split("\n")
-    needles = ["prompt template", "prompt format", "prompt_format"]
-    for o_line in ws:
-        line = o_line.lower()
-        for needle in needles:
-            if needle in line:
-                for o_format in formats:
-                    format = o_format.lower()
-                    if format in line:
-                        return format
-
-    # additional heuristics if we haven't found it above
-    wl = w.lower()
-    if "<|im_start|>" in wl:
-        return "chat-ml"
-
-    if "### instruction:" in wl:
-        return "alpaca"
-
-    if "### user:" in wl:
-        return "user-assistant-newlines"
-
-    if "[INST]" in wl and "[/INST]" in wl:
-        return "mistral"
-    
-    # no idea
-    return ""
-    
 if __name__ == "__main__":
     main()
 
@@ -418,34 +520,130 @@ def writeScriptFiles(models, sdir, args):
             printerr("warning: Skipping " + scriptfile + ": Is a directory.")
             continue
 
+        script = mkBashScript(model, args.layers_file, layers=args.layers, server=args.executable, additional_arguments=args.additional_arguments, logdir=args.log_directory)
         if os.path.isfile(scriptfile):
+            if fileDigest(scriptfile) == hashlib.sha256(script.encode("utf-8")).hexdigest():
+                count("scripts unchanged")
+                continue
             printout("Overwriting " + scriptfile)
+            mode = os.stat(scriptfile).st_mode
         else:
             printout("Generating " + scriptfile)
-            
-        f = open(scriptfile, "w")
-        f.write(mkBashScript(model, args.layers_file, layers=args.layers, server=args.executable, additional_arguments=args.additional_arguments, logdir=args.log_directory))
-        f.flush()
-        st = os.stat(scriptfile)
-        os.chmod(scriptfile, st.st_mode | stat.S_IEXEC)
+            mode = 0o755 & ~umask()
+
+        # atomic, since the script might be started while we write it
+        writeFileAtomic(scriptfile, script, mode=stat.S_IMODE(mode) | stat.S_IXUSR)
+        count("scripts written")
 
     printout("Script files have been writen to " + sdir)    
 
+def fileDigest(file):
+    """Returns the sha256 hex digest of the contents of file, or None if it can't be read."""
+    try:
+        with open(file, "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+def umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+def removeScriptFiles(models, sdir, args):
+    """Deletes the scripts for models, but only if they are still the scripts llm-layers generated for them."""
+    for model in models:
+        scriptfile = os.path.normpath(sdir + "/" + makeScriptName(model["file"], args.prefix, args.suffix))
+        try:
+            head = open(scriptfile, "r").read(4096)
+        except OSError:
+            continue
+        if not(head.startswith("#!/bin/bash\nMODEL=" + os.path.expanduser(model["file"]) + "\n")):
+            printerr("warning: Not removing " + scriptfile + ", it has been edited.")
+            continue
+        os.remove(scriptfile)
+        printout("Removed " + scriptfile)
+
+def modelSignature(models):
+    """Returns a dictionary mapping model names to the identity of their files, so changes between two scans can be found by comparing signatures."""
+    signature = {}
+    for model in models:
+        try:
+            signature[model["name"]] = tuple([(os.stat(shard).st_mtime_ns, os.stat(shard).st_size) for shard in model["shards"]])
+        except OSError:
+            # vanished between scan and stat, it will be gone next time
+            continue
+    return signature
+
+def watchModels(mdir, sdir, args, cmd=""):
+    """Polls mdir every args.watch_interval seconds and handles models that were added, changed or removed since the last time, until interrupted. Changes are handled once the directory has looked the same for args.debounce seconds. Polling is cheap, since the scan index only lists directories whose mtime changed."""
+    index = ScanIndex()
+    models = getGGUFFiles(mdir, args, index=index)
+    known = modelSignature(models)
+    byName = {model["name"] : model for model in models}
+    pending = None
+    since = 0
+    printerr("Watching " + mdir + " for new models. Press ctrl+c to stop.")
+    try:
+        while True:
+            time.sleep(args.watch_interval)
+            try:
+                models = getGGUFFiles(mdir, args, index=index)
+                signature = modelSignature(models)
+                if signature == known:
+                    pending = None
+                    continue
+                if signature != pending:
+                    pending = signature
+                    since = time.monotonic()
+                    continue
+                if time.monotonic() - since < args.debounce:
+                    continue
+
+                added = [model for model in models if model["name"] in signature and known.get(model["name"], None) != signature[model["name"]]]
+                removed = [byName[name] for name in known.keys() if name not in signature]
+                printerr("Found " + str(len(added)) + " new or changed and " + str(len(removed)) + " removed models.")
+                if added != []:
+                    doLayersFile(args.layers_file, added, args, cmd=cmd)
+                    writeScriptFiles(added, sdir, args)
+                removeScriptFiles(removed, sdir, args)
+                index.save()
+            except OSError as e:
+                # e.g. a file vanished while it was read, or the disk is full. Nothing is marked as handled, so the next poll tries again
+                printerr("error: " + str(e) + ". Trying again in " + str(args.watch_interval) + "s.")
+                continue
+            known = signature
+            byName = {model["name"] : model for model in models}
+            pending = None
+    except KeyboardInterrupt:
+        pass
+    finally:
+        index.save()
+
+def verifiedModels(models):
+    """Returns models without the ones whose files don't match what the hub has for them, see llm_layers.verify."""
+    cache = getHashCache()
+    try:
+        results = verifyModels(models, cache=cache)
+    finally:
+        cache.save()
+    corrupt = [result["name"] for result in results if result["status"] == "corrupt"]
+    for result in results:
+        if result["status"] == "corrupt":
+            printerr("warning: " + result["name"] + " is corrupt, " + formatProblems(result) + ". Not writing a script for it. Delete it with 'llm-layers verify --remove " + result["name"] + "' to have it downloaded again.")
+    return [model for model in models if model["name"] not in corrupt]
+
 def ensureUniqueModels(models):
     """Takes a list of models as dictionaries and removes entries with duplicate "name" fields. Returns the list without offending entries.
-    Current behaviour when a duplicate is encountered is to keep the layerfile model when conflict is between a model from a layerfile and a model read from the filesystem (which would just get default values assigned to it). In any other case, the model further down the list wins."""
-    def f(acc, model):
-        if model["name"] in [other["name"] for other in acc]:
-            # there are duplicates, now we need to decide who wins
-            if "file" in model.keys():
-                # other model in acc wins
-                return acc
-            else:
-                # i win, remove other and add myself
-                return list(filter(lambda other: other["name"] != model["name"], acc)) + [model]
-        return acc + [model]
-            
-    return reduce(f, models, [])
+    Current behaviour when a duplicate is encountered is to keep the layerfile model when conflict is between a model from a layerfile and a model read from the filesystem (which would just get default values assigned to it). In any other case, the model further down the list wins. Only layers file columns are kept."""
+    return list(modelsToLayersFile(models))
+
+def modelsToLayersFile(models):
+    """Merges a list of model dictionaries into a LayersFile. Models with a file key count as found on the filesystem, all others as included from a layers file."""
+    lf = LayersFile()
+    for model in models:
+        lf.merge([model], "filesystem" if "file" in model else "include")
+    return lf
 
 
 
@@ -468,7 +666,10 @@ def choiceForVRam(vram):
                     if len(ws) > 1:
                         key = ws[0].replace("#", "").strip()
                         if key == "vram":
-                            d[key] = megabyteIntFromVRamString(ws[1].strip())
+                            try:
+                                d[key] = megabyteIntFromVRamString(ws[1].strip())
+                            except ValueError as e:
+                                printerr("warning: Ignoring loadout " + file + ": " + str(e))
                         elif key in validkeys:
                             d[key] = ":".join(ws[1:]).strip()
             except:
@@ -499,27 +700,13 @@ def megabyteIntFromVRamString(w):
     return int(round(parse_size(w) / 1e6))
 
 def parse_size(w):
-    """Takes a string of byte size like 200kb and returns the number of bytes as an int. Returns -1 on no parse."""
+    """Takes a string of byte size like 200kb or 1.5gb and returns the number of bytes as an int. A bare number is taken as GB. Raises ValueError on no parse."""
     units = {"B": 1, "KB": 10**3, "MB": 10**6, "GB": 10**9, "TB": 10**12}
     # Alternative unit definitions, notably used by Windows:
     # units = {"B": 1, "KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
-    w = w.strip()
-    for i in range(0, len(w)):
-        if not(w[i].isdigit()):
-            break
-
-    if i == len(w):
-        number = w
-        unit = "GB"
-    else:
-        number = w[:i].strip()
-        unit = w[i:].strip().upper()
-        
-        try:
-            n = int(number)
-        except:
-            return -1
+    m = re.match(r"^(\d+(?:\.\d+)?)\s*([a-zA-Z]*)$", w.strip())
+    unit = (m.group(2).upper() or "GB") if m else None
     if unit not in units:
-        return -1
-    return int(round(float(n) * units[unit]))
+        raise ValueError("Could not read the size '" + w + "'. Give amounts like '6gb' or '500mb'.")
+    return int(round(float(m.group(1)) * units[unit]))
                                 
@@ -0,0 +1,259 @@
+import os, re, mmap, struct
+from llm_layers.cache import JsonCache, getCacheDir
+
+# see https://github.com/ggerganov/ggml/blob/master/docs/gguf.md
+GGUF_MAGIC = b"GGUF"
+GGUF_DEFAULT_ALIGNMENT = 32
+
+# value type -> struct format, for the fixed size types
+scalar_formats = {0 : "<B", 1 : "<b", 2 : "<H", 3 : "<h", 4 : "<I", 5 : "<i", 6 : "<f", 7 : "<?", 10 : "<Q", 11 : "<q", 12 : "<d"}
+GGUF_TYPE_STRING = 8
+GGUF_TYPE_ARRAY = 9
+_uint64 = struct.Struct("<Q")
+
+# arrays longer than this (e.g. the tokenizer vocabulary) are skipped and only their length is kept
+max_array_length = 1024
+
+# general.file_type -> the quantization name that llama.cpp uses in filenames
+file_types = {0 : "F32", 1 : "F16", 2 : "Q4_0", 3 : "Q4_1", 7 : "Q8_0", 8 : "Q5_0", 9 : "Q5_1", 10 : "Q2_K", 11 : "Q3_K_S", 12 : "Q3_K_M", 13 : "Q3_K_L", 14 : "Q4_K_S", 15 : "Q4_K_M", 16 : "Q5_K_S", 17 : "Q5_K_M", 18 : "Q6_K", 19 : "IQ2_XXS", 20 : "IQ2_XS", 21 : "Q2_K_S", 22 : "IQ3_XS", 23 : "IQ3_XXS", 24 : "IQ1_S", 25 : "IQ4_NL", 26 : "IQ3_S", 27 : "IQ3_M", 28 : "IQ2_S", 29 : "IQ2_M", 30 : "IQ4_XS", 31 : "IQ1_M", 32 : "BF16", 36 : "TQ1_0", 37 : "TQ2_0"}
+
+class GGUFError(Exception):
+    pass
+
+class _Reader(object):
+    def __init__(self, buf):
+        self.buf = buf
+        self.pos = 0
+
+    def unpack(self, fmt):
+        try:
+            v = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        except struct.error:
+            raise GGUFError("Unexpected end of file at offset " + str(self.pos))
+        self.pos += struct.calcsize(fmt)
+        return v
+
+    def string(self):
+        n = self.unpack("<Q")
+        if self.pos + n > len(self.buf):
+            raise GGUFError("String runs past end of file at offset " + str(self.pos))
+        w = self.buf[self.pos:self.pos+n].decode("utf-8", errors="replace")
+        self.pos += n
+        return w
+
+    def value(self, type):
+        if type in scalar_formats:
+            return self.unpack(scalar_formats[type])
+        if type == GGUF_TYPE_STRING:
+            return self.string()
+        if type == GGUF_TYPE_ARRAY:
+            elemtype = self.unpack("<I")
+            n = self.unpack("<Q")
+            if n > max_array_length:
+                self.skipArray(elemtype, n)
+                return {"array_length" : n}
+            return [self.value(elemtype) for i in range(0, n)]
+        raise GGUFError("Unknown value type " + str(type) + " at offset " + str(self.pos))
+
+    def skipArray(self, elemtype, n):
+        if elemtype in scalar_formats:
+            self.pos += n * struct.calcsize(scalar_formats[elemtype])
+        elif elemtype == GGUF_TYPE_STRING:
+            # this is the tokenizer vocabulary, so it's the hot loop of the whole reader
+            unpack = _uint64.unpack_from
+            buf = self.buf
+            pos = self.pos
+            try:
+                for i in range(0, n):
+                    pos += 8 + unpack(buf, pos)[0]
+            except struct.error:
+                raise GGUFError("Unexpected end of file at offset " + str(pos))
+            self.pos = pos
+        else:
+            for i in range(0, n):
+                self.value(elemtype)
+
+def readGGUF(path, tensors=True):
+    """Reads the header of the gguf file at path. Returns a dictionary with keys version, metadata (a dictionary of all key-value pairs, with long arrays replaced by their length), tensors (a list of dictionaries with keys name, shape, type, offset and size), data_offset and file_size.
+    The file is memory mapped and only the header and tensor info pages are touched, so this is fast even for huge files. With tensors=False, reading stops after the metadata. Raises GGUFError if the file isn't a gguf file."""
+    with open(path, "rb") as f:
+        file_size = os.fstat(f.fileno()).st_size
+        if file_size < 24:
+            raise GGUFError(path + " is too small to be a gguf file.")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if buf[0:4] != GGUF_MAGIC:
+                raise GGUFError(path + " is not a gguf file.")
+            r = _Reader(buf)
+            r.pos = 4
+            version = r.unpack("<I")
+            if version < 2:
+                raise GGUFError("Unsupported gguf version " + str(version) + " in " + path)
+            tensor_count = r.unpack("<Q")
+            kv_count = r.unpack("<Q")
+            metadata = {}
+            for i in range(0, kv_count):
+                key = r.string()
+                metadata[key] = r.value(r.unpack("<I"))
+
+            result = {"version" : version, "metadata" : metadata, "tensors" : [], "data_offset" : None, "file_size" : file_size}
+            if not(tensors):
+                return result
+
+            infos = []
+            for i in range(0, tensor_count):
+                name = r.string()
+                n_dims = r.unpack("<I")
+                shape = [r.unpack("<Q") for j in range(0, n_dims)]
+                infos.append({"name" : name, "shape" : shape, "type" : r.unpack("<I"), "offset" : r.unpack("<Q")})
+
+    alignment = metadata.get("general.alignment", GGUF_DEFAULT_ALIGNMENT)
+    data_offset = r.pos + (alignment - r.pos % alignment) % alignment
+    # tensors are laid out back to back, so the distance to the next tensor is the size, padding included
+    ordered = sorted(infos, key=lambda t: t["offset"])
+    for i in range(0, len(ordered)):
+        end = ordered[i+1]["offset"] if i+1 < len(ordered) else file_size - data_offset
+        ordered[i]["size"] = end - ordered[i]["offset"]
+    result["tensors"] = infos
+    result["data_offset"] = data_offset
+    return result
+
+def architectureKey(metadata, key, default=None):
+    """Returns metadata[arch + "." + key], where arch is the model's general.architecture."""
+    arch = metadata.get("general.architecture", "")
+    return metadata.get(arch + "." + key, default)
+
+def layerOf(tensorname):
+    """Returns the block number of a tensor named like blk.12.attn_q.weight, or None."""
+    ws = tensorname.split(".")
+    if len(ws) > 2 and ws[0] == "blk" and ws[1].isdigit():
+        return int(ws[1])
+    return None
+
+def modelFacts(gguf):
+    """Takes the result of readGGUF and returns a dictionary of the facts llm-layers cares about: architecture, block_count, context_length, embedding_length, head_count, head_count_kv, quantization, chat_template, general_name, size_label, vision (True for models that can see), size, layer_bytes (a list with the bytes of each block), other_bytes (embeddings, output layer and everything else outside of the blocks) and output_bytes (the part of other_bytes belonging to the output layer)."""
+    md = gguf["metadata"]
+    head_count = architectureKey(md, "attention.head_count")
+    head_count_kv = architectureKey(md, "attention.head_count_kv", head_count)
+    # some models have per-layer head counts, we go with the maximum
+    if isinstance(head_count, list):
+        head_count = max(head_count) if head_count != [] else None
+    if isinstance(head_count_kv, list):
+        head_count_kv = max(head_count_kv) if head_count_kv != [] else None
+    block_count = architectureKey(md, "block_count", 0)
+    layer_bytes = [0] * block_count
+    other_bytes = 0
+    output_bytes = 0
+    for t in gguf["tensors"]:
+        n = layerOf(t["name"])
+        if n is not None and n < block_count:
+            layer_bytes[n] += t["size"]
+        else:
+            other_bytes += t["size"]
+            if t["name"].startswith("output"):
+                output_bytes += t["size"]
+    template = md.get("tokenizer.chat_template", "")
+    # projectors (clip) and models with a built in vision tower (mllama and friends)
+    vision = md.get("general.architecture", "") in ["clip", "mllama"] or any([key.startswith("clip.") or ".vision." in key for key in md.keys()])
+    return {"architecture" : md.get("general.architecture", ""),
+            "block_count" : block_count,
+            "context_length" : architectureKey(md, "context_length", 0),
+            "embedding_length" : architectureKey(md, "embedding_length", 0),
+            "head_count" : head_count,
+            "head_count_kv" : head_count_kv,
+            "quantization" : file_types.get(md.get("general.file_type", None), ""),
+            "chat_template" : template if isinstance(template, str) else "",
+            "general_name" : str(md.get("general.name", "")),
+            "size_label" : str(md.get("general.size_label", "")),
+            "vision" : vision,
+            "size" : gguf["file_size"],
+            "layer_bytes" : layer_bytes,
+            "other_bytes" : other_bytes,
+            "output_bytes" : output_bytes}
+
+# bump this when modelFacts learns something new, so cached facts get read again
+facts_version = 2
+
+_facts_cache = None
+def getFactsCache():
+    global _facts_cache
+    if _facts_cache is None:
+        _facts_cache = JsonCache(getCacheDir() + "/gguf.json")
+    return _facts_cache
+
+def ggufFacts(path, cache=None):
+    """Returns modelFacts for the gguf file at path, or None if it can't be read. Results are cached by path, mtime and size, so the header is only parsed once per file version. Call save() on the cache to persist them."""
+    if cache is None:
+        cache = getFactsCache()
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    key = os.path.abspath(path)
+    cached = cache.get(key)
+    if cached is not None and cached["mtime"] == st.st_mtime_ns and cached["size"] == st.st_size and cached.get("version", 1) == facts_version:
+        return cached["facts"]
+    try:
+        facts = modelFacts(readGGUF(path))
+    except (GGUFError, OSError, ValueError):
+        facts = None
+    cache.put(key, {"mtime" : st.st_mtime_ns, "size" : st.st_size, "version" : facts_version, "facts" : facts})
+    return facts
+
+def splitFacts(paths, cache=None):
+    """Returns modelFacts for a model split into several gguf files, like llama.cpp's gguf-split writes them, or None if any of them can't be read. paths are the shards in order. Metadata comes from the first shard, tensors and sizes from all of them. Cached like ggufFacts, under the first shard and the identity of every shard."""
+    if len(paths) == 1:
+        return ggufFacts(paths[0], cache=cache)
+    if cache is None:
+        cache = getFactsCache()
+    try:
+        stats = [os.stat(path) for path in paths]
+    except OSError:
+        return None
+    key = os.path.abspath(paths[0])
+    identity = [[st.st_mtime_ns, st.st_size] for st in stats]
+    cached = cache.get(key)
+    if cached is not None and cached.get("shards", None) == identity and cached.get("version", 1) == facts_version:
+        return cached["facts"]
+    try:
+        gguf = readGGUF(paths[0])
+        for path in paths[1:]:
+            other = readGGUF(path)
+            gguf["tensors"] += other["tensors"]
+            gguf["file_size"] += other["file_size"]
+        facts = modelFacts(gguf)
+    except (GGUFError, OSError, ValueError):
+        facts = None
+    cache.put(key, {"mtime" : stats[0].st_mtime_ns, "size" : stats[0].st_size, "shards" : identity, "version" : facts_version, "facts" : facts})
+    return facts
+
+# shards as written by llama.cpp's gguf-split, e.g. model-Q8_0-00001-of-00004.gguf
+shard_pattern = re.compile(r"^(.*)-(\d{5})-of-(\d{5})\.gguf$", re.IGNORECASE)
+
+def shardInfo(filename):
+    """Returns a tuple (prefix, number, count) if filename is a shard of a split model, None otherwise. number starts at 1."""
+    match = shard_pattern.match(os.path.basename(filename))
+    if match is None:
+        return None
+    return (match.group(1), int(match.group(2)), int(match.group(3)))
+
+def shardNames(filename):
+    """Returns the names of all files making up the model that filename belongs to, in order. That's just [filename] for models that aren't split."""
+    info = shardInfo(filename)
+    if info is None:
+        return [filename]
+    (prefix, number, count) = info
+    dir = os.path.dirname(filename)
+    return [os.path.join(dir, prefix + "-" + str(i).zfill(5) + "-of-" + str(count).zfill(5) + ".gguf") for i in range(1, count + 1)]
+
+# columns that get added to layers file rows, from ggufFacts
+fact_fields = "architecture block_count context_length quantization size_mb".split(" ")
+
+def factColumns(facts):
+    """Returns the layers file columns for facts, as returned by ggufFacts. Empty strings if facts is None."""
+    if facts is None:
+        return {key : "" for key in fact_fields}
+    return {"architecture" : facts["architecture"],
+            "block_count" : facts["block_count"],
+            "context_length" : facts["context_length"],
+            "quantization" : facts["quantization"],
+            "size_mb" : round(facts["size"] / 1e6)}
@@ -0,0 +1,326 @@
+import os, re, sys, glob, json, time, argparse
+import appdirs
+from llm_layers.layers import printerr
+from llm_layers.fit import ALL_LAYERS
+
+# socket and statistics are imported where they are used, generate only needs log_keep from here and starts quickly
+# how many logs of earlier runs are kept next to the current one, as MODEL.1.log.1 and so on
+log_keep = 5
+
+# the first line of every log, written by the run scripts and by launch before the backend starts
+header_pattern = re.compile(r"^# llm-layers run (.*)$")
+# appended by launch once the backend is ready
+ready_pattern = re.compile(r"^# llm-layers ready load_s=([\d.]+)")
+# what llama.cpp prints while loading and serving. Formats differ between versions, these cover the common ones.
+model_pattern = re.compile(r"loaded meta data with \d+ key-value pairs and \d+ tensors from (\S+)")
+offload_pattern = re.compile(r"offloaded (\d+)/(\d+) layers to GPU")
+context_pattern = re.compile(r"\bn_ctx\s+=\s+(\d+)")
+build_pattern = re.compile(r"\b(?:build|version)\s*[:=]\s*(\d+ \([0-9a-f]+\))")
+# device buffers only, the CUDA_Host and CPU ones are system memory
+vram_pattern = re.compile(r"\b(?:CUDA|ROCm|Metal|Vulkan|SYCL|MUSA|CANN)\d*\s+(?:\w+ )?buffer size\s*=\s*([\d.]+) MiB")
+load_pattern = re.compile(r"\bload time\s*=\s*([\d.]+) ms")
+prompt_pattern = re.compile(r"prompt eval time\s*=\s*([\d.]+) ms\s*/\s*(\d+) (?:tokens|runs).*?([\d.]+) tokens per second")
+eval_pattern = re.compile(r"(?<!prompt )\beval time\s*=\s*([\d.]+) ms\s*/\s*(\d+) (?:tokens|runs).*?([\d.]+) tokens per second")
+log_pattern = re.compile(r"^(.*)\.([12])\.log(?:\.(\d+))?$")
+
+sparks = "▁▂▃▄▅▆▇█"
+
+def getHistoryFile():
+    return appdirs.user_data_dir() + "/llm_layers/history.sqlite"
+
+def rotateLog(file, keep=log_keep):
+    """Moves file out of the way for a new run. It becomes file.1, file.1 becomes file.2 and so on, up to keep old logs."""
+    for i in range(keep, 1, -1):
+        if os.path.isfile(file + "." + str(i - 1)):
+            os.replace(file + "." + str(i - 1), file + "." + str(i))
+    if os.path.isfile(file):
+        os.replace(file, file + ".1")
+
+def runHeader(model, gpu_layers, context, host=None, started=None):
+    """Returns the line that starts the log of a run, recording what the timings in it belong to."""
+    import socket
+    return "# llm-layers run model=" + model + " gpu_layers=" + str(gpu_layers) + " context=" + str(context) + " host=" + (host or socket.gethostname()) + " started=" + str(int(started or time.time())) + "\n"
+
+def argvHeader(argv):
+    """Returns runHeader for a backend started with argv, as made by llm_layers.launch.backendCommand."""
+    def value(option, default=""):
+        # the last one wins, like it does for llama.cpp
+        return argv[len(argv) - 1 - argv[::-1].index(option) + 1] if option in argv[:-1] else default
+    return runHeader(os.path.basename(value("-m", "unknown")), value("-ngl", ""), value("-c", ""))
+
+def checkLogArguments(additional_arguments):
+    """Warns if the backend arguments keep llama.cpp from logging the timings llm-layers stats reads."""
+    if "--log-disable" in additional_arguments.split():
+        printerr("warning: --log-disable in the backend arguments leaves no timings in the logs for llm-layers stats.")
+
+def parseLog(lines, run=None):
+    """Extracts what a run of the backend reported from the lines of its log. Returns a dictionary with keys model, gpu_layers, layers_total, context, host, started, backend, load_s, vram_mb and requests, a list of dictionaries with prompt_tokens, prompt_tps, eval_tokens and eval_tps, one per completed request. Keys nothing was found for are None. Values from the run header win over what llama.cpp printed, except for gpu_layers, where the layers actually offloaded are recorded."""
+    if run is None:
+        run = {}
+    for key in ["model", "gpu_layers", "layers_total", "context", "host", "started", "backend", "load_s", "vram_mb"]:
+        run.setdefault(key, None)
+    run.setdefault("requests", [])
+    header = {}
+    vram = 0.0
+    load_ms = None
+    prompt = None
+    for line in lines:
+        if line.startswith("{"):
+            # --log-format json, the messages are the same
+            try:
+                line = str(json.loads(line).get("msg", line))
+            except (ValueError, AttributeError):
+                pass
+        m = header_pattern.match(line)
+        if m:
+            header = dict(re.findall(r"(\w+)=(\S*)", m.group(1)))
+            continue
+        m = ready_pattern.match(line)
+        if m:
+            run["load_s"] = float(m.group(1))
+            continue
+        m = model_pattern.search(line)
+        if m and run["model"] is None:
+            run["model"] = os.path.basename(m.group(1))
+        m = offload_pattern.search(line)
+        if m:
+            (run["gpu_layers"], run["layers_total"]) = (int(m.group(1)), int(m.group(2)))
+        m = context_pattern.search(line)
+        if m and run["context"] is None:
+            run["context"] = int(m.group(1))
+        m = build_pattern.search(line)
+        if m and run["backend"] is None:
+            run["backend"] = m.group(1)
+        m = vram_pattern.search(line)
+        if m:
+            vram += float(m.group(1))
+        m = load_pattern.search(line)
+        if m:
+            load_ms = float(m.group(1))
+        m = prompt_pattern.search(line)
+        if m:
+            prompt = (int(m.group(2)), float(m.group(3)))
+            continue
+        m = eval_pattern.search(line)
+        if m:
+            (prompt_tokens, prompt_tps) = prompt if prompt is not None else (None, None)
+            run["requests"].append({"prompt_tokens" : prompt_tokens, "prompt_tps" : prompt_tps, "eval_tokens" : int(m.group(2)), "eval_tps" : float(m.group(3))})
+            prompt = None
+    if header.get("model", ""):
+        run["model"] = header["model"]
+    if header.get("host", ""):
+        run["host"] = header["host"]
+    if header.get("started", "").isdigit():
+        run["started"] = float(header["started"])
+    if header.get("context", "").isdigit():
+        run["context"] = int(header["context"])
+    if run["gpu_layers"] is None and header.get("gpu_layers", "").isdigit():
+        run["gpu_layers"] = int(header["gpu_layers"])
+    if run["load_s"] is None and load_ms is not None:
+        run["load_s"] = round(load_ms / 1000, 2)
+    if vram:
+        # llama.cpp reports MiB
+        run["vram_mb"] = round(vram * 1.048576)
+    return run
+
+def logRuns(logdir):
+    """Returns a list of pairs (stdout, stderr) of log files in logdir that belong to the same run, current and rotated ones. Either may be None if it doesn't exist."""
+    runs = {}
+    for path in glob.glob(os.path.join(glob.escape(logdir), "*.log*")):
+        m = log_pattern.match(os.path.basename(path))
+        if m is None or not(os.path.isfile(path)):
+            continue
+        pair = runs.setdefault((m.group(1), m.group(3)), [None, None])
+        pair[int(m.group(2)) - 1] = path
+    return [tuple(pair) for (key, pair) in sorted(runs.items(), key=lambda item: (item[0][0], int(item[0][1] or 0)))]
+
+def readLines(path):
+    if path is None:
+        return []
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        return f.read().splitlines()
+
+class History(object):
+    """The performance history, a small sqlite database with a row per backend run in the table runs, and a row per request in requests. Runs are imported from log files, which are recognized by device, inode and first line, so rotated logs aren't imported twice, and a log that grew since the last import is read again."""
+    schema = """
+create table if not exists runs (id integer primary key, source text unique, log text, signature text, started real, model text, gpu_layers integer, layers_total integer, context integer, host text, backend text, load_s real, vram_mb integer);
+create table if not exists requests (run integer references runs(id) on delete cascade, prompt_tokens integer, prompt_tps real, eval_tokens integer, eval_tps real);
+create index if not exists runs_model on runs (model, host, started);
+create index if not exists requests_run on requests (run);
+"""
+    def __init__(self, file=None):
+        # sqlite3 isn't needed anywhere else
+        import sqlite3
+        self.file = file if file is not None else getHistoryFile()
+        if not(os.path.isdir(os.path.dirname(os.path.abspath(self.file)))):
+            os.makedirs(os.path.dirname(os.path.abspath(self.file)))
+        self.db = sqlite3.connect(self.file)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("pragma foreign_keys = on")
+        self.db.executescript(self.schema)
+
+    def close(self):
+        self.db.close()
+
+    def importRun(self, stdout, stderr):
+        """Imports the run logged to the files stdout and stderr, if it is new or grew since it was imported. Returns True if something was imported. Runs without a model are ignored, they are of no use."""
+        main = stderr if stderr is not None else stdout
+        st = os.stat(main)
+        with open(main, "rb") as f:
+            first = f.readline(4096)
+        source = str(st.st_dev) + ":" + str(st.st_ino) + ":" + first.decode("utf-8", errors="replace").strip()
+        signature = ":".join([str(os.stat(p).st_size) + "/" + str(os.stat(p).st_mtime_ns) for p in [stdout, stderr] if p is not None])
+        row = self.db.execute("select id, signature from runs where source = ?", (source,)).fetchone()
+        if row is not None and row["signature"] == signature:
+            return False
+        run = parseLog(readLines(stderr) + readLines(stdout))
+        if run["model"] is None:
+            return False
+        if run["started"] is None:
+            run["started"] = st.st_mtime
+        if run["host"] is None:
+            import socket
+            run["host"] = socket.gethostname()
+        with self.db:
+            if row is not None:
+                self.db.execute("delete from runs where id = ?", (row["id"],))
+            cursor = self.db.execute("insert into runs (source, log, signature, started, model, gpu_layers, layers_total, context, host, backend, load_s, vram_mb) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                     (source, main, signature, run["started"], run["model"], run["gpu_layers"], run["layers_total"], run["context"], run["host"], run["backend"], run["load_s"], run["vram_mb"]))
+            self.db.executemany("insert into requests (run, prompt_tokens, prompt_tps, eval_tokens, eval_tps) values (?, ?, ?, ?, ?)",
+                                [(cursor.lastrowid, r["prompt_tokens"], r["prompt_tps"], r["eval_tokens"], r["eval_tps"]) for r in run["requests"]])
+        return True
+
+    def importLogs(self, logdir):
+        """Imports all runs logged in logdir. Returns the number of runs that were new or had grown."""
+        n = 0
+        for (stdout, stderr) in logRuns(logdir):
+            try:
+                n += self.importRun(stdout, stderr)
+            except OSError:
+                # rotated away while we were looking
+                continue
+        return n
+
+    def runs(self, models=[], host=None):
+        """Returns a list of dictionaries, one per run, oldest first, with the columns of runs plus the medians prompt_tps and eval_tps over the run's requests, and their number. gpu_layers is ALL_LAYERS for runs that offloaded everything."""
+        query = "select * from runs"
+        conditions = []
+        values = []
+        if models != []:
+            conditions.append("model in (" + ", ".join(["?"] * len(models)) + ")")
+            values += models
+        if host is not None:
+            conditions.append("host = ?")
+            values.append(host)
+        if conditions != []:
+            query += " where " + " and ".join(conditions)
+        result = []
+        for row in self.db.execute(query + " order by started, id", values).fetchall():
+            run = dict(row)
+            requests = self.db.execute("select prompt_tps, eval_tps from requests where run = ?", (run["id"],)).fetchall()
+            run["requests"] = len(requests)
+            run["prompt_tps"] = median([r["prompt_tps"] for r in requests])
+            run["eval_tps"] = median([r["eval_tps"] for r in requests])
+            if run["gpu_layers"] is not None and run["layers_total"] and run["gpu_layers"] >= run["layers_total"]:
+                run["gpu_layers"] = ALL_LAYERS
+            result.append(run)
+        return result
+
+def median(xs):
+    import statistics
+    xs = [x for x in xs if x is not None]
+    return statistics.median(xs) if xs != [] else None
+
+def sparkline(xs):
+    """Returns a line of block characters showing the values xs, scaled between their minimum and maximum."""
+    xs = [x for x in xs if x is not None]
+    if xs == []:
+        return ""
+    (lo, hi) = (min(xs), max(xs))
+    return "".join([sparks[0 if hi == lo else round((x - lo) / (hi - lo) * (len(sparks) - 1))] for x in xs])
+
+def summarize(runs, trend=12):
+    """Returns a list of dictionaries, one per model, gpu_layers, context and host, with the number of runs and medians of load time, vram and speeds over them. trend shows generation speed over the last runs."""
+    groups = {}
+    for run in runs:
+        groups.setdefault((run["model"], run["gpu_layers"], run["context"], run["host"]), []).append(run)
+    rows = []
+    for ((model, gpu_layers, context, host), group) in sorted(groups.items(), key=lambda item: (item[0][0], item[0][3], -item[1][-1]["started"])):
+        measured = [run for run in group if run["eval_tps"] is not None]
+        rows.append({"model" : model,
+                     "gpu_layers" : "" if gpu_layers is None else gpu_layers,
+                     "context" : "" if context is None else context,
+                     "host" : host,
+                     "runs" : len(group),
+                     "last" : time.strftime("%Y-%m-%d %H:%M", time.localtime(group[-1]["started"])),
+                     "load_s" : rounded(median([run["load_s"] for run in group])),
+                     "vram_mb" : rounded(median([run["vram_mb"] for run in group]), 0),
+                     "pp_tps" : rounded(median([run["prompt_tps"] for run in measured])),
+                     "tg_tps" : rounded(median([run["eval_tps"] for run in measured])),
+                     "trend" : sparkline([run["eval_tps"] for run in measured[-trend:]])})
+    return rows
+
+def rounded(x, digits=1):
+    if x is None:
+        return ""
+    return round(x, digits) if digits else round(x)
+
+def findRegressions(runs, threshold=0.1):
+    """Finds drops in generation speed that came with a change of setup. Runs of a model on a host are split wherever gpu_layers, context or the backend build changed, and the median speed of every stretch is compared to the one before it.
+    Returns a list of dictionaries with keys model, host, started (of the first run after the change), change (a description of what changed), before and after (tokens per second) and drop (a fraction), for every drop larger than threshold."""
+    regressions = []
+    byModel = {}
+    for run in runs:
+        if run["eval_tps"] is not None:
+            byModel.setdefault((run["model"], run["host"]), []).append(run)
+    for ((model, host), group) in byModel.items():
+        stretches = []
+        for run in group:
+            setup = (run["gpu_layers"], run["context"], run["backend"])
+            if stretches == [] or stretches[-1][0] != setup:
+                stretches.append((setup, []))
+            stretches[-1][1].append(run)
+        for ((old, before), (new, after)) in zip(stretches, stretches[1:]):
+            (b, a) = (median([run["eval_tps"] for run in before]), median([run["eval_tps"] for run in after]))
+            if b and (b - a) / b > threshold:
+                change = ", ".join([name + " " + str(o) + " -> " + str(n) for (name, o, n) in zip(["gpu_layers", "context", "backend"], old, new) if o != n])
+                regressions.append({"model" : model, "host" : host, "started" : after[0]["started"], "change" : change, "before" : round(b, 2), "after" : round(a, 2), "drop" : (b - a) / b})
+    return sorted(regressions, key=lambda r: r["started"])
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="llm-layers stats", description="Show how fast models ran, from the timings llama.cpp writes to the per-model logs of the run scripts, launch and serve. Logs are imported into a history database first, so numbers survive log rotation. Runs are grouped by model, gpu_layers, context and host. Throughput drops that came with a change of gpu_layers, context or backend build are flagged.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("models", nargs="*", help="Only show these models.")
+    parser.add_argument("--log_directory", action="append", default=[], help="Folder with backend logs to import. Can be given multiple times. Defaults to " + appdirs.user_log_dir() + ".")
+    parser.add_argument("--history_file", type=str, default=getHistoryFile(), help="The history database.")
+    parser.add_argument("--import", dest="import_logs", action=argparse.BooleanOptionalAction, default=True, help="Import new and grown logs before showing anything.")
+    parser.add_argument("--host", type=str, default=None, help="Only show runs on this host. By default, all hosts whose logs were imported are shown.")
+    parser.add_argument("--trend", type=int, default=12, help="Number of recent runs shown in the trend column.")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Drop in median generation speed, as a fraction, that counts as a regression.")
+    parser.add_argument("--check", action=argparse.BooleanOptionalAction, default=False, help="Exit with code 1 if there are regressions, e.g. for running from cron.")
+    args = parser.parse_args(argv)
+
+    history = History(os.path.expanduser(args.history_file))
+    try:
+        if args.import_logs:
+            for logdir in args.log_directory or [appdirs.user_log_dir()]:
+                logdir = os.path.expanduser(logdir)
+                if not(os.path.isdir(logdir)):
+                    printerr("warning: No log directory " + logdir)
+                    continue
+                n = history.importLogs(logdir)
+                if n:
+                    printerr("Imported " + str(n) + " runs from " + logdir)
+        runs = history.runs(models=args.models, host=args.host)
+    finally:
+        history.close()
+    if runs == []:
+        printerr("No runs recorded yet. Start models with the run scripts, llm-layers launch or llm-layers serve, and their logs get picked up from the log directory.")
+        return
+
+    from tabulate import tabulate
+    print(tabulate(summarize(runs, trend=args.trend), headers="keys"))
+    regressions = findRegressions(runs, threshold=args.threshold)
+    for r in regressions:
+        printerr("warning: " + r["model"] + " on " + r["host"] + " generates " + str(round(r["drop"] * 100)) + "% slower since " + time.strftime("%Y-%m-%d %H:%M", time.localtime(r["started"])) + ", " + str(r["before"]) + " -> " + str(r["after"]) + " t/s after " + (r["change"] or "no change of setup"))
+    if regressions != [] and args.check:
+        sys.exit(1)
@@ -0,0 +1,328 @@
+import os, sys, re, time, shlex, socket, signal, argparse, subprocess, urllib.request, urllib.error
+from llm_layers.layers import getLayersFile, LayersFile, printerr, get_devices
+from llm_layers.scan import scanModels
+from llm_layers.fit import modelEstimate, splitNeeded, ALL_LAYERS, context_step
+from llm_layers.memory import memoryArguments, memoryStrategy, systemMemoryMb, lockLimitMb, prefetchForBackend
+from llm_layers.history import rotateLog, argvHeader, checkLogArguments
+
+# lines in the backend's output that mean it is up. Checked when there is no health endpoint to ask.
+ready_patterns = re.compile(r"server is listening|HTTP server listening|all slots are idle|model loaded", re.IGNORECASE)
+# lines that mean it won't be
+failure_patterns = re.compile(r"out of memory|CUDA error|cudaMalloc failed|failed to allocate|failed to load model|error loading model|unable to load model|segmentation fault", re.IGNORECASE)
+
+default_host = "127.0.0.1"
+# llama.cpp's server default
+default_port = 8080
+
+def freePort():
+    """Returns a port on default_host that nothing listens on right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((default_host, 0))
+        return s.getsockname()[1]
+
+def logFiles(logdir, name):
+    """Returns the pair of files the backend for the model name writes its standard output and standard error to."""
+    return (os.path.join(logdir, name + ".1.log"), os.path.join(logdir, name + ".2.log"))
+
+def backendCommand(executable, model, gpu_layers, context, mmproj="", additional_arguments="", host=None, port=None, extra=[], tensor_split="", main_gpu="", memory=""):
+    """Returns the argument list to start executable on model, with the same parameters the run scripts pass. memory is one of llm_layers.memory.memory_strategies and replaces the memory options in additional_arguments."""
+    argv = [executable, "-c", str(context), "-m", model, "-ngl", str(gpu_layers)]
+    if tensor_split:
+        argv += ["--tensor-split", tensor_split, "--main-gpu", str(main_gpu or 0)]
+    if mmproj:
+        argv += ["--mmproj", mmproj]
+    argv += memoryArguments(shlex.split(additional_arguments), memory)
+    if host is not None:
+        argv += ["--host", host]
+    if port is not None:
+        argv += ["--port", str(port)]
+    return argv + list(extra)
+
+class Backend(object):
+    """A backend process serving one model. start() spawns it with its output going to per-model log files, and waitReady() blocks until it is ready to take requests, has failed, or timed out.
+    Logs of earlier runs are rotated, and the standard error log starts with a line recording the model, gpu_layers and context, which llm-layers stats reads along with the backend's timings.
+    Readiness is decided by the health endpoint at http://host:port/health if health is True, otherwise by the backend's output, see ready_patterns. Failure is the process exiting, or its output matching failure_patterns, which catches e.g. cuda running out of memory while the process is still winding down."""
+    def __init__(self, name, argv, logdir, host=default_host, port=default_port, health=True, env=None):
+        self.name = name
+        self.argv = argv
+        self.logdir = logdir
+        self.host = host
+        self.port = port
+        self.health = health
+        self.env = env
+        self.process = None
+        self.started = None
+        self.time_to_ready = None
+        self.reason = ""
+        self.logs = logFiles(logdir, name)
+        self.offsets = [0, 0]
+        self.partial = ["", ""]
+
+    def start(self):
+        if not(os.path.isdir(self.logdir)):
+            os.makedirs(self.logdir)
+        for log in self.logs:
+            rotateLog(log)
+        with open(self.logs[1], "w") as f:
+            f.write(argvHeader(self.argv))
+        stdout = open(self.logs[0], "wb")
+        stderr = open(self.logs[1], "ab")
+        self.started = time.monotonic()
+        # own session, so the backend survives us in --wait mode and we can signal its whole process group
+        self.process = subprocess.Popen(self.argv, stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr, start_new_session=True, env=self.env)
+        stdout.close()
+        stderr.close()
+        return self
+
+    def _newLines(self):
+        """Returns complete lines the backend wrote since the last call."""
+        lines = []
+        for i in range(0, 2):
+            try:
+                with open(self.logs[i], "rb") as f:
+                    f.seek(self.offsets[i])
+                    data = f.read()
+            except OSError:
+                continue
+            self.offsets[i] += len(data)
+            ws = (self.partial[i] + data.decode("utf-8", errors="replace")).split("\n")
+            self.partial[i] = ws[-1]
+            lines += ws[:-1]
+        return lines
+
+    def _note(self, line):
+        """Appends line to the standard error log, which the backend opened for appending as well."""
+        try:
+            with open(self.logs[1], "a") as f:
+                f.write(line + "\n")
+        except OSError:
+            pass
+
+    def _healthy(self):
+        try:
+            with urllib.request.urlopen("http://" + self.host + ":" + str(self.port) + "/health", timeout=1) as response:
+                return response.status == 200
+        except (urllib.error.URLError, OSError, ValueError):
+            return False
+
+    def _exited(self):
+        code = self.process.poll()
+        if code is not None:
+            self.reason = "exited with code " + str(code)
+        return code is not None
+
+    def poll(self):
+        """Returns 'ready', 'failed' or None if the backend is still loading."""
+        for line in self._newLines():
+            if failure_patterns.search(line):
+                self.reason = line.strip()
+                return "failed"
+            if not(self.health) and ready_patterns.search(line):
+                return "ready"
+        if self._exited():
+            return "failed"
+        if self.health and self._healthy():
+            # whatever answered, the backend must still be running for it to have been the backend
+            return "failed" if self._exited() else "ready"
+        return None
+
+    def waitReady(self, timeout=600, interval=0.25):
+        """Blocks until the backend is ready. Returns 'ready', 'failed' or 'timeout'. On success, time_to_ready holds the seconds it took, on failure, reason says why."""
+        deadline = self.started + timeout
+        while True:
+            status = self.poll()
+            if status == "ready":
+                self.time_to_ready = time.monotonic() - self.started
+                self._note("# llm-layers ready load_s=" + str(round(self.time_to_ready, 2)))
+                return status
+            if status == "failed":
+                return status
+            if time.monotonic() > deadline:
+                self.reason = "not ready after " + str(timeout) + "s"
+                return "timeout"
+            time.sleep(interval)
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self, timeout=10):
+        """Terminates the backend, killing it if it doesn't exit within timeout seconds."""
+        if not(self.alive()):
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            pass
+
+def splitShares(tensor_split, free_mb):
+    """Returns the proportions in which llama.cpp splits the blocks over devices with free_mb free vram each: tensor_split, comma or slash separated, if it has one value per device, otherwise in proportion to free vram, which is what llama.cpp does without --tensor-split."""
+    try:
+        shares = [float(x) for x in re.split("[,/]", str(tensor_split))]
+    except ValueError:
+        shares = []
+    if len(shares) != len(free_mb) or sum(shares) <= 0:
+        shares = [max(mb, 0) for mb in free_mb]
+    if sum(shares) <= 0:
+        shares = [1] * len(free_mb)
+    return shares
+
+def adaptToFreeVram(model, gpu_layers, context, free_mb, margin_mb=500, prefer="layers", min_context=512, tensor_split="", main_gpu=""):
+    """Scales gpu_layers or context down so the model fits into free_mb of currently free vram, keeping margin_mb spare. model is a scanned model dictionary (see llm_layers.scan.scanModels). free_mb is a number or a list with the free vram of each device, in which case each device's share of the model (see splitShares) has to fit into that device's free vram, keeping margin_mb spare on each. main_gpu is the device holding the scratch buffers, the first by default. With prefer='layers', layers are given up first, with prefer='context', the context is shrunk down to min_context before giving up layers.
+    Returns a tuple (gpu_layers, context, reason) where reason is a human readable explanation, empty if nothing changed."""
+    estimate = modelEstimate(model["facts"], size=os.path.getsize(model["file"]) if model["facts"] is None else None)
+    free_mb = free_mb if isinstance(free_mb, list) else [free_mb]
+    budgets = [(mb - margin_mb) * 10**6 for mb in free_mb]
+    shares = splitShares(tensor_split, free_mb)
+    main = int(main_gpu) if str(main_gpu).isdigit() and int(main_gpu) < len(free_mb) else 0
+    def fits(layers, context):
+        return all([n <= b for (n, b) in zip(splitNeeded(estimate, layers, context, shares, main), budgets)])
+    layers = min(int(gpu_layers), estimate["block_count"] + 1)
+    context = int(context)
+    needed = splitNeeded(estimate, layers, context, shares, main)
+    if fits(layers, context):
+        return (gpu_layers, context, "")
+    into = " to fit " + "+".join([str(round(n / 1e6)) for n in needed]) + "MB into " + "+".join([str(mb - margin_mb) for mb in free_mb]) + "MB"
+
+    if prefer == "context":
+        lo = 0
+        hi = context // context_step
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if fits(layers, mid * context_step):
+                lo = mid
+            else:
+                hi = mid - 1
+        smaller = lo * context_step
+        if smaller >= min_context:
+            return (gpu_layers, smaller, "context " + str(context) + " -> " + str(smaller) + into)
+        context = min_context
+    fitted = 0
+    while fitted <= estimate["block_count"] and fits(fitted + 1, context):
+        fitted += 1
+    new_layers = ALL_LAYERS if fitted > estimate["block_count"] else fitted
+    return (new_layers, context, "gpu_layers " + str(gpu_layers) + " -> " + str(new_layers) + " at context " + str(context) + into)
+
+def freeVramMb(probe=None):
+    """Returns a list with the free vram of each device in MB, or None if there are no GPUs. probe is a function returning a device list like llm_layers.layers.get_devices does, which is the default."""
+    devices = probe() if probe is not None else get_devices()
+    if devices == []:
+        return None
+    return [d["free_mb"] for d in devices]
+
+def findModel(name, layers_file, model_directory):
+    """Returns a pair (model, row) for the model called name, where model is the scanned model dictionary (see llm_layers.scan.scanModels) and row the layers file row or None. name may also be a path to a gguf file. model is None if the file can't be found."""
+    if os.path.isfile(name):
+        path = os.path.abspath(name)
+        name = os.path.basename(path)
+        models = [m for m in scanModels(os.path.dirname(path)) if m["file"] == path]
+    else:
+        models = [m for m in scanModels(model_directory) if m["name"] == name]
+    row = None
+    if os.path.isfile(layers_file):
+        row = LayersFile.read(layers_file).get(name)
+    return (models[0] if models != [] else None, row)
+
+def settingOrDefault(row, key, env, default):
+    """Resolves a setting the way the run scripts do: layers file first, then environment variable, then default."""
+    if row is not None and row.get(key, ""):
+        return row[key]
+    if os.environ.get(env, ""):
+        return os.environ[env]
+    return default
+
+def addBackendArguments(parser):
+    """Adds the arguments describing how to start a backend, shared by all subcommands that launch models."""
+    from llm_layers.generate import default_additional_arguments
+    import appdirs
+    parser.add_argument("-f", "--layers_file", type=str, default=os.environ.get("LLM_LAYERS_FILE", getLayersFile()), help="Layers file to read gpu_layers and context from.")
+    parser.add_argument("--model_directory", type=str, default="~/.cache/huggingface", help="Directory with the gguf files.")
+    parser.add_argument("-x", "--executable", type=str, default=os.environ.get("LLM_SERVER", "server"), help="Backend executable, e.g. the llama.cpp server. Defaults to LLM_SERVER.")
+    parser.add_argument("--additional_arguments", type=str, default=default_additional_arguments, help="Additional arguments passed to the executable.")
+    parser.add_argument("--log_directory", type=str, default=appdirs.user_log_dir(), help="Folder for the per-model log files MODEL.1.log and MODEL.2.log. Logs of earlier runs are kept as MODEL.1.log.1 and so on. See llm-layers stats.")
+
+def splitExtra(argv):
+    """Splits argv at the first --, returning the arguments before and after it."""
+    if "--" in argv:
+        i = argv.index("--")
+        return (argv[:i], argv[i+1:])
+    return (argv, [])
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="llm-layers launch", description="Start the backend for a model from the layers file, wait until it is ready to serve, and report how long that took. Fails early on crashes and out of memory errors.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("model", help="Name of the model in the layers file, or path to a gguf file.")
+    addBackendArguments(parser)
+    parser.add_argument("--host", type=str, default=default_host, help="Host for the backend to listen on.")
+    parser.add_argument("--port", type=int, default=None, help="Port for the backend to listen on, and to poll the health endpoint on. By default a free one is picked, so another server that is already listening can't answer for the backend.")
+    parser.add_argument("--health", action=argparse.BooleanOptionalAction, default=True, help="Poll the backend's /health endpoint to decide readiness. With --no-health, readiness is read from the backend's output, which works for backends without an http server.")
+    parser.add_argument("--adapt", type=str, choices=["off", "layers", "context"], default="off", help="Check free vram right before starting and scale down to fit. 'layers' offloads fewer layers, 'context' shrinks the context first and only then gives up layers.")
+    parser.add_argument("--margin", type=str, default="500mb", help="Vram to keep free when adapting with --adapt.")
+    parser.add_argument("--memory", type=str, choices=["layers_file", "auto"], default="layers_file", help="How the backend holds the model in system memory. 'layers_file' uses the memory column, 'auto' decides right now from available ram, which accounts for models that are already running.")
+    parser.add_argument("--prefetch", action=argparse.BooleanOptionalAction, default=None, help="Read the model file into the page cache with several threads while the backend starts, which then loads faster. By default, this only happens if the model fits into available memory and the backend maps it, i.e. not with --no-mmap or --mlock.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the backend to become ready.")
+    parser.add_argument("--wait", action=argparse.BooleanOptionalAction, default=False, help="Return as soon as the backend is ready and leave it running in the background. The exit code tells whether it came up. Without this, llm-layers stays in the foreground until the backend exits.")
+    parser.epilog = "Arguments after -- are passed on to the backend."
+    (argv, extra) = splitExtra(argv)
+    args = parser.parse_args(argv)
+    checkLogArguments(args.additional_arguments)
+
+    (model, row) = findModel(args.model, os.path.expanduser(args.layers_file), os.path.expanduser(args.model_directory))
+    if model is None:
+        printerr("error: Could not find a gguf file for " + args.model + " in " + args.model_directory)
+        sys.exit(1)
+    gpu_layers = settingOrDefault(row, "gpu_layers", "LLM_LAYERS", 1)
+    context = settingOrDefault(row, "context", "LLM_MAX_CONTEXT_LENGTH", 2048)
+    if args.adapt != "off":
+        from llm_layers.generate import megabyteIntFromVRamString
+        try:
+            margin = megabyteIntFromVRamString(args.margin)
+        except ValueError as e:
+            printerr("error: " + str(e))
+            sys.exit(1)
+        free = freeVramMb()
+        if free is None:
+            printerr("warning: No GPU found, not adapting to free vram.")
+        else:
+            (gpu_layers, context, reason) = adaptToFreeVram(model, gpu_layers, context, free, margin_mb=margin, prefer=args.adapt, tensor_split=row.get("tensor_split", "") if row else "", main_gpu=row.get("main_gpu", "") if row else "")
+            printerr("Adapting to " + "+".join([str(mb) for mb in free]) + "MB free vram: " + (reason if reason else "no change needed"))
+    memory = row.get("memory", "") if row else ""
+    if args.memory == "auto" and model["facts"] is not None:
+        memory = memoryStrategy(round(model["facts"]["size"] / 1e6), gpu_layers, model["facts"]["block_count"], systemMemoryMb()[1], lock_limit_mb=lockLimitMb())
+        printerr("Memory strategy for " + model["name"] + ": " + memory)
+    port = args.port if args.port is not None else freePort()
+    cmd = backendCommand(os.path.expanduser(args.executable), model["file"], gpu_layers, context, mmproj=model["mmproj"], additional_arguments=args.additional_arguments, host=args.host, port=port, extra=extra, tensor_split=row.get("tensor_split", "") if row else "", main_gpu=row.get("main_gpu", "") if row else "", memory=memory)
+    backend = Backend(model["name"], cmd, os.path.expanduser(args.log_directory), host=args.host, port=port, health=args.health)
+    prefetchForBackend(model["shards"], cmd, force=args.prefetch, report=printerr)
+    sys.exit(supervise(backend, timeout=args.timeout, wait=args.wait))
+
+def supervise(backend, timeout=600, wait=False):
+    """Starts backend and reports on it. Returns an exit code: 0 if it became ready (and, unless wait is True, exited cleanly afterwards), 1 otherwise."""
+    printerr("Starting " + backend.name + ": " + " ".join([shlex.quote(w) for w in backend.argv]))
+    printerr("Logging to " + backend.logs[0] + " and " + backend.logs[1])
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+    signal.signal(signal.SIGTERM, interrupt)
+    try:
+        backend.start()
+    except OSError as e:
+        printerr("error: Could not start " + backend.argv[0] + ": " + str(e))
+        return 1
+    try:
+        status = backend.waitReady(timeout=timeout)
+        if status != "ready":
+            printerr("error: " + backend.name + " " + status + ": " + backend.reason)
+            backend.stop()
+            return 1
+        print(backend.name + " ready in " + str(round(backend.time_to_ready, 2)) + "s on http://" + backend.host + ":" + str(backend.port) + " (pid " + str(backend.process.pid) + ")")
+        sys.stdout.flush()
+        if wait:
+            return 0
+        code = backend.process.wait()
+        printerr(backend.name + " exited with code " + str(code))
+        return 0 if code == 0 else 1
+    except KeyboardInterrupt:
+        backend.stop()
+        return 1
@@ -1,9 +1,10 @@
-import os, appdirs, sys, traceback, csv, torch
-from tabulate import tabulate
-from huggingface_hub import list_models, get_paths_info, repo_info, snapshot_download, list_files_info
-from huggingface_hub.utils._errors import GatedRepoError
-from requests import HTTPError
+import os, appdirs, sys, traceback, csv, threading, subprocess, glob, tempfile
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed
 from functools import *
+# torch, tabulate and huggingface_hub are slow to import, so they are imported where they are used.
+from llm_layers.cache import getResolutionCache
+from llm_layers.profile import phase, count, getProfiler
+from llm_layers.gguf import fact_fields, shardNames
 
 def printerr(w):
     print(w, file=sys.stderr)
@@ -14,16 +15,161 @@ def getLayersFile():
 
 def loadLayersFile(file=getLayersFile()):
     """Returns a list of dictionaries, one for each row in the layers file."""
-    f = open(file, "r")
-    return list(csv.DictReader(filter(lambda row: row[0] != "#", f), delimiter="\t"))
+    return list(LayersFile.read(file))
+
+# columns every layers file has, in this order. The run scripts read gpu_layers and context by position, so new columns go at the end.
+layers_fields = "name gpu_layers context prompt_format type".split(" ") + fact_fields
+
+class LayersFile(object):
+    """The rows of a layers file, indexed by model name.
+    Rows are stored as lists of values aligned with fields, in insertion order. Columns can be added by merging rows that have them, and are kept when writing, after the standard layers_fields.
+    When rows are merged, a name that is already present is decided by where the rows come from, see precedence: the higher source wins, and between equal sources the later row wins. The winner's empty cells are filled in from the loser, so facts gathered from the filesystem survive being overridden by settings from a layers file."""
+    precedence = {"filesystem" : 0, "loadout" : 1, "include" : 2, "layersfile" : 3}
+
+    def __init__(self, fields=layers_fields):
+        self.fields = list(fields)
+        self.columns = {field : i for (i, field) in enumerate(self.fields)}
+        self.index = {}
+        self.rows = []
+        self.sources = []
+
+    @classmethod
+    def read(cls, file, source="layersfile"):
+        """Reads a layers file, streaming it line by line. Lines starting with # are comments."""
+        lf = cls()
+        with open(file, "r") as f:
+            reader = csv.reader(filter(lambda line: line[0] != "#", f), delimiter="\t")
+            header = next(reader, None)
+            if header is None:
+                return lf
+            for field in header:
+                lf._addField(field)
+            positions = [lf.columns[field] for field in header]
+            for values in reader:
+                if values == []:
+                    continue
+                row = [""] * len(lf.fields)
+                for (i, value) in zip(positions, values):
+                    row[i] = value
+                lf._put(row, lf.precedence[source])
+        return lf
+
+    def _addField(self, field):
+        if field not in self.columns:
+            self.columns[field] = len(self.fields)
+            self.fields.append(field)
+
+    def _put(self, row, rank):
+        name = row[0]
+        i = self.index.get(name, None)
+        if i is None:
+            self.index[name] = len(self.rows)
+            self.rows.append(row)
+            self.sources.append(rank)
+            return
+        old = self.rows[i]
+        if rank < self.sources[i]:
+            (row, old) = (old, row)
+            rank = self.sources[i]
+        for j in range(0, len(old)):
+            if j >= len(row):
+                row.append(old[j])
+            elif row[j] == "" and old[j] != "":
+                row[j] = old[j]
+        self.rows[i] = row
+        self.sources[i] = rank
+
+    def merge(self, models, source):
+        """Adds models, an iterable of dictionaries with at least a name key, coming from source. Keys that aren't columns yet become new columns, except for file, mmproj and facts, which describe files on disk rather than settings. Returns self."""
+        rank = self.precedence[source]
+        for model in models:
+            row = [""] * len(self.fields)
+            for (key, value) in model.items():
+                if key in ignored_keys:
+                    continue
+                if key not in self.columns:
+                    self._addField(key)
+                    row.append("")
+                row[self.columns[key]] = "" if value is None else str(value)
+            self._put(row, rank)
+        return self
+
+    def mergeFile(self, other):
+        """Adds all rows of another LayersFile, keeping the source each row had there. Returns self."""
+        for field in other.fields:
+            self._addField(field)
+        positions = [self.columns[field] for field in other.fields]
+        for (values, rank) in zip(other.rows, other.sources):
+            row = [""] * len(self.fields)
+            for (i, value) in zip(positions, values):
+                row[i] = value
+            self._put(row, rank)
+        return self
+
+    def get(self, name):
+        """Returns the row for name as a dictionary, or None."""
+        i = self.index.get(name, None)
+        if i is None:
+            return None
+        return self._dict(self.rows[i])
+
+    def set(self, name, key, value):
+        """Sets a single cell. The row must exist, the column is created if necessary."""
+        self._addField(key)
+        row = self.rows[self.index[name]]
+        while len(row) < len(self.fields):
+            row.append("")
+        row[self.columns[key]] = str(value)
+
+    def _dict(self, row):
+        return {field : (row[i] if i < len(row) else "") for (i, field) in enumerate(self.fields)}
+
+    def __iter__(self):
+        for row in self.rows:
+            yield self._dict(row)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __len__(self):
+        return len(self.rows)
+
+    def names(self):
+        return list(self.index.keys())
+
+    def write(self, file, header="", sort=True):
+        """Writes the rows to file, sorted by name unless sort is False, preceded by header, which should consist of # comment lines. The file is replaced atomically. Raises on error."""
+        fields = layers_fields + [field for field in self.fields if field not in layers_fields]
+        positions = [self.columns.get(field, None) for field in fields]
+        rows = self.rows
+        if sort:
+            rows = sorted(rows, key=lambda row: row[0])
+        dir = os.path.dirname(os.path.abspath(file))
+        fd, tmp = tempfile.mkstemp(dir=dir, prefix="." + os.path.basename(file) + ".")
+        try:
+            with os.fdopen(fd, "w", newline="") as f:
+                f.write(header)
+                writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+                writer.writerow(fields)
+                for row in rows:
+                    writer.writerow([row[i] if i is not None and i < len(row) else "" for i in positions])
+            os.replace(tmp, file)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+# model keys that never go into a layers file
+ignored_keys = ["file", "mmproj", "facts", "shards"]
 
 
 def show(file=getLayersFile()):
+    from tabulate import tabulate
     try:
         ds = loadLayersFile(file)
     except:
         printerr(traceback.format_exc())
-        printerr("error: Couldn't load the layers file " + file, file=sys.stderr)
+        printerr("error: Couldn't load the layers file " + file)
         return ""
     return tabulate(ds, headers="keys")
 
@@ -43,8 +189,15 @@ def splitIntercalateFilename(filename, splits):
 
     return reduce(lambda xs, ys: xs+ys, map(lambda w: splitIntercalateFilename(w, splits[1:]), ws), [])
 
-def reposFromFile(filename, exhaustive=False):
-    """Given a filename (e.g. a gguf file), returns a list of huggingface repository ids with that file in it. The list may be empty."""
+def reposFromFile(filename, exhaustive=False, info=None):
+    """Given a filename (e.g. a gguf file), returns a list of huggingface repository ids with that file in it. The list may be empty.
+    If info is a dictionary, it is filled with the file size per repository under "sizes" and a list of gated repositories under "gated"."""
+    from huggingface_hub import list_models, get_paths_info
+    from huggingface_hub.utils import GatedRepoError
+    from requests import HTTPError
+    if info is not None:
+        info.setdefault("sizes", {})
+        info.setdefault("gated", [])
     # hf will not allow search in repos directly, so we first have to find the repo with some trickery and guesswork
     # of course, we don't know filename, it might be totally ok as is
     ws = splitIntercalateFilename(filename, [".", "-"])
@@ -77,19 +230,30 @@ def reposFromFile(filename, exhaustive=False):
                 # want exact match here
                 if fileinfo.path == filename:
                     winners.append(modelinfo)
+                    if info is not None:
+                        info["sizes"][modelinfo] = fileinfo.size
 
         except GatedRepoError:
+            if info is not None:
+                info["gated"].append(modelinfo)
             continue
         except HTTPError:
             printerr("http error for " + modelinfo)
             continue
 
         if winners == [] and not(exhaustive):
-            return reposFromFile(filename, exhaustive=True)
+            return reposFromFile(filename, exhaustive=True, info=info)
     return winners
             
 def pickWinner(winners, filename):
     """Given a list of repo ids and a file they contain, pick the best one to acquire later"""
+    return pickWinnerScored(winners, filename)[0]
+
+def pickWinnerScored(winners, filename):
+    """Like pickWinner, but returns a pair of (repo_id, score). TheBloke always wins with a score of infinity."""
+    from huggingface_hub import repo_info
+    from huggingface_hub.utils import GatedRepoError
+    from requests import HTTPError
     # This is a very simple algorithm, it's either theBloke or whoever has more downloads+likes
     # hf has the brilliant strategy of throwing an exception when querying a gated repo, so no list comprehension here.
     repo_data = []
@@ -108,7 +272,7 @@ def pickWinner(winners, filename):
     for (repo_id, repo) in repo_data:
         if repo.author == "TheBloke":
             # clear winner, return early
-            return repo_id
+            return (repo_id, float("inf"))
 
         score = repo.downloads + repo.likes
         if winner["score"] < score:
@@ -116,48 +280,333 @@ def pickWinner(winners, filename):
             winner["name"] = repo_id
             winner["score"] = score
 
-    return winner["name"]
+    return (winner["name"], winner["score"])
 
     
     
 
-def get_hf_repo_for_file(filename):
-    """Given the name of a file in some huggingface repository, returns the repository id of a repository containing that file. If multiple repositories contain the file, the result is determined by ranking the candidate repositories according to various factors. If theBloke is among candidates, the result is always theBloke. Returns empty string if no repository contains the file."""
-    return pickWinner(reposFromFile(filename), filename)
+class RepoUnavailable(Exception):
+    """Raised by hub clients when a repository can't be inspected. reason is e.g. 'gated' or 'error'."""
+    def __init__(self, repo_id, reason="error"):
+        super().__init__(repo_id + ": " + reason)
+        self.repo_id = repo_id
+        self.reason = reason
+
+class HubClient(object):
+    """The two huggingface api calls the resolver needs, with results as plain dictionaries. Anything with the same methods can stand in for it, e.g. a local fake hub for testing. calls counts the requests made."""
+    def __init__(self):
+        self.calls = 0
+
+    def search(self, query):
+        """Returns a list of dictionaries with keys id, author, downloads and likes for models matching query."""
+        from huggingface_hub import list_models
+        self.calls += 1
+        count("http calls")
+        results = []
+        for m in list_models(search=query):
+            author = getattr(m, "author", None) or m.id.split("/")[0]
+            results.append({"id" : m.id, "author" : author, "downloads" : getattr(m, "downloads", 0) or 0, "likes" : getattr(m, "likes", 0) or 0})
+        return results
+
+    def _repoRequest(self, repo_id, f, *args):
+        """Returns f(*args), a request about repo_id. Raises RepoUnavailable for gated or broken repositories."""
+        from huggingface_hub.utils import GatedRepoError
+        from requests import RequestException
+        self.calls += 1
+        count("http calls")
+        try:
+            return f(*args)
+        except GatedRepoError:
+            raise RepoUnavailable(repo_id, "gated")
+        except (RequestException, OSError):
+            # http errors, but also connection errors and timeouts, which shouldn't take down a whole download run
+            raise RepoUnavailable(repo_id, "error")
+
+    def paths_info(self, repo_id, paths):
+        """Returns a list of dictionaries with keys path, size and sha256 for the paths that exist in repo_id. Raises RepoUnavailable for gated or broken repositories."""
+        from huggingface_hub import get_paths_info
+        infos = self._repoRequest(repo_id, get_paths_info, repo_id, paths)
+        results = []
+        for info in infos:
+            lfs = getattr(info, "lfs", None)
+            results.append({"path" : info.path, "size" : getattr(info, "size", None), "sha256" : lfs.sha256 if lfs is not None else None})
+        return results
+
+    def list_files(self, repo_id):
+        """Returns a list of dictionaries with keys path, size and sha256 for all files at the top of repo_id. Raises RepoUnavailable like paths_info."""
+        from huggingface_hub import list_repo_tree
+        infos = self._repoRequest(repo_id, lambda: list(list_repo_tree(repo_id)))
+        results = []
+        for info in infos:
+            if not(hasattr(info, "size")):
+                # a folder
+                continue
+            lfs = getattr(info, "lfs", None)
+            results.append({"path" : info.path, "size" : info.size, "sha256" : lfs.sha256 if lfs is not None else None})
+        return results
+
+class RepoResolver(object):
+    """Resolves many filenames to huggingface repositories at once.
+    Filenames are resolved concurrently on a bounded thread pool. Identical requests are only ever sent once per resolver, no matter how many filenames need them, which matters since many quants of a model share their search prefixes. Repositories are ranked with the metadata that comes with the search results, instead of asking for repo_info again. Results go into the resolution cache.
+    The search itself follows reposFromFile: incrementally longer prefixes of the filename are searched until nothing is found, and the repositories of the most specific search are checked for the file. Only if none of them has it, all repositories that turned up along the way are checked."""
+    def __init__(self, hub=None, cache=None, max_workers=8, offline=False):
+        self.hub = hub if hub is not None else HubClient()
+        self.cache = cache if cache is not None else getResolutionCache()
+        self.max_workers = max_workers
+        self.offline = offline
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def _once(self, key, f, *args):
+        """Calls f(*args) and remembers the result under key. Concurrent callers with the same key wait for the first one instead of sending their own request. Exceptions are passed on to the callers waiting at the time, but not remembered, so a later call asks again."""
+        with self.lock:
+            future = self.requests.get(key, None)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.requests[key] = future
+        if owner:
+            try:
+                future.set_result(f(*args))
+            except Exception as e:
+                with self.lock:
+                    del self.requests[key]
+                future.set_exception(e)
+        return future.result()
+
+    def search(self, query):
+        return self._once(("search", query), self.hub.search, query)
+
+    def paths_info(self, repo_id, filename):
+        """Asks for filename and, if it's the first shard of a split model, all of its other shards, in one request."""
+        return self._once(("paths_info", repo_id, filename), self.hub.paths_info, repo_id, shardNames(filename))
+
+    def _check(self, pool, repo_ids, filename, found, gated, failed):
+        """Checks repo_ids concurrently for an exact match of filename, adding hits to found, gated repositories to gated and repositories that couldn't be asked to failed."""
+        futures = [(repo_id, pool.submit(self.paths_info, repo_id, filename)) for repo_id in repo_ids]
+        for (repo_id, future) in futures:
+            try:
+                infos = future.result()
+            except RepoUnavailable as e:
+                if e.reason == "gated":
+                    gated.append(repo_id)
+                else:
+                    printerr("http error for " + repo_id)
+                    failed.append(repo_id)
+                continue
+            shards = {info["path"] : info for info in infos}
+            names = shardNames(filename)
+            # a split model only counts if the repository has all of it
+            if [name for name in names if name not in shards] != []:
+                continue
+            sizes = [shards[name]["size"] for name in names]
+            found[repo_id] = {"path" : filename,
+                              "size" : sum(sizes) if None not in sizes else None,
+                              "sha256" : shards[filename]["sha256"],
+                              "shards" : {name : {"size" : shards[name]["size"], "sha256" : shards[name]["sha256"]} for name in names} if len(names) > 1 else None}
+
+    def _resolve(self, pool, filename):
+        with phase("resolve"):
+            return self._resolveUntimed(pool, filename)
+
+    def _resolveUntimed(self, pool, filename):
+        entry = self.cache.lookup(filename, offline=self.offline)
+        if entry is not None or self.offline:
+            return entry
+
+        metadata = {}
+        best = []
+        try:
+            query = ""
+            for w in splitIntercalateFilename(filename, [".", "-"]):
+                query += w
+                xs = self.search(query)
+                if xs == []:
+                    # a longer string won't get any more results
+                    break
+                for x in xs:
+                    metadata[x["id"]] = x
+                if best == [] or len(xs) < len(best):
+                    best = [x["id"] for x in xs]
+        except OSError:
+            # covers HTTPError and connection errors. We don't cache this, the hub might just be unreachable right now
+            printerr("error: Could not search huggingface for " + filename)
+            return {"repo" : "", "reason" : "unreachable", "candidates" : [], "score" : 0, "size" : None, "sha256" : None}
+
+        found = {}
+        gated = []
+        failed = []
+        self._check(pool, best, filename, found, gated, failed)
+        if found == {}:
+            # exhaustive pass over everything the searches turned up
+            self._check(pool, [repo_id for repo_id in metadata.keys() if repo_id not in best], filename, found, gated, failed)
+
+        if found == {} and failed != []:
+            # a repository we couldn't ask might have it. Like a failed search, this isn't cached, the hub might just be unreachable right now
+            printerr("error: Could not check " + str(len(failed)) + " repositories for " + filename)
+            return {"repo" : "", "reason" : "unreachable", "candidates" : [], "score" : 0, "size" : None, "sha256" : None}
+        if found == {}:
+            self.cache.storeNegative(filename, "gated" if gated != [] else "missing", candidates=gated)
+        else:
+            (repo, score) = rankRepos([metadata[repo_id] for repo_id in found.keys()])
+            self.cache.store(filename, repo, candidates=found.keys(), score=score, size=found[repo]["size"], sha256=found[repo]["sha256"], shards=found[repo]["shards"])
+        return self.cache.lookup(filename)
+
+    def resolve(self, filename):
+        return self.resolve_many([filename])[filename]
+
+    def resolve_many(self, filenames):
+        """Returns a dictionary mapping each filename to its resolution cache entry. See resolve_file."""
+        results = dict(self.resolve_iter(filenames))
+        return {filename : results[filename] for filename in filenames}
+
+    def resolve_iter(self, filenames):
+        """Generator yielding pairs of (filename, resolution) in the order the resolutions finish."""
+        # one pool for filenames and one for requests, so filename tasks never wait on work queued behind themselves
+        with ThreadPoolExecutor(self.max_workers) as pool, ThreadPoolExecutor(self.max_workers) as requestPool:
+            futures = {pool.submit(self._resolve, requestPool, filename) : filename for filename in dict.fromkeys(filenames)}
+            for future in as_completed(futures):
+                yield (futures[future], future.result())
+
+def rankRepos(repos):
+    """Takes a list of search results as returned by HubClient.search and returns a pair of (repo_id, score) for the best one. This is the same ranking as pickWinner."""
+    winner = { "name" : "", "score" : -10}
+    for repo in repos:
+        if repo["author"] == "TheBloke":
+            return (repo["id"], float("inf"))
+        score = repo["downloads"] + repo["likes"]
+        if winner["score"] < score:
+            winner["name"] = repo["id"]
+            winner["score"] = score
+    return (winner["name"], winner["score"])
+
+def get_hf_repo_for_file(filename, offline=False, cache=None):
+    """Given the name of a file in some huggingface repository, returns the repository id of a repository containing that file. If multiple repositories contain the file, the result is determined by ranking the candidate repositories according to various factors. If theBloke is among candidates, the result is always theBloke. Returns empty string if no repository contains the file.
+    Results are remembered in the persistent resolution cache. With offline=True, only the cache is consulted and no network requests are made."""
+    entry = resolve_file(filename, offline=offline, cache=cache)
+    if entry is None:
+        return ""
+    return entry["repo"]
+
+def resolve_file(filename, offline=False, cache=None, hub=None):
+    """Resolves filename to a huggingface repository. Returns a dictionary with keys repo, candidates, score, size and sha256, as stored in the resolution cache. repo is the empty string for files that couldn't be found or are only in gated repositories. Returns None in offline mode if the file has never been resolved before."""
+    return RepoResolver(hub=hub, cache=cache, offline=offline).resolve(filename)
+
+def resolve_files(filenames, offline=False, cache=None, hub=None, max_workers=8):
+    """Resolves many filenames concurrently. Returns a dictionary of filename to resolution, see resolve_file."""
+    return RepoResolver(hub=hub, cache=cache, max_workers=max_workers, offline=offline).resolve_many(filenames)
 
 def load_layers_file(file=getLayersFile()):
     """Returns a list of dictionaries, one for each row in the layers file."""
     return loadLayersFile(file)
 
-def download_for_layers_file(filename, exclude=[]):
-    """Takes filename of a layer file and downloads all listed model files using the huggingface api. exclude is a list of filenames which will not be downloaded, even if listed in the layers file."""
+def download_for_layers_file(filename, exclude=[], offline=False, jobs=3, order="priority", local_dir=None):
+    """Takes filename of a layer file and downloads all listed model files using the huggingface api. exclude is a list of filenames which will not be downloaded, even if listed in the layers file.
+    Up to jobs models are transferred at the same time, while the remaining ones are still being resolved. order is either 'priority', which downloads in the order of the layers file, or 'smallest', which downloads small models first. See llm_layers.download.DownloadScheduler.
+    With offline=True, repositories are only looked up in the resolution cache and nothing is downloaded. Models that would have been fetched are listed instead. With local_dir, files are put into that directory instead of the huggingface cache."""
+    from llm_layers.download import DownloadScheduler
     try:
         ds = load_layers_file(filename)
     except FileNotFoundError:
-        printerr("error: File not found " + filename, file=sys.stderr)
+        printerr("error: File not found " + filename)
         return
 
-    for d in ds:
-        if d["name"] in exclude:
-            continue
-        repo = get_hf_repo_for_file(d["name"])
-        if repo:
-            printerr("Getting " + repo + " ...")
-            snapshot_download(repo,
-                              allow_patterns=[d["name"], "*README*", "*readme*", "*LICENSE*", "*license*", "*.txt", "*.md", "*.json", "*mmproj*"])
+    cache = getResolutionCache()
+    getProfiler().cache("resolutions", cache)
+    try:
+        names = [d["name"] for d in ds if d["name"] not in exclude]
+        if offline:
+            resolved = resolve_files(names, offline=True, cache=cache)
+            for name in names:
+                entry = resolved[name]
+                if entry is not None and entry["repo"]:
+                    printerr("Offline: Not getting " + name + " from " + entry["repo"])
+                else:
+                    printerr("Offline: No cached repository for " + name)
+            return
+        DownloadScheduler(jobs=jobs, order=order, resolver=RepoResolver(cache=cache), local_dir=local_dir).run(names)
+    finally:
+        cache.save()
             
                                     
 
-def get_total_vram_mb():
-    has_cuda = torch.cuda.is_available()
-    if not(has_cuda):
-        return 0
-    n = torch.cuda.device_count()
-    vram = 0
-    for i in range(0, n):
-        vram += torch.cuda.get_device_properties(i).total_memory / 1e6
-
-    return round(vram)
-    
+def nvidiaSmiDevices():
+    """Queries nvidia-smi for the memory of all nvidia GPUs. Returns a list of device dictionaries, empty if nvidia-smi isn't available."""
+    try:
+        out = subprocess.run(["nvidia-smi", "--query-gpu=index,name,memory.total,memory.free", "--format=csv,noheader,nounits"], capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    if out.returncode != 0:
+        return []
+    devices = []
+    for line in out.stdout.strip().split("\n"):
+        ws = [w.strip() for w in line.split(",")]
+        if len(ws) != 4:
+            continue
+        try:
+            # nvidia-smi reports MiB
+            devices.append({"index" : int(ws[0]), "name" : ws[1], "total_mb" : round(float(ws[2]) * 1.048576), "free_mb" : round(float(ws[3]) * 1.048576)})
+        except ValueError:
+            continue
+    return devices
 
-            
+def sysfsDevices():
+    """Reads vram of amdgpu devices from /sys/class/drm. Returns a list of device dictionaries, empty if there are none."""
+    devices = []
+    for dir in sorted(glob.glob("/sys/class/drm/card[0-9]*/device")):
+        try:
+            total = int(open(dir + "/mem_info_vram_total").read().strip())
+            used = int(open(dir + "/mem_info_vram_used").read().strip())
+        except (OSError, ValueError):
+            continue
+        devices.append({"index" : len(devices), "name" : os.path.basename(os.path.dirname(dir)), "total_mb" : round(total / 1e6), "free_mb" : round((total - used) / 1e6)})
+    return devices
+
+def torchDevices():
+    """Asks torch about cuda devices. This is slow, because it imports torch, and is only used if nothing else works."""
+    try:
+        import torch
+    except ImportError:
+        return []
+    if not(torch.cuda.is_available()):
+        return []
+    devices = []
+    for i in range(0, torch.cuda.device_count()):
+        props = torch.cuda.get_device_properties(i)
+        (free, total) = torch.cuda.mem_get_info(i)
+        devices.append({"index" : i, "name" : props.name, "total_mb" : round(props.total_memory / 1e6), "free_mb" : round(free / 1e6)})
+    return devices
+
+def environmentDevices():
+    """Reads devices from the LLM_LAYERS_DEVICES environment variable, which looks like 8000/6500,12000/12000 with total/free MB per device. Free may be left out. This is for machines without a GPU, testing, and overriding what the hardware says."""
+    w = os.environ.get("LLM_LAYERS_DEVICES", "").strip()
+    if w == "":
+        return []
+    devices = []
+    for (i, device) in enumerate(w.split(",")):
+        ws = device.split("/")
+        try:
+            total = int(ws[0])
+            free = int(ws[1]) if len(ws) > 1 else total
+        except ValueError:
+            printerr("warning: Ignoring malformed device '" + device + "' in LLM_LAYERS_DEVICES.")
+            continue
+        devices.append({"index" : i, "name" : "env" + str(i), "total_mb" : total, "free_mb" : free})
+    return devices
+
+# tried in order, the first one to find anything wins
+device_probes = [environmentDevices, nvidiaSmiDevices, sysfsDevices, torchDevices]
+
+def get_devices(probes=None):
+    """Returns a list of dictionaries, one per GPU, with keys index, name, total_mb and free_mb. The list is empty on machines without a usable GPU. probes is a list of functions returning such lists, the default being device_probes."""
+    if probes is None:
+        probes = device_probes
+    for probe in probes:
+        devices = probe()
+        if devices != []:
+            return devices
+    return []
+
+def get_total_vram_mb():
+    """Returns the sum of vram across all GPUs in MB."""
+    return round(sum([d["total_mb"] for d in get_devices()]))
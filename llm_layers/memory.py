@@ -0,0 +1,123 @@
+import os, time, resource, threading
+from concurrent.futures import ThreadPoolExecutor
+
+# how a backend should hold the part of a model that stays in system memory
+# mmap: map the file, weights live in the page cache, shared and evictable
+# no-mmap: read the file into private memory
+# mlock: map the file and lock it, so it can't be paged out
+memory_strategies = ["mmap", "no-mmap", "mlock"]
+strategy_arguments = {"mmap" : [], "no-mmap" : ["--no-mmap"], "mlock" : ["--mlock"]}
+# llama.cpp options that the strategies replace
+memory_options = ["--mlock", "--no-mmap", "--mmap"]
+
+# ram left alone for the rest of the system
+headroom_mb = 2000
+prefetch_chunk_bytes = 64 * 2**20
+
+def systemMemoryMb():
+    """Returns a pair (total, available) of system memory in MB. available is what can be used without swapping, page cache included."""
+    values = {}
+    try:
+        for line in open("/proc/meminfo", "r"):
+            ws = line.split()
+            values[ws[0].rstrip(":")] = int(ws[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    if "MemTotal" in values:
+        return (round(values["MemTotal"] / 1e6), round(values.get("MemAvailable", values.get("MemFree", 0)) / 1e6))
+    total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    return (round(total / 1e6), round(total / 1e6))
+
+def lockLimitMb():
+    """Returns how much memory this user may lock in MB, or None if there is no limit."""
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_MEMLOCK)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return round(soft / 1e6)
+
+def hostShareMb(size_mb, gpu_layers, block_count):
+    """Returns the MB of a model that stay in system memory with gpu_layers offloaded."""
+    gpu_layers = int(gpu_layers)
+    if block_count <= 0:
+        return size_mb
+    if gpu_layers > block_count:
+        return 0
+    return round(size_mb * (block_count - gpu_layers) / (block_count + 1))
+
+def memoryStrategy(size_mb, gpu_layers, block_count, available_mb, resident_mb=0, lock_limit_mb=None):
+    """Decides between mmap, no-mmap and mlock for a model of size_mb with gpu_layers of block_count blocks offloaded. available_mb is free system memory, resident_mb what other models that will run at the same time keep in system memory.
+    Fully offloaded models only need the file while loading, so they are mapped and keep the page cache warm for the next start. Models that leave weights on the cpu get them locked if they fit and the lock limit allows, so they can't be paged out while generating. If they fit but can't be locked, they are read into private memory. If they don't fit at all, they are mapped and the kernel has to page."""
+    host = hostShareMb(size_mb, gpu_layers, block_count)
+    if host == 0:
+        return "mmap"
+    if host + resident_mb + headroom_mb > available_mb:
+        return "mmap"
+    if lock_limit_mb is None or host <= lock_limit_mb:
+        return "mlock"
+    return "no-mmap"
+
+def memoryArguments(additional_arguments, strategy):
+    """Returns the list of arguments additional_arguments with its memory options replaced by those for strategy. Unknown or empty strategies leave them alone."""
+    if strategy not in strategy_arguments:
+        return list(additional_arguments)
+    return [w for w in additional_arguments if w not in memory_options] + strategy_arguments[strategy]
+
+def prefetchFile(path, jobs=4, chunk=prefetch_chunk_bytes, wait=True):
+    """Warms the page cache with the file at path, so a backend mapping or reading it right after doesn't wait on the disk. The file is split into chunks that are handled by jobs threads in parallel, which keeps fast disks busy.
+    With wait=True, chunks are advised and then read, and this returns once the whole file is cached. With wait=False, the kernel is only advised to read ahead, which returns right away. Returns the number of bytes covered."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        def warm(offset):
+            length = min(chunk, size - offset)
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+            if wait:
+                done = 0
+                while done < length:
+                    data = os.pread(fd, min(length - done, 8 * 2**20), offset + done)
+                    if not(data):
+                        break
+                    done += len(data)
+        with ThreadPoolExecutor(max(1, jobs)) as pool:
+            list(pool.map(warm, range(0, size, chunk)))
+        return size
+    finally:
+        os.close(fd)
+
+def prefetchModel(files, jobs=4, wait=True, report=None):
+    """Prefetches all files of a model, e.g. the shards of a split model. Returns the number of bytes covered. report, if given, is called with a message when done."""
+    start = time.monotonic()
+    total = sum([prefetchFile(file, jobs=jobs, wait=wait) for file in files])
+    if report is not None:
+        elapsed = time.monotonic() - start
+        report("Prefetched " + str(round(total / 1e6)) + "MB in " + str(round(elapsed, 2)) + "s" + (" (" + str(round(total / 1e6 / elapsed)) + "MB/s)" if wait and elapsed > 0 else ""))
+    return total
+
+def prefetchForBackend(files, argv, force=None, report=None):
+    """Prefetches the files of a model in a background thread, overlapping with the start of a backend run with argv. With force=None, this only happens if it pays off: not when the backend reads the file into private memory (--no-mmap) or locks it (--mlock) anyway, and not when the model doesn't fit into available memory, where it would only push other things out of the page cache. force=True and force=False prefetch always and never. Returns the thread, or None if there's nothing to do."""
+    if force is None:
+        size_mb = sum([os.path.getsize(file) for file in files]) / 1e6
+        force = not(any([w in argv for w in ["--no-mmap", "--mlock"]])) and size_mb + headroom_mb <= systemMemoryMb()[1]
+    if not(force):
+        return None
+    thread = threading.Thread(target=prefetchModel, args=(files,), kwargs={"report" : report}, daemon=True)
+    thread.start()
+    return thread
+
+def main(argv):
+    import argparse
+    from llm_layers.launch import findModel
+    from llm_layers.layers import getLayersFile, printerr
+    parser = argparse.ArgumentParser(prog="llm-layers prefetch", description="Warm the page cache with models that are about to be started, e.g. from a login hook, so their backends load from memory instead of disk.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("models", nargs="+", help="Names of models, or paths to gguf files.")
+    parser.add_argument("--model_directory", type=str, default="~/.cache/huggingface", help="Directory with the gguf files.")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of threads reading in parallel.")
+    parser.add_argument("--wait", action=argparse.BooleanOptionalAction, default=True, help="Read the files and return once they are cached. With --no-wait, the kernel is only advised to read ahead, and this returns right away.")
+    args = parser.parse_args(argv)
+    for name in args.models:
+        (model, row) = findModel(name, getLayersFile(), os.path.expanduser(args.model_directory))
+        if model is None:
+            printerr("error: Could not find a gguf file for " + name + " in " + args.model_directory)
+            continue
+        prefetchModel(model["shards"], jobs=args.jobs, wait=args.wait, report=lambda w: printerr(model["name"] + ": " + w))
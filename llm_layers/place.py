@@ -0,0 +1,295 @@
+import os, sys, argparse, configparser
+from llm_layers.layers import getLayersFile, LayersFile, printerr
+from llm_layers.cache import getResolutionCache, writeFileAtomic
+from llm_layers.fit import modelEstimate, effectiveVramMb
+from llm_layers.plan import planCoresidency, objectives
+from llm_layers.memory import hostShareMb, memoryStrategy, headroom_mb
+
+# an example inventory, also shown by llm-layers place --help
+example_inventory = """[DEFAULT]
+executable = /opt/llama.cpp/llama-server
+
+[node box1]
+vram = 24gb,24gb
+ram = 128gb
+disk = 2tb
+model_directory = /srv/models
+max_models = 4
+
+[node box2]
+vram = 12gb
+ram = 32gb
+disk = 500gb
+model_directory = /srv/models
+
+[model mistral-7b-instruct-v0.2.Q5_K_M.gguf]
+replicas = 2
+context = 8192
+priority = 2
+
+[model Meta-Llama-3-70B-Instruct.Q4_K_M.gguf]
+nodes = box1"""
+
+def sizeMb(w, what):
+    from llm_layers.generate import megabyteIntFromVRamString
+    try:
+        return megabyteIntFromVRamString(w)
+    except ValueError:
+        raise ValueError("Could not read " + what + " '" + w + "'. Give amounts like '24gb' or '500mb'.")
+
+def readInventory(file):
+    """Reads an inventory file, an ini file with a [node NAME] section for every machine and a [model NAME] section for every model that should run somewhere. Settings in [DEFAULT] apply to all sections. Returns a pair (nodes, models) of lists of dictionaries. Raises ValueError on nonsense."""
+    config = configparser.ConfigParser(interpolation=None)
+    with open(file, "r") as f:
+        config.read_file(f)
+    nodes = []
+    models = []
+    for section in config.sections():
+        (kind, _, name) = section.partition(" ")
+        name = name.strip()
+        s = config[section]
+        if kind == "node" and name:
+            if "vram" not in s or "model_directory" not in s:
+                raise ValueError("Node " + name + " needs at least vram and model_directory.")
+            directory = s.get("directory", "") or s["model_directory"].rstrip("/") + "/llm-layers"
+            nodes.append({"name" : name,
+                          "vram" : [sizeMb(w, "vram of " + name) for w in s["vram"].split(",") if w.strip()],
+                          "ram" : sizeMb(s.get("ram", "0gb"), "ram of " + name),
+                          "disk" : sizeMb(s.get("disk", "0gb"), "disk of " + name),
+                          "reserve" : sizeMb(s.get("reserve", "0mb"), "reserve of " + name),
+                          "lock_limit" : sizeMb(s["lock_limit"], "lock_limit of " + name) if s.get("lock_limit", "") else None,
+                          "max_models" : s.getint("max_models", 0),
+                          "model_directory" : s["model_directory"],
+                          "directory" : directory,
+                          "log_directory" : s.get("log_directory", "") or directory + "/log",
+                          "executable" : s.get("executable", ""),
+                          "additional_arguments" : s.get("additional_arguments", None)})
+            for key in ["model_directory", "directory", "log_directory"]:
+                if not(os.path.isabs(nodes[-1][key])):
+                    raise ValueError("The " + key + " of node " + name + " must be an absolute path, since it is used on the node as it is.")
+        elif kind == "model" and name:
+            models.append({"name" : name,
+                           "replicas" : s.getint("replicas", 1),
+                           "context" : s.get("context", ""),
+                           "priority" : s.getfloat("priority", 1.0),
+                           "size_mb" : sizeMb(s["size"], "size of " + name) if s.get("size", "") else None,
+                           "nodes" : [w.strip() for w in s.get("nodes", "").split(",") if w.strip()]})
+        else:
+            raise ValueError("Don't know what section [" + section + "] is. Sections are [node NAME] or [model NAME].")
+    names = [node["name"] for node in nodes]
+    for model in models:
+        unknown = [n for n in model["nodes"] if n not in names]
+        if unknown != []:
+            raise ValueError("Model " + model["name"] + " is pinned to unknown nodes " + ", ".join(unknown))
+    return (nodes, models)
+
+def rowFacts(row, size):
+    """Returns just enough of a facts dictionary for llm_layers.fit.modelEstimate, from the block_count of a layers file row. None if the row doesn't have one."""
+    if row is None or not(row.get("block_count", "")):
+        return None
+    return {"block_count" : int(row["block_count"]), "layer_bytes" : [], "other_bytes" : 0, "size" : size}
+
+def sizeModels(models, rows, files={}, resolutions=None, context=2048):
+    """Fills in size_mb, facts and context of the inventory models, without touching the network. Sizes come from the inventory, then from gguf headers of files present on this machine, then from the size_mb column of the layers file rows, then from the resolution cache. Returns the list of names nobody knows the size of."""
+    if resolutions is None:
+        resolutions = getResolutionCache()
+    unknown = []
+    for model in models:
+        row = rows.get(model["name"])
+        model["facts"] = files[model["name"]]["facts"] if model["name"] in files else None
+        if model["size_mb"] is None and model["facts"] is not None:
+            model["size_mb"] = round(model["facts"]["size"] / 1e6)
+        if model["size_mb"] is None and row is not None and row.get("size_mb", ""):
+            model["size_mb"] = int(row["size_mb"])
+        if model["size_mb"] is None:
+            entry = resolutions.lookup(model["name"], offline=True)
+            if entry is not None and entry["size"]:
+                model["size_mb"] = round(entry["size"] / 1e6)
+        if model["size_mb"] is None:
+            unknown.append(model["name"])
+            continue
+        if model["facts"] is None:
+            model["facts"] = rowFacts(row, model["size_mb"] * 10**6)
+        if not(model["context"]):
+            model["context"] = row["context"] if row is not None and row.get("context", "") else context
+        model["context"] = int(model["context"])
+        model["block_count"] = modelEstimate(model["facts"], size=model["size_mb"] * 10**6)["block_count"]
+    return unknown
+
+def planNode(node, residents, objective="offload"):
+    """Plans gpu_layers and context for the models in residents running together on node. Returns a pair (plan, value), see llm_layers.plan.planCoresidency. value is the weighted objective reached, which is what placement maximizes. Several GPUs are treated as one card of their effective size."""
+    if residents == []:
+        return ({}, 0.0)
+    plan = planCoresidency([{"name" : m["name"], "context" : m["context"], "facts" : m["facts"], "size" : m["size_mb"] * 10**6} for m in residents],
+                           effectiveVramMb(node["vram"]), reserved_mb=node["reserve"], priorities={m["name"] : m["priority"] for m in residents}, objective=objective)
+    value = 0.0
+    for m in residents:
+        total = m["block_count"] + 1
+        value += m["priority"] * objectives[objective](min(plan[m["name"]]["gpu_layers"], total), total)
+    return (plan, value)
+
+def nodeProblem(node, residents, plan):
+    """Returns why the models in residents can't all live on node with plan, or None if they can. Checks the co-residency limit, disk space, and whether what stays in system memory fits into ram."""
+    if node["max_models"] and len(residents) > node["max_models"]:
+        return "holds " + str(node["max_models"]) + " models at most"
+    if node["disk"] and sum([m["size_mb"] for m in residents]) > node["disk"]:
+        return "not enough disk"
+    host = sum([hostShareMb(m["size_mb"], plan[m["name"]]["gpu_layers"], m["block_count"]) for m in residents])
+    if node["ram"] and host > node["ram"] - headroom_mb:
+        return "not enough ram"
+    return None
+
+def placeModels(nodes, models, objective="offload"):
+    """Assigns replicas of models to nodes. Replicas of a model go to different nodes, and models with a nodes list only go to those.
+    Replicas are placed greedily, first replicas of all models before any second ones, higher priority and bigger models first. Each goes to the node where it adds the most to the objective, which accounts for the layers the models already there have to give up. Ties go to the node with the most vram left.
+    Returns a pair (placement, unplaced). placement maps node names to pairs (residents, plan), unplaced is a list of pairs (name, reason)."""
+    state = {node["name"] : ([], {}, 0.0) for node in nodes}
+    replicas = sorted([(i, model) for model in models for i in range(0, model["replicas"])], key=lambda p: (p[0], -p[1]["priority"], -p[1]["size_mb"]))
+    unplaced = []
+    for (i, model) in replicas:
+        best = None
+        reasons = []
+        for node in nodes:
+            (residents, plan, value) = state[node["name"]]
+            if model["nodes"] != [] and node["name"] not in model["nodes"]:
+                continue
+            if model in residents:
+                reasons.append(node["name"] + " already has a replica")
+                continue
+            candidate = residents + [model]
+            (newPlan, newValue) = planNode(node, candidate, objective)
+            problem = nodeProblem(node, candidate, newPlan)
+            if problem is not None:
+                reasons.append(node["name"] + " " + problem)
+                continue
+            left = effectiveVramMb(node["vram"]) - node["reserve"] - sum([p["vram_mb"] for p in newPlan.values()])
+            key = (round(newValue - value, 6), left)
+            if best is None or key > best[0]:
+                best = (key, node, candidate, newPlan, newValue)
+        if best is None:
+            unplaced.append((model["name"], "; ".join(reasons) if reasons != [] else "no node to put it on"))
+            continue
+        (_, node, candidate, newPlan, newValue) = best
+        state[node["name"]] = (candidate, newPlan, newValue)
+    return ({name : (residents, plan) for (name, (residents, plan, value)) in state.items()}, unplaced)
+
+def nodeLayersFile(node, residents, plan, rows):
+    """Returns the LayersFile for node, with the rows of the residents from the layers file rows and the planned settings on top."""
+    lf = LayersFile()
+    for m in residents:
+        row = rows.get(m["name"])
+        lf.merge([row if row is not None else {"name" : m["name"]}], "include")
+        p = plan[m["name"]]
+        lf.set(m["name"], "gpu_layers", p["gpu_layers"])
+        lf.set(m["name"], "context", p["context"])
+        lf.set(m["name"], "size_mb", m["size_mb"])
+        if len(node["vram"]) > 1:
+            # every model is spread over the GPUs in proportion to their vram, which is what planning against the effective vram assumes
+            lf.set(m["name"], "tensor_split", ",".join([str(mb) for mb in node["vram"]]))
+            lf.set(m["name"], "main_gpu", node["vram"].index(max(node["vram"])))
+        if node["ram"]:
+            resident = sum([hostShareMb(o["size_mb"], plan[o["name"]]["gpu_layers"], o["block_count"]) for o in residents if o is not m])
+            lf.set(m["name"], "memory", memoryStrategy(m["size_mb"], p["gpu_layers"], m["block_count"], node["ram"], resident_mb=resident, lock_limit_mb=node["lock_limit"]))
+    return lf
+
+def mkDownloadScript(node, listfile):
+    """Returns a bash script that downloads the models in listfile, a layers file next to the script, straight into the node's model directory. Models that are there already are skipped."""
+    import shlex
+    mdir = shlex.quote(node["model_directory"])
+    return """#!/bin/bash
+# Downloads the models planned for """ + node["name"] + """ into """ + node["model_directory"] + """, skipping those that are there already. Needs llm-layers on this machine.
+DIR=$(cd "$(dirname "$0")" && pwd)
+mkdir -p """ + mdir + " " + shlex.quote(node["log_directory"]) + """
+llm-layers -d --download --no-best_for_machine --no-fit --memory off --model_directory """ + mdir + " --download_directory " + mdir + """ -f "$DIR/""" + listfile + """" "$@"
+"""
+
+def writeNode(node, residents, plan, rows, outdir, args, cmd=""):
+    """Writes the layers file, run scripts, download list and download script for node into outdir, which is meant to be copied to the node's directory. Files of an earlier plan are replaced, run scripts of models that aren't planned for the node anymore are removed."""
+    from llm_layers.generate import doLayersFile, writeScriptFiles, writeLayersConfig, makeScriptName
+    if not(os.path.isdir(outdir)):
+        os.makedirs(outdir)
+    layersfile = os.path.join(outdir, "llm_layers")
+    # the plan owns this file, existing rows would otherwise win over the new settings
+    if os.path.isfile(layersfile):
+        os.remove(layersfile)
+    doLayersFile(layersfile, nodeLayersFile(node, residents, plan, rows), argparse.Namespace(dry_run=False), cmd=cmd)
+
+    listfile = "download"
+    LayersFile().merge([{"name" : m["name"], "size_mb" : m["size_mb"]} for m in residents], "layersfile").write(os.path.join(outdir, listfile), header="# Models planned for " + node["name"] + ". Fetched by download.sh.\n")
+    writeFileAtomic(os.path.join(outdir, "download.sh"), mkDownloadScript(node, listfile), mode=0o755)
+
+    scripts = argparse.Namespace(prefix=args.prefix, suffix=args.suffix, layers=1,
+                                 layers_file=node["directory"].rstrip("/") + "/llm_layers",
+                                 executable=node["executable"],
+                                 additional_arguments=node["additional_arguments"] if node["additional_arguments"] is not None else args.additional_arguments,
+                                 log_directory=node["log_directory"])
+    models = [{"name" : m["name"], "file" : node["model_directory"].rstrip("/") + "/" + m["name"], "mmproj" : ""} for m in residents]
+    writeScriptFiles(models, outdir, scripts)
+    names = [makeScriptName(m["file"], args.prefix, args.suffix) for m in models]
+    for file in os.listdir(outdir):
+        if file.startswith(args.prefix) and file.endswith(args.suffix) and file not in names and file != "download.sh" and os.path.isfile(os.path.join(outdir, file)):
+            printerr("Removing " + os.path.join(outdir, file))
+            os.remove(os.path.join(outdir, file))
+
+def formatPlacement(nodes, placement):
+    lines = []
+    for node in nodes:
+        (residents, plan) = placement[node["name"]]
+        vram = effectiveVramMb(node["vram"]) - node["reserve"]
+        lines.append(node["name"] + " (" + ", ".join([str(mb) + "MB" for mb in node["vram"]]) + " vram, " + str(node["ram"]) + "MB ram):")
+        for m in residents:
+            p = plan[m["name"]]
+            lines.append("  " + m["name"] + ": " + str(p["gpu_layers"]) + " layers, context " + str(p["context"]) + ", ~" + str(p["vram_mb"]) + "MB vram, " + str(m["size_mb"]) + "MB on disk")
+        lines.append("  total: ~" + str(sum([p["vram_mb"] for p in plan.values()])) + "MB of " + str(vram) + "MB vram, " + str(sum([m["size_mb"] for m in residents])) + "MB on disk")
+    return "\n".join(lines)
+
+def main(argv):
+    from llm_layers.generate import default_additional_arguments
+    from llm_layers.scan import scanModels
+    parser = argparse.ArgumentParser(prog="llm-layers place", description="Plan which models run on which of several machines, and write a layers file, run scripts and a download script for every machine. Models are spread so that as many layers as possible are on a GPU, with replicas on different machines, and within every machine's vram, ram, disk and model limit. Works offline: model sizes come from the inventory, the layers file or the resolution cache.", epilog="Copy each machine's output directory to the directory given for it in the inventory, by default MODEL_DIRECTORY/llm-layers, e.g. 'rsync -a OUT/box1/ box1:/srv/models/llm-layers/', then run download.sh there. Paths in the inventory go into the scripts as they are, so they must be absolute. An inventory looks like this:\n\n" + example_inventory, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inventory", help="Ini file with a [node NAME] section for every machine, with vram (one amount per GPU), ram, disk, model_directory and optionally directory, max_models, reserve, executable, additional_arguments and log_directory, and a [model NAME] section for every model, with optional replicas, context, priority, size and nodes.")
+    parser.add_argument("-o", "--output_directory", type=str, default="llm-layers-nodes", help="Directory to write a subdirectory per machine into.")
+    parser.add_argument("-f", "--layers_file", type=str, default=getLayersFile(), help="Layers file to take model sizes, prompt formats and other columns from.")
+    parser.add_argument("--model_directory", type=str, default="", help="Directory with gguf files on this machine. Models found there are sized from their headers.")
+    parser.add_argument("--context", type=int, default=2048, help="Context for models that have none in the inventory or the layers file.")
+    parser.add_argument("--objective", type=str, choices=list(objectives.keys()), default="offload", help="'offload' maximizes the weighted fraction of layers on GPUs, 'throughput' maximizes weighted estimated speed.")
+    parser.add_argument("-p", "--prefix", type=str, default="run.", help="String to prepend each script's filename.")
+    parser.add_argument("-s", "--suffix", type=str, default=".sh", help="String to append to each script's filename.")
+    parser.add_argument("--additional_arguments", type=str, default=default_additional_arguments, help="Arguments passed on to the backend, for machines that don't set additional_arguments.")
+    parser.add_argument("--dry", action=argparse.BooleanOptionalAction, default=False, help="Only show the placement, don't write anything.")
+    args = parser.parse_args(argv)
+
+    try:
+        (nodes, models) = readInventory(os.path.expanduser(args.inventory))
+    except (OSError, ValueError, configparser.Error) as e:
+        printerr("error: " + str(e))
+        sys.exit(1)
+    if nodes == [] or models == []:
+        printerr("error: The inventory needs at least one [node NAME] and one [model NAME] section.")
+        sys.exit(1)
+
+    layersfile = os.path.expanduser(args.layers_file)
+    rows = LayersFile.read(layersfile) if os.path.isfile(layersfile) else LayersFile()
+    files = {m["name"] : m for m in scanModels(os.path.expanduser(args.model_directory))} if args.model_directory else {}
+    unknown = sizeModels(models, rows, files=files, context=args.context)
+    if unknown != []:
+        printerr("error: Don't know the size of " + ", ".join(unknown) + ". Give it with size in the inventory, or put the model into the layers file with a size_mb.")
+        sys.exit(1)
+
+    (placement, unplaced) = placeModels(nodes, models, objective=args.objective)
+    print(formatPlacement(nodes, placement))
+    for (name, reason) in unplaced:
+        printerr("warning: Could not place a replica of " + name + ": " + reason)
+
+    if not(args.dry):
+        from llm_layers import generate
+        # generate's chatter about every file it writes is repeated for every machine, the summary below is enough
+        generate.print_enabled = False
+        cmd = "llm-layers place " + " ".join(argv)
+        outdir = os.path.expanduser(args.output_directory)
+        for node in nodes:
+            (residents, plan) = placement[node["name"]]
+            writeNode(node, residents, plan, rows, os.path.join(outdir, node["name"]), args, cmd=cmd)
+            printerr("Wrote " + str(len(residents)) + " run scripts for " + node["name"] + " to " + os.path.join(outdir, node["name"]) + ", copy it to " + node["directory"])
+    if unplaced != []:
+        sys.exit(1)
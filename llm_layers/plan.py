@@ -0,0 +1,145 @@
+import os, sys, argparse, tempfile
+from llm_layers.layers import getLayersFile, LayersFile, get_total_vram_mb, printerr
+from llm_layers.scan import scanModels
+from llm_layers.fit import modelEstimate, vramNeeded, ALL_LAYERS
+
+# how much faster a layer runs on the GPU than on the CPU. Only the ratio matters for the throughput objective.
+gpu_speedup = 10.0
+
+def offloadValue(layers, total):
+    """Fraction of the model that runs on the GPU."""
+    return layers / total
+
+def throughputValue(layers, total):
+    """Estimated tokens per second relative to running fully offloaded. Time per token is the sum of the time spent in CPU and GPU layers."""
+    f = layers / total
+    return 1.0 / (gpu_speedup * (1 - f) + f)
+
+objectives = {"offload" : offloadValue, "throughput" : throughputValue}
+
+def planCoresidency(models, budget_mb, reserved_mb=0, priorities={}, objective="offload"):
+    """Distributes a vram budget among several models that will run at the same time.
+    models is a list of dictionaries with keys name, context and facts (see llm_layers.gguf.ggufFacts, may be None if size is given instead). priorities maps names to weights, defaulting to 1. The objective is either 'offload', maximizing the weighted sum of offloaded fractions, or 'throughput', maximizing the weighted sum of estimated relative speeds.
+    Layers are handed out greedily: in every step, the model and layer count with the best gain per byte of vram wins. Since the first layer of a model also pays for the backend's fixed overhead, every possible layer count is considered, not just the next one. Returns a dictionary mapping names to dictionaries with keys gpu_layers, context and vram_mb. The sum of vram_mb never exceeds budget_mb - reserved_mb."""
+    value = objectives[objective]
+    budget = (budget_mb - reserved_mb) * 10**6
+    states = []
+    for model in models:
+        estimate = modelEstimate(model["facts"], size=model.get("size", None))
+        total = estimate["block_count"] + 1
+        context = int(model["context"])
+        needs = [vramNeeded(estimate, n, context) for n in range(0, total + 1)]
+        states.append({"name" : model["name"], "context" : context, "total" : total, "needs" : needs, "layers" : 0, "weight" : float(priorities.get(model["name"], 1.0))})
+
+    used = 0
+    while True:
+        best = None
+        for state in states:
+            n = state["layers"]
+            for m in range(n + 1, state["total"] + 1):
+                cost = state["needs"][m] - state["needs"][n]
+                if used + cost > budget:
+                    break
+                gain = state["weight"] * (value(m, state["total"]) - value(n, state["total"]))
+                ratio = gain / max(cost, 1)
+                if best is None or ratio > best[0]:
+                    best = (ratio, state, m, cost)
+        if best is None:
+            break
+        (_, state, m, cost) = best
+        state["layers"] = m
+        used += cost
+
+    plan = {}
+    for state in states:
+        layers = state["layers"]
+        plan[state["name"]] = {"gpu_layers" : ALL_LAYERS if layers == state["total"] else layers,
+                               "context" : state["context"],
+                               "vram_mb" : round(state["needs"][layers] / 1e6)}
+    return plan
+
+def applyPlan(lf, plan):
+    """Sets gpu_layers and context for the planned models in the LayersFile lf. Returns lf."""
+    for (name, p) in plan.items():
+        lf.set(name, "gpu_layers", p["gpu_layers"])
+        lf.set(name, "context", p["context"])
+    return lf
+
+def parsePriorities(ws):
+    priorities = {}
+    for w in ws:
+        if "=" not in w:
+            raise ValueError("Priority must look like NAME=WEIGHT, not " + w)
+        (name, weight) = w.rsplit("=", 1)
+        priorities[name] = float(weight)
+    return priorities
+
+def main(argv):
+    from llm_layers.generate import megabyteIntFromVRamString, writeLayersConfig, fail
+    parser = argparse.ArgumentParser(prog="llm-layers plan", description="Plan gpu_layers for several models that should run at the same time, so that together they fit into vram.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("models", nargs="+", help="Names of models in the layers file that will run together.")
+    parser.add_argument("-f", "--layers_file", type=str, default=getLayersFile(), help="Layers file to read models from.")
+    parser.add_argument("--model_directory", type=str, default="~/.cache/huggingface", help="Directory with the gguf files. Models found here are sized from their headers, others from the size_mb column of the layers file.")
+    parser.add_argument("-V", "--vram", type=str, default="", help="Total vram. By default, vram is determined from hardware.")
+    parser.add_argument("-r", "--reserve", type=str, default="0mb", help="Vram that is spoken for by other programs, like a TTS engine, whisper, or OBS.")
+    parser.add_argument("--context", type=int, default=2048, help="Context for models that have none in the layers file.")
+    parser.add_argument("--priority", action="append", default=[], help="Weight of a model like NAME=2. Models default to 1. Can be given multiple times.")
+    parser.add_argument("--objective", type=str, choices=list(objectives.keys()), default="offload", help="'offload' maximizes the weighted fraction of layers on the GPU, 'throughput' maximizes weighted estimated speed.")
+    parser.add_argument("--profile", type=str, default="", help="Write the result as a named profile next to the layers file, e.g. ~/.config/llm_layers.streaming. Run scripts pick it up with LLM_LAYERS_FILE set to that file.")
+    parser.add_argument("-o", "--output", type=str, default="", help="Write the resulting layers file here. Without this or --profile, it is printed to stdout.")
+    args = parser.parse_args(argv)
+
+    layersfile = os.path.expanduser(args.layers_file)
+    try:
+        rows = LayersFile.read(layersfile)
+    except FileNotFoundError:
+        fail("error: Layers file not found: " + layersfile)
+    try:
+        vram = megabyteIntFromVRamString(args.vram) if args.vram else get_total_vram_mb()
+        reserved = megabyteIntFromVRamString(args.reserve)
+    except ValueError as e:
+        fail("error: " + str(e))
+    if vram <= 0 or reserved < 0:
+        fail("error: Need a positive amount of vram. Please specify it with e.g. '-V 12gb'.")
+    try:
+        priorities = parsePriorities(args.priority)
+    except ValueError as e:
+        fail("error: " + str(e))
+
+    files = {m["name"] : m for m in scanModels(os.path.expanduser(args.model_directory))}
+    models = []
+    for name in args.models:
+        if name not in rows:
+            fail("error: " + name + " is not in the layers file " + layersfile)
+        row = rows.get(name)
+        facts = files[name]["facts"] if name in files else None
+        size = None
+        try:
+            if facts is None:
+                if not(row["size_mb"]):
+                    fail("error: Don't know the size of " + name + ". It's neither in the model directory nor has a size_mb in the layers file.")
+                size = int(row["size_mb"]) * 10**6
+            context = int(row["context"]) if row["context"] else args.context
+        except ValueError:
+            fail("error: Could not read the size_mb or context of " + name + " in the layers file " + layersfile)
+        models.append({"name" : name, "context" : context, "facts" : facts, "size" : size})
+
+    plan = planCoresidency(models, vram, reserved_mb=reserved, priorities=priorities, objective=args.objective)
+    for name in args.models:
+        p = plan[name]
+        printerr(name + ": " + str(p["gpu_layers"]) + " layers, context " + str(p["context"]) + ", ~" + str(p["vram_mb"]) + "MB")
+    printerr("Total: ~" + str(sum([p["vram_mb"] for p in plan.values()])) + "MB of " + str(vram - reserved) + "MB available.")
+
+    cmd = "llm-layers plan " + " ".join(argv)
+    if args.profile:
+        output = layersfile + "." + args.profile
+    else:
+        output = os.path.expanduser(args.output)
+    if output:
+        if writeLayersConfig(output, applyPlan(rows, plan), cmd=cmd):
+            fail("error: Could not write " + output)
+        printerr("Wrote " + output)
+        return
+    with tempfile.TemporaryDirectory() as dir:
+        writeLayersConfig(dir + "/llm_layers", applyPlan(rows, plan), cmd=cmd)
+        print(open(dir + "/llm_layers", "r").read(), end="")
@@ -0,0 +1,131 @@
+import os, sys, json, time, threading, contextlib
+
+class Profiler(object):
+    """Collects wall time per phase, counters and cache statistics for one run of llm-layers. A disabled profiler costs next to nothing, so instrumentation can stay in place.
+    Phases may nest and may run on several threads at once, a phase's seconds are the wall time during which any of its calls ran. Counters are plain sums, like files scanned or http calls made. Caches are anything with hits and misses attributes, like llm_layers.cache.JsonCache, and are read when the report is made."""
+    def __init__(self, enabled=False, start=None):
+        self.enabled = enabled
+        self.start = start if start is not None else time.perf_counter()
+        self.lock = threading.Lock()
+        self.phases = []
+        self.counters = {}
+        self.caches = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not(self.enabled):
+            yield
+            return
+        begin = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            with self.lock:
+                self.phases.append({"name" : name, "start" : begin - self.start, "duration" : end - begin, "thread" : threading.get_ident()})
+
+    def count(self, name, n=1):
+        if not(self.enabled):
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def cache(self, name, cache):
+        """Adds cache to the statistics under name. Several caches under the same name are summed up."""
+        if not(self.enabled):
+            return
+        with self.lock:
+            caches = self.caches.setdefault(name, [])
+            if not(any([c is cache for c in caches])):
+                caches.append(cache)
+
+    def totals(self):
+        """Returns a list of dictionaries with keys name, calls, seconds and thread_seconds, one per phase name, in the order phases were first entered. seconds is the wall time covered by the calls, thread_seconds their sum, which is larger when calls overlapped on several threads."""
+        totals = {}
+        for p in sorted(self.phases, key=lambda p: p["start"]):
+            t = totals.setdefault(p["name"], {"name" : p["name"], "calls" : 0, "seconds" : 0.0, "thread_seconds" : 0.0, "until" : 0.0})
+            t["calls"] += 1
+            t["thread_seconds"] += p["duration"]
+            # phases come sorted by start, so only the part after what's covered so far is new
+            end = p["start"] + p["duration"]
+            t["seconds"] += max(0.0, end - max(p["start"], t["until"]))
+            t["until"] = max(t["until"], end)
+        return [{k : v for (k, v) in t.items() if k != "until"} for t in totals.values()]
+
+    def cacheStats(self):
+        stats = {}
+        for (name, caches) in self.caches.items():
+            hits = sum([cache.hits for cache in caches])
+            misses = sum([cache.misses for cache in caches])
+            stats[name] = {"hits" : hits, "misses" : misses, "hit_rate" : round(hits / (hits + misses), 3) if hits + misses else None}
+        return stats
+
+    def asDict(self):
+        return {"wall_seconds" : round(time.perf_counter() - self.start, 4),
+                "phases" : [{"name" : t["name"], "calls" : t["calls"], "seconds" : round(t["seconds"], 4), "thread_seconds" : round(t["thread_seconds"], 4)} for t in self.totals()],
+                "counters" : dict(self.counters),
+                "caches" : self.cacheStats()}
+
+    def asTable(self):
+        d = self.asDict()
+        lines = ["phase                        calls    seconds"]
+        for t in d["phases"]:
+            lines.append(t["name"].ljust(28) + str(t["calls"]).rjust(6) + ("%.3f" % t["seconds"]).rjust(11))
+        lines.append("total".ljust(34) + ("%.3f" % d["wall_seconds"]).rjust(11))
+        if d["counters"] != {}:
+            lines.append("")
+            lines.append("counter                                value")
+            for (name, value) in sorted(d["counters"].items()):
+                lines.append(name.ljust(34) + str(value).rjust(11))
+        if d["caches"] != {}:
+            lines.append("")
+            lines.append("cache                  hits   misses  hit rate")
+            for (name, s) in sorted(d["caches"].items()):
+                rate = "-" if s["hit_rate"] is None else str(round(100 * s["hit_rate"])) + "%"
+                lines.append(name.ljust(18) + str(s["hits"]).rjust(9) + str(s["misses"]).rjust(9) + rate.rjust(10))
+        return "\n".join(lines) + "\n"
+
+    def asTrace(self):
+        """Returns the phases as a chrome trace, to be opened in chrome://tracing or perfetto. Counters and cache statistics end up in the trace's metadata."""
+        pid = os.getpid()
+        events = [{"name" : p["name"], "ph" : "X", "ts" : round(p["start"] * 1e6), "dur" : round(p["duration"] * 1e6), "pid" : pid, "tid" : p["thread"]} for p in self.phases]
+        d = self.asDict()
+        return {"traceEvents" : events, "displayTimeUnit" : "ms", "otherData" : {"counters" : d["counters"], "caches" : d["caches"], "wall_seconds" : d["wall_seconds"]}}
+
+    def report(self, format="table", file=""):
+        """Writes the report in format, which is 'table', 'json' or 'trace', to file, or to standard error if file is empty."""
+        if format == "table":
+            w = self.asTable()
+        elif format == "json":
+            w = json.dumps(self.asDict(), indent=2) + "\n"
+        elif format == "trace":
+            w = json.dumps(self.asTrace()) + "\n"
+        else:
+            raise ValueError("Unknown profile format " + str(format))
+        if file:
+            with open(file, "w") as f:
+                f.write(w)
+        else:
+            sys.stderr.write(w)
+
+_profiler = Profiler()
+
+def getProfiler():
+    """Returns the process wide profiler. It is disabled unless enableProfiler was called."""
+    return _profiler
+
+def enableProfiler():
+    """Replaces the process wide profiler with an enabled one. Time since the llm_layers package started importing is recorded as the phase import."""
+    global _profiler
+    started = getattr(sys.modules.get("llm_layers", None), "import_started", None)
+    _profiler = Profiler(enabled=True, start=started)
+    if started is not None:
+        _profiler.phases.append({"name" : "import", "start" : 0.0, "duration" : time.perf_counter() - started, "thread" : threading.get_ident()})
+    return _profiler
+
+def phase(name):
+    """Context manager timing the phase name on the process wide profiler."""
+    return _profiler.phase(name)
+
+def count(name, n=1):
+    _profiler.count(name, n)
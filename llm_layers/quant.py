@@ -0,0 +1,219 @@
+import os, re, sys, argparse
+from llm_layers.layers import HubClient, RepoUnavailable, LayersFile, rankRepos, getLayersFile, get_devices, printerr
+from llm_layers.cache import JsonCache, getCacheDir, getResolutionCache
+from llm_layers.gguf import file_types, shardInfo, shardNames
+from llm_layers.fit import modelEstimate, fitModel, fitDevices, ALL_LAYERS
+from llm_layers.classify import modelType
+
+# quantizations from best to worst. Bits per weight alone would get this wrong, since k-quants beat the legacy ones of the same size
+quant_quality = "F32 F16 BF16 Q8_0 Q6_K Q5_K_M Q5_K_S Q5_1 Q5_0 Q4_K_M Q4_K_S IQ4_NL IQ4_XS Q4_1 Q4_0 Q3_K_L Q3_K_M IQ3_M IQ3_S Q3_K_S IQ3_XS IQ3_XXS Q2_K IQ2_M Q2_K_S IQ2_S IQ2_XS IQ2_XXS IQ1_M IQ1_S TQ2_0 TQ1_0".split(" ")
+# longest names first, so Q4_K_M isn't mistaken for Q4_K_S's prefix or similar
+quant_pattern = re.compile(r"(?:^|[.\-_])(" + "|".join(sorted(set(quant_quality) | set(file_types.values()), key=len, reverse=True)) + r")(?=[.\-_]|$)", re.IGNORECASE)
+
+# memory bandwidth in GB/s, since generating a token means reading every weight once
+default_gpu_bandwidth = 300
+default_cpu_bandwidth = 40
+
+def quantName(filename):
+    """Returns the quantization named in a gguf filename, like Q4_K_M for mistral-7b-instruct-v0.2.Q4_K_M.gguf, or the empty string."""
+    matches = quant_pattern.findall(os.path.basename(filename))
+    return matches[-1].upper() if matches != [] else ""
+
+def qualityRank(quant):
+    """Smaller is better. Unknown quantizations come last."""
+    return quant_quality.index(quant) if quant in quant_quality else len(quant_quality)
+
+def repoVariants(files):
+    """Groups the files of a repository, as returned by HubClient.list_files, into the gguf models it offers. Split models are one variant, named after their first shard. Projectors are left out. Returns a list of dictionaries with keys name, quant, size, sha256 and shards (None, or a dictionary like the resolution cache has)."""
+    byPath = {f["path"] : f for f in files}
+    variants = []
+    for f in files:
+        name = f["path"]
+        if not(name.lower().endswith(".gguf")) or "mmproj" in name.lower() or "/" in name:
+            continue
+        info = shardInfo(name)
+        if info is not None and info[1] != 1:
+            continue
+        names = shardNames(name)
+        if [shard for shard in names if shard not in byPath] != []:
+            continue
+        sizes = [byPath[shard]["size"] for shard in names]
+        variants.append({"name" : name,
+                         "quant" : quantName(name),
+                         "size" : sum(sizes) if None not in sizes else None,
+                         "sha256" : f["sha256"],
+                         "shards" : {shard : {"size" : byPath[shard]["size"], "sha256" : byPath[shard]["sha256"]} for shard in names} if len(names) > 1 else None})
+    return variants
+
+def estimateVariant(variant, budgets_mb, ram_mb, context=2048, max_context=8192, gpu_bandwidth=default_gpu_bandwidth, cpu_bandwidth=default_cpu_bandwidth):
+    """Estimates how variant runs with vram budgets_mb, one per GPU, and ram_mb of system memory. Only the file size is known before downloading, so layers are assumed to be evenly sized, see llm_layers.fit.modelEstimate.
+    Returns a dictionary with keys gpu_layers, context, tensor_split, main_gpu, offload (fraction of the model on the GPU), tg_tps (expected tokens per second, from the bandwidth needed to read the weights once per token) and fits (whether the rest fits into ram)."""
+    size = variant["size"]
+    estimate = modelEstimate(None, size=size)
+    if len(budgets_mb) > 1:
+        result = fitDevices(None, budgets_mb, context=context, max_context=max_context, size=size)
+    else:
+        (layers, ctx) = fitModel(None, budgets_mb[0] if budgets_mb != [] else 0, context=context, max_context=max_context, size=size)
+        result = {"gpu_layers" : layers, "context" : ctx, "tensor_split" : "", "main_gpu" : ""}
+    blocks = estimate["block_count"]
+    layers = blocks + 1 if result["gpu_layers"] == ALL_LAYERS else min(int(result["gpu_layers"]), blocks)
+    gpu_bytes = size if layers > blocks else sum(estimate["layer_bytes"][:layers])
+    cpu_bytes = size - gpu_bytes
+    seconds = gpu_bytes / (gpu_bandwidth * 1e9) + cpu_bytes / (cpu_bandwidth * 1e9)
+    result.update({"offload" : layers / (blocks + 1),
+                   "tg_tps" : round(1 / seconds, 1) if seconds > 0 else 0.0,
+                   "fits" : cpu_bytes <= ram_mb * 1e6})
+    return result
+
+def pickVariant(variants, offload=1.0):
+    """Returns the best of variants, which carry the estimates of estimateVariant: the highest quality quant that fits and still gets at least offload onto the GPU. If none gets that much, the one that gets the most wins, and quality breaks ties. None if nothing fits."""
+    fitting = [v for v in variants if v["fits"] and v["size"] is not None]
+    if fitting == []:
+        return None
+    keeping = [v for v in fitting if v["offload"] >= offload]
+    if keeping != []:
+        return min(keeping, key=lambda v: (qualityRank(v["quant"]), -v["tg_tps"]))
+    return max(fitting, key=lambda v: (v["offload"], -qualityRank(v["quant"])))
+
+def getRepoFilesCache():
+    return JsonCache(getCacheDir() + "/repo_files.json", ttl=24*3600)
+
+def repoFiles(repo_id, hub=None, cache=None, offline=False):
+    """Returns the list of files at the top of repo_id, see HubClient.list_files. Cached for a day, and in offline mode, stale listings are used too. Returns None if the repository can't be listed."""
+    if cache is None:
+        cache = getRepoFilesCache()
+    files = cache.get(repo_id, ttl=float("inf") if offline else None)
+    if files is not None or offline:
+        return files
+    try:
+        files = (hub if hub is not None else HubClient()).list_files(repo_id)
+    except (RepoUnavailable, OSError):
+        return None
+    cache.put(repo_id, files)
+    cache.save()
+    return files
+
+def findRepo(query, hub=None):
+    """Returns the repository id for query. Anything with a slash is taken to be a repository id already. Otherwise, query is a model family like mistral-7b-instruct, and the best ranked repository with gguf in its name is picked, see llm_layers.layers.rankRepos. Returns the empty string if there's none."""
+    if "/" in query:
+        return query
+    try:
+        results = (hub if hub is not None else HubClient()).search(query)
+    except OSError:
+        return ""
+    results = [r for r in results if "gguf" in r["id"].lower()]
+    if results == []:
+        return ""
+    return rankRepos(results)[0]
+
+def pickModel(query, budgets_mb, ram_mb, offload=1.0, context=2048, max_context=8192, gpu_bandwidth=default_gpu_bandwidth, cpu_bandwidth=default_cpu_bandwidth, hub=None, offline=False):
+    """Picks a quant of the model family or repository query for the hardware, see pickVariant. Returns a triple (repo, variants, chosen), where variants carry their estimates and chosen is one of them or None. repo is the empty string if nothing was found."""
+    if offline and "/" not in query:
+        printerr("error: Can't search for " + query + " offline, give a repository id instead.")
+        return ("", [], None)
+    repo = findRepo(query, hub=hub)
+    if repo == "":
+        return ("", [], None)
+    files = repoFiles(repo, hub=hub, offline=offline)
+    if files is None:
+        return (repo, [], None)
+    variants = [v for v in repoVariants(files) if v["size"] is not None]
+    for variant in variants:
+        variant.update(estimateVariant(variant, budgets_mb, ram_mb, context=context, max_context=max_context, gpu_bandwidth=gpu_bandwidth, cpu_bandwidth=cpu_bandwidth))
+    variants.sort(key=lambda v: (qualityRank(v["quant"]), v["name"]))
+    return (repo, variants, pickVariant(variants, offload=offload))
+
+def variantRow(variant):
+    """Returns a layers file row for a picked variant. Columns that need the gguf header are left empty, the next scan after downloading fills them in."""
+    row = {"name" : variant["name"],
+           "gpu_layers" : variant["gpu_layers"],
+           "context" : variant["context"],
+           "type" : modelType(variant["name"], None),
+           "quantization" : variant["quant"],
+           "size_mb" : round(variant["size"] / 1e6)}
+    if variant["tensor_split"]:
+        row.update({"tensor_split" : variant["tensor_split"], "main_gpu" : variant["main_gpu"]})
+    return row
+
+def rememberRepo(variant, repo, resolutions=None):
+    """Stores repo as the resolution of the variant's filename, so downloading it fetches it from the repository it was picked from."""
+    if resolutions is None:
+        resolutions = getResolutionCache()
+    resolutions.store(variant["name"], repo, candidates=[repo], score=0, size=variant["size"], sha256=variant["sha256"], shards=variant["shards"])
+
+def formatVariants(variants, chosen):
+    lines = ["  quant        size     layers  offload   ~t/s  file"]
+    for v in variants:
+        layers = "all" if v["gpu_layers"] == ALL_LAYERS else str(v["gpu_layers"])
+        mark = "*" if v is chosen else (" " if v["fits"] else "-")
+        lines.append(mark + " " + (v["quant"] or "?").ljust(8) + (str(round(v["size"] / 1e6)) + "MB").rjust(10) + layers.rjust(9) + (str(round(100 * v["offload"])) + "%").rjust(9) + str(v["tg_tps"]).rjust(7) + "  " + v["name"])
+    return "\n".join(lines)
+
+def pickRows(queries, budgets_mb, ram_mb, offload=1.0, context=2048, max_context=8192, gpu_bandwidth=default_gpu_bandwidth, cpu_bandwidth=default_cpu_bandwidth, hub=None, offline=False, remember=True, report=print):
+    """Picks a quant for every model family or repository in queries, see pickModel, and reports the variants. Returns a list of layers file rows for the picks. With remember, the repositories they were picked from are stored in the resolution cache, so downloads get them from there."""
+    rows = []
+    resolutions = getResolutionCache()
+    for query in queries:
+        (repo, variants, chosen) = pickModel(query, budgets_mb, ram_mb, offload=offload, context=context, max_context=max_context, gpu_bandwidth=gpu_bandwidth, cpu_bandwidth=cpu_bandwidth, hub=hub, offline=offline)
+        if repo == "":
+            printerr("error: No gguf repository found for " + query)
+            continue
+        if variants == []:
+            printerr("error: No gguf files found in " + repo)
+            continue
+        report(repo + ":\n" + formatVariants(variants, chosen))
+        if chosen is None:
+            printerr("error: No quant of " + repo + " fits into " + str(sum(budgets_mb)) + "MB of vram and " + str(ram_mb) + "MB of ram.")
+            continue
+        report("Picked " + chosen["name"] + ".")
+        if remember:
+            rememberRepo(chosen, repo, resolutions)
+        rows.append(variantRow(chosen))
+    if remember:
+        resolutions.save()
+    return rows
+
+def main(argv):
+    from llm_layers.generate import megabyteIntFromVRamString, writeLayersConfig
+    from llm_layers.memory import systemMemoryMb, headroom_mb
+    parser = argparse.ArgumentParser(prog="llm-layers pick", description="Pick the best quant of a model for this machine. Lists the gguf variants of a repository with their sizes, estimates how much of each fits onto the GPU and how fast it runs, and adds the highest quality one that keeps the --offload target to the layers file. The next llm-layers run downloads it.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("models", nargs="+", help="Model families like mistral-7b-instruct, which are searched for on huggingface, or repository ids like TheBloke/Mistral-7B-Instruct-v0.2-GGUF.")
+    parser.add_argument("-f", "--layers_file", type=str, default=getLayersFile(), help="Layers file to add the picked models to.")
+    parser.add_argument("-V", "--vram", type=str, default="", help="Vram budget, one amount per GPU like '-V 8gb,8gb' for several. By default, vram is determined from hardware.")
+    parser.add_argument("--ram", type=str, default="", help="System memory budget for the layers that don't fit into vram. Defaults to total ram minus some headroom.")
+    parser.add_argument("--offload", type=float, default=1.0, help="Fraction of the model that should be on the GPU. 1 means fully offloaded, lower values trade speed for a better quant.")
+    parser.add_argument("--context", type=int, default=2048, help="Context the model needs at least.")
+    parser.add_argument("--max_context", type=int, default=8192, help="Largest context to give fully offloaded models.")
+    parser.add_argument("--gpu_bandwidth", type=float, default=default_gpu_bandwidth, help="GPU memory bandwidth in GB/s, for the speed estimate.")
+    parser.add_argument("--cpu_bandwidth", type=float, default=default_cpu_bandwidth, help="System memory bandwidth in GB/s, for the speed estimate.")
+    parser.add_argument("--offline", action=argparse.BooleanOptionalAction, default=False, help="Only use repository listings cached by earlier runs.")
+    parser.add_argument("--dry", action=argparse.BooleanOptionalAction, default=False, help="Only show the variants and the pick, don't change the layers file.")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.vram:
+            budgets = [megabyteIntFromVRamString(w) for w in args.vram.split(",")]
+        else:
+            budgets = [d["total_mb"] for d in get_devices()]
+        ram = megabyteIntFromVRamString(args.ram) if args.ram else systemMemoryMb()[0] - headroom_mb
+    except ValueError as e:
+        printerr("error: " + str(e))
+        sys.exit(1)
+    if [mb for mb in budgets if mb <= 0] != [] or ram <= 0:
+        printerr("error: Nonsense or negative budget. Please specify amounts like '-V 8gb' or '--ram 32gb'.")
+        sys.exit(1)
+
+    rows = pickRows(args.models, budgets, ram, offload=args.offload, context=args.context, max_context=args.max_context, gpu_bandwidth=args.gpu_bandwidth, cpu_bandwidth=args.cpu_bandwidth, offline=args.offline, remember=not(args.dry))
+    if rows == [] or args.dry:
+        return
+    layersfile = os.path.expanduser(args.layers_file)
+    lf = LayersFile.read(layersfile) if os.path.isfile(layersfile) else LayersFile()
+    for row in rows:
+        if row["name"] in lf:
+            printerr("Keeping the existing entry for " + row["name"] + " in " + layersfile)
+    # like every other source, picked rows never override what's in the layers file
+    result = LayersFile().merge(rows, "loadout").mergeFile(lf)
+    if writeLayersConfig(layersfile, result, cmd="llm-layers pick " + " ".join(argv)):
+        printerr("error: Could not write " + layersfile)
+        sys.exit(1)
+    printerr("Wrote " + layersfile + ". Run llm-layers to download the picked models.")
@@ -0,0 +1,143 @@
+import os
+from llm_layers.cache import JsonCache, getCacheDir
+from llm_layers.gguf import splitFacts, factColumns, shardInfo, shardNames, getFactsCache
+from llm_layers.cache import printerr
+from llm_layers.profile import getProfiler
+from llm_layers.classify import guessPromptFormat, classifyModel
+
+class ScanIndex(object):
+    """Persistent index of directory listings, README prompt formats and gguf header facts, so that rescanning a large model directory only costs work for what changed.
+    A directory is only listed again if its mtime changed, which happens whenever an entry is added, removed or renamed. READMEs and gguf files are keyed by path, mtime and size. scanned and skipped count listed and reused directories. In the default cache directory, gguf facts are shared with llm_layers.gguf.getFactsCache."""
+    def __init__(self, dir=None):
+        self.facts = getFactsCache() if dir is None else JsonCache(dir + "/gguf.json")
+        if dir is None:
+            dir = getCacheDir()
+        self.dirs = JsonCache(dir + "/scan_dirs.json")
+        self.readmes = JsonCache(dir + "/scan_readmes.json")
+        self.scanned = 0
+        self.skipped = 0
+        self.incomplete = {}
+
+    def listDir(self, dir):
+        """Returns a pair of sorted lists (files, subdirectories) with the names of non-hidden entries in dir. Symlinks are followed."""
+        st = os.stat(dir)
+        cached = self.dirs.get(dir)
+        if cached is not None and cached["mtime"] == st.st_mtime_ns:
+            self.skipped += 1
+            return (cached["files"], cached["dirs"])
+
+        self.scanned += 1
+        files = []
+        dirs = []
+        with os.scandir(dir) as it:
+            for entry in it:
+                # glob, which this replaces, never saw hidden files either
+                if entry.name.startswith("."):
+                    continue
+                try:
+                    if entry.is_dir():
+                        dirs.append(entry.name)
+                    elif entry.is_file():
+                        files.append(entry.name)
+                except OSError:
+                    continue
+        files.sort()
+        dirs.sort()
+        self.dirs.put(dir, {"mtime" : st.st_mtime_ns, "files" : files, "dirs" : dirs})
+        return (files, dirs)
+
+    def promptFormat(self, file):
+        """Returns the prompt format guessed from the README at file, reading it only if it changed since last time."""
+        st = os.stat(file)
+        cached = self.readmes.get(file)
+        if cached is not None and cached["mtime"] == st.st_mtime_ns and cached["size"] == st.st_size:
+            return cached["prompt_format"]
+        prompt_format = guessPromptFormat(open(file, "r", errors="replace").read())
+        self.readmes.put(file, {"mtime" : st.st_mtime_ns, "size" : st.st_size, "prompt_format" : prompt_format})
+        return prompt_format
+
+    def warnIncomplete(self, incomplete):
+        """Warns about split models with missing shards. incomplete maps the first shard's path to a pair (missing, total). Models warned about by the last call, with as many shards missing, aren't warned about again, so that rescanning, e.g. with --watch, doesn't repeat the same warnings."""
+        for (file, (missing, total)) in incomplete.items():
+            if self.incomplete.get(file, None) != (missing, total):
+                printerr("warning: Skipping " + file + ", " + str(missing) + " of its " + str(total) + " shards are missing.")
+        self.incomplete = incomplete
+
+    def save(self):
+        self.dirs.save()
+        self.readmes.save()
+        self.facts.save()
+
+def scanModels(mdir, defaults={}, index=None, extensions=["gguf"]):
+    """Walks through mdir and all directories below it, collecting gguf models. Returns a list of dictionaries with keys file, name, mmproj, prompt_format and type (see llm_layers.classify.classifyModel), the columns from llm_layers.gguf.factColumns, plus everything in defaults. The raw gguf facts are under the key facts, and the list of files making up the model under shards. Split models appear once, under the name of their first shard, and only if all shards are there.
+    If index is None, a ScanIndex in the cache directory is used and saved afterwards."""
+    save = index is None
+    if index is None:
+        index = ScanIndex()
+    models = []
+    incomplete = {}
+    seen = set()
+    # directories come with the README guess of their closest ancestor, for repos that keep the gguf files in subdirectories
+    stack = [(os.path.normpath(mdir), "")]
+    while stack != []:
+        (dir, inherited) = stack.pop()
+        real = os.path.realpath(dir)
+        if real in seen:
+            # symlink loop, or the same directory linked twice
+            continue
+        seen.add(real)
+        try:
+            (files, dirs) = index.listDir(dir)
+        except OSError:
+            continue
+        readme_format = scanDirectory(dir, files, index, models, incomplete, defaults, extensions, inherited)
+        # reversed, so directories are visited in sorted order
+        stack.extend([(os.path.join(dir, d), readme_format) for d in reversed(dirs)])
+    index.warnIncomplete(incomplete)
+    profiler = getProfiler()
+    profiler.count("directories listed", index.scanned)
+    profiler.count("directories reused", index.skipped)
+    profiler.count("models found", len(models))
+    profiler.cache("directory listings", index.dirs)
+    profiler.cache("readmes", index.readmes)
+    profiler.cache("gguf headers", index.facts)
+    if save:
+        index.save()
+    return models
+
+def scanDirectory(dir, files, index, models, incomplete, defaults, extensions, inherited=""):
+    """Appends models found among files in dir to models, and split models with missing shards to incomplete, see ScanIndex.warnIncomplete. Returns the prompt format guessed from the README in dir, or inherited if there is none."""
+    ggufs = [f for f in files if f.lower().split(".")[-1] in extensions]
+    # filter out mmproj files. This is a heuristic, but it usually works
+    candidates = [f for f in ggufs if "mmproj" in f.lower()]
+    mmproj = os.path.join(dir, candidates[0]) if candidates != [] else ""
+
+    readme_format = inherited
+    for f in files:
+        if f.lower() == "readme.md":
+            try:
+                readme_format = index.promptFormat(os.path.join(dir, f)) or inherited
+            except OSError:
+                pass
+
+    present = set(files)
+    for f in ggufs:
+        if f in candidates:
+            continue
+        # split models are one model, named after and started from their first shard
+        shards = shardNames(f)
+        info = shardInfo(f)
+        if info is not None and info[1] != 1:
+            continue
+        missing = [shard for shard in shards if shard not in present]
+        if missing != []:
+            incomplete[os.path.join(dir, f)] = (len(missing), len(shards))
+            continue
+        file = os.path.join(dir, f)
+        facts = splitFacts([os.path.join(dir, shard) for shard in shards], cache=index.facts)
+        (prompt_format, type) = classifyModel(f, facts, readme_format=readme_format, mmproj=mmproj)
+        d = dict(defaults)
+        d.update({ "file" : file, "name" : f, "mmproj" : mmproj, "prompt_format" : prompt_format, "type" : type, "facts" : facts, "shards" : [os.path.join(dir, shard) for shard in shards]})
+        d.update(factColumns(facts))
+        models.append(d)
+    return readme_format
@@ -0,0 +1,328 @@
+import os, sys, json, time, argparse, threading, http.client, http.server
+from llm_layers.layers import LayersFile, printerr, get_total_vram_mb
+from llm_layers.launch import Backend, backendCommand, settingOrDefault, addBackendArguments, default_host, freePort
+from llm_layers.history import checkLogArguments
+from llm_layers.scan import scanModels
+from llm_layers.fit import modelEstimate, vramNeeded
+from llm_layers.memory import prefetchForBackend
+
+# headers that belong to a single connection and must not be passed through
+hop_headers = ["connection", "keep-alive", "transfer-encoding", "te", "trailer", "upgrade", "proxy-authenticate", "proxy-authorization"]
+
+class ModelError(Exception):
+    """Raised when a model can't be served. status is the http status to answer with."""
+    def __init__(self, message, status=503):
+        super().__init__(message)
+        self.status = status
+
+class Slot(object):
+    """A model that is loading or loaded, with its backend and bookkeeping."""
+    def __init__(self, name, vram_mb):
+        self.name = name
+        self.vram_mb = vram_mb
+        self.backend = None
+        self.port = None
+        self.state = "loading"
+        self.reason = ""
+        self.active = 0
+        self.last_used = time.monotonic()
+
+class ModelPool(object):
+    """Keeps backends for models running within a vram budget, starting them on demand.
+    acquire() returns a ready slot for a model, starting its backend if needed. Requests for a model that is still loading wait for it. If the budget would be exceeded, idle models are stopped, least recently used first, unless they are pinned. If nothing can be evicted because everything is busy, acquire() waits until something is released.
+    models maps names to pairs (model, row) as returned by llm_layers.launch.findModel. makeBackend is a function (name, model, row, port) returning an unstarted llm_layers.launch.Backend."""
+    def __init__(self, models, budget_mb, makeBackend, pinned=[], timeout=600):
+        self.models = models
+        self.budget_mb = budget_mb
+        self.makeBackend = makeBackend
+        self.pinned = set(pinned)
+        self.timeout = timeout
+        self.slots = {}
+        self.cond = threading.Condition()
+        self.stats = {"requests" : 0, "loads" : 0, "failed_loads" : 0, "evictions" : 0, "queued" : 0, "cold_starts" : []}
+
+    def vramFor(self, name):
+        """Returns the vram in MB that the model called name needs. A measured tuned_vram_mb from llm-layers tune beats the estimate. Raises ModelError if the model file or its settings can't be read."""
+        (model, row) = self.models[name]
+        try:
+            if row is not None and row.get("tuned_vram_mb", ""):
+                return int(float(row["tuned_vram_mb"]))
+            estimate = modelEstimate(model["facts"], size=os.path.getsize(model["file"]) if model["facts"] is None else None)
+            gpu_layers = int(settingOrDefault(row, "gpu_layers", "LLM_LAYERS", 1))
+            context = int(settingOrDefault(row, "context", "LLM_MAX_CONTEXT_LENGTH", 2048))
+        except (OSError, ValueError) as e:
+            raise ModelError("Can't tell how much vram " + name + " needs: " + str(e), status=500)
+        return round(vramNeeded(estimate, gpu_layers, context) / 1e6)
+
+    def used(self):
+        return sum([slot.vram_mb for slot in self.slots.values()])
+
+    def _victims(self, need):
+        """Returns the slots to stop so that need MB fit, or None if that isn't possible right now."""
+        free = self.budget_mb - self.used()
+        idle = sorted([slot for slot in self.slots.values() if slot.state == "ready" and slot.active == 0 and slot.name not in self.pinned], key=lambda slot: slot.last_used)
+        victims = []
+        while free < need:
+            if idle == []:
+                return None
+            slot = idle.pop(0)
+            victims.append(slot)
+            free += slot.vram_mb
+        return victims
+
+    def acquire(self, name):
+        """Returns a ready Slot for the model called name, with its active count increased. Call release() when done. Raises ModelError."""
+        if name not in self.models:
+            raise ModelError("Unknown model " + name, status=404)
+        with self.cond:
+            self.stats["requests"] += 1
+            queued = False
+            waiting_on = None
+            while True:
+                if waiting_on is not None and waiting_on.state == "failed":
+                    # everyone queued behind a failed load fails with it, instead of trying again one by one
+                    raise ModelError(name + " failed to load: " + waiting_on.reason)
+                slot = self.slots.get(name, None)
+                waiting_on = slot
+                if slot is not None and slot.state == "ready":
+                    slot.active += 1
+                    slot.last_used = time.monotonic()
+                    return slot
+                if slot is None:
+                    need = self.vramFor(name)
+                    if need > self.budget_mb:
+                        raise ModelError(name + " needs " + str(need) + "MB, more than the whole budget of " + str(self.budget_mb) + "MB.", status=507)
+                    victims = self._victims(need)
+                    if victims is not None:
+                        for victim in victims:
+                            del self.slots[victim.name]
+                            self.stats["evictions"] += 1
+                        slot = Slot(name, need)
+                        self.slots[name] = slot
+                        break
+                if not(queued):
+                    queued = True
+                    self.stats["queued"] += 1
+                self.cond.wait()
+
+        # loading happens outside the lock, so other models keep being served
+        for victim in victims:
+            printerr("Evicting " + victim.name + " (" + str(victim.vram_mb) + "MB)")
+            victim.backend.stop()
+        self._load(slot)
+        with self.cond:
+            slot.active += 1
+            slot.last_used = time.monotonic()
+        return slot
+
+    def _load(self, slot):
+        """Starts the backend for slot and waits until it is ready. Whatever goes wrong, the slot ends up ready or failed and removed, and everyone waiting on it is woken up. Cold start time is measured from here, so it includes everything makeBackend does."""
+        started = time.monotonic()
+        reason = ""
+        try:
+            (model, row) = self.models[slot.name]
+            slot.port = freePort()
+            slot.backend = self.makeBackend(slot.name, model, row, slot.port)
+            printerr("Loading " + slot.name + " (" + str(slot.vram_mb) + "MB, " + str(self.used()) + "MB of " + str(self.budget_mb) + "MB in use)")
+            slot.backend.start()
+            status = slot.backend.waitReady(timeout=self.timeout)
+            reason = slot.backend.reason
+        except Exception as e:
+            status = "failed"
+            reason = str(e) or type(e).__name__
+        elapsed = time.monotonic() - started
+        with self.cond:
+            if status == "ready":
+                slot.state = "ready"
+                self.stats["loads"] += 1
+                self.stats["cold_starts"].append(elapsed)
+            else:
+                slot.state = "failed"
+                slot.reason = status + ": " + reason
+                self.stats["failed_loads"] += 1
+                if self.slots.get(slot.name, None) is slot:
+                    del self.slots[slot.name]
+            self.cond.notify_all()
+        if status != "ready":
+            if slot.backend is not None:
+                slot.backend.stop()
+            raise ModelError(slot.name + " " + slot.reason)
+        printerr(slot.name + " ready in " + str(round(elapsed, 2)) + "s")
+
+    def release(self, slot):
+        with self.cond:
+            slot.active -= 1
+            slot.last_used = time.monotonic()
+            self.cond.notify_all()
+
+    def report(self):
+        """Returns a dictionary with counts of requests, loads, failed loads, evictions and queued requests, cold start latencies, and the loaded models."""
+        with self.cond:
+            cold = self.stats["cold_starts"]
+            return {"requests" : self.stats["requests"],
+                    "loads" : self.stats["loads"],
+                    "failed_loads" : self.stats["failed_loads"],
+                    "evictions" : self.stats["evictions"],
+                    "queued" : self.stats["queued"],
+                    "cold_start_s" : {"last" : round(cold[-1], 3) if cold else None,
+                                      "mean" : round(sum(cold) / len(cold), 3) if cold else None,
+                                      "max" : round(max(cold), 3) if cold else None},
+                    "budget_mb" : self.budget_mb,
+                    "used_mb" : self.used(),
+                    "loaded" : [{"name" : slot.name, "state" : slot.state, "vram_mb" : slot.vram_mb, "active" : slot.active, "pinned" : slot.name in self.pinned} for slot in self.slots.values()]}
+
+    def shutdown(self):
+        with self.cond:
+            slots = list(self.slots.values())
+            self.slots = {}
+        for slot in slots:
+            if slot.backend is not None:
+                slot.backend.stop()
+
+class RouterHandler(http.server.BaseHTTPRequestHandler):
+    """Answers OpenAI style requests by passing them on to the backend of the model named in the request. The pool is set on the server."""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def error(self, status, message):
+        self.answer(status, {"error" : {"message" : message, "type" : "invalid_request_error" if status < 500 else "server_error", "code" : status}})
+
+    def do_GET(self):
+        pool = self.server.pool
+        if self.path == "/v1/models":
+            self.answer(200, {"object" : "list", "data" : [{"id" : name, "object" : "model", "owned_by" : "llm-layers"} for name in sorted(pool.models.keys())]})
+        elif self.path in ["/stats", "/health"]:
+            self.answer(200, pool.report() if self.path == "/stats" else {"status" : "ok"})
+        else:
+            self.error(404, "Not found: " + self.path)
+
+    def do_POST(self):
+        pool = self.server.pool
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            # the body can't be skipped without knowing its length
+            self.close_connection = True
+            return self.error(400, "Bad Content-Length.")
+        body = self.rfile.read(length)
+        try:
+            name = json.loads(body.decode("utf-8")).get("model", "")
+        except (ValueError, AttributeError):
+            return self.error(400, "Request body must be a json object.")
+        name = self.server.modelName(name)
+        try:
+            slot = pool.acquire(name)
+        except ModelError as e:
+            return self.error(e.status, str(e))
+        try:
+            self.forward(slot, body)
+        finally:
+            pool.release(slot)
+
+    def forward(self, slot, body):
+        connection = http.client.HTTPConnection(default_host, slot.port, timeout=self.server.pool.timeout)
+        try:
+            headers = {key : value for (key, value) in self.headers.items() if key.lower() not in hop_headers + ["host", "content-length"]}
+            connection.request("POST", self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            self.send_response(response.status)
+            for (key, value) in response.getheaders():
+                if key.lower() not in hop_headers:
+                    self.send_header(key, value)
+            if response.getheader("Content-Length", None) is None:
+                # streamed, e.g. server sent events. Passed on as it comes, ending with the connection
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            while True:
+                chunk = response.read1(65536)
+                if not(chunk):
+                    break
+                self.wfile.write(chunk)
+                self.wfile.flush()
+        except (OSError, http.client.HTTPException) as e:
+            printerr("error: Backend for " + slot.name + " failed: " + str(e))
+            self.close_connection = True
+        finally:
+            connection.close()
+
+class Router(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pool):
+        super().__init__(address, RouterHandler)
+        self.pool = pool
+
+    def modelName(self, name):
+        """Model names may be given without the .gguf extension."""
+        if name not in self.pool.models and name + ".gguf" in self.pool.models:
+            return name + ".gguf"
+        return name
+
+def loadModels(layers_file, model_directory):
+    """Returns a dictionary mapping names to pairs (model, row) for all models in model_directory, with their layers file row or None."""
+    rows = LayersFile.read(layers_file) if os.path.isfile(layers_file) else LayersFile()
+    return {model["name"] : (model, rows.get(model["name"]) if model["name"] in rows else None) for model in scanModels(model_directory)}
+
+def main(argv):
+    from llm_layers.generate import megabyteIntFromVRamString
+    parser = argparse.ArgumentParser(prog="llm-layers serve", description="Serve many models behind one OpenAI compatible endpoint. A model's backend is started on its first request, with the settings from the layers file, and requests wait while it loads. When the vram budget is exhausted, the least recently used idle model is stopped. GET /stats reports loads, evictions and cold start latency.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    addBackendArguments(parser)
+    parser.add_argument("--host", type=str, default=default_host, help="Host to listen on.")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on.")
+    parser.add_argument("-V", "--vram", type=str, default="", help="Vram budget for all models together. By default, vram is determined from hardware.")
+    parser.add_argument("-r", "--reserve", type=str, default="0mb", help="Vram that is spoken for by other programs.")
+    parser.add_argument("--pin", action="append", default=[], help="Model that is never evicted once loaded. Can be given multiple times.")
+    parser.add_argument("--preload", action="append", default=[], help="Model to start right away instead of on its first request. Can be given multiple times.")
+    parser.add_argument("--prefetch", action=argparse.BooleanOptionalAction, default=None, help="Read a model into the page cache with several threads while its backend starts. By default, this only happens if the model fits into available memory and the backend maps it, i.e. not with --no-mmap or --mlock.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for a backend to load, and for it to answer.")
+    args = parser.parse_args(argv)
+    checkLogArguments(args.additional_arguments)
+
+    try:
+        budget = (megabyteIntFromVRamString(args.vram) if args.vram else get_total_vram_mb()) - megabyteIntFromVRamString(args.reserve)
+    except ValueError as e:
+        printerr("error: " + str(e))
+        sys.exit(1)
+    if budget <= 0:
+        printerr("error: Need a positive vram budget. Please specify it with e.g. '-V 12gb'.")
+        sys.exit(1)
+    models = loadModels(os.path.expanduser(args.layers_file), os.path.expanduser(args.model_directory))
+    logdir = os.path.expanduser(args.log_directory)
+    executable = os.path.expanduser(args.executable)
+    def makeBackend(name, model, row, port):
+        gpu_layers = settingOrDefault(row, "gpu_layers", "LLM_LAYERS", 1)
+        context = settingOrDefault(row, "context", "LLM_MAX_CONTEXT_LENGTH", 2048)
+        cmd = backendCommand(executable, model["file"], gpu_layers, context, mmproj=model["mmproj"], additional_arguments=args.additional_arguments, host=default_host, port=port, tensor_split=row.get("tensor_split", "") if row else "", main_gpu=row.get("main_gpu", "") if row else "", memory=row.get("memory", "") if row else "")
+        prefetchForBackend(model["shards"], cmd, force=args.prefetch, report=printerr)
+        return Backend(name, cmd, logdir, host=default_host, port=port)
+
+    pool = ModelPool(models, budget, makeBackend, pinned=args.pin, timeout=args.timeout)
+    router = Router((args.host, args.port), pool)
+    printerr("Serving " + str(len(models)) + " models with " + str(budget) + "MB of vram on http://" + args.host + ":" + str(args.port) + "/v1")
+    for name in args.preload:
+        try:
+            pool.release(pool.acquire(router.modelName(name)))
+        except ModelError as e:
+            printerr("error: Could not preload " + name + ": " + str(e))
+    try:
+        router.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        router.server_close()
+        pool.shutdown()
+        report = pool.report()
+        printerr("Served " + str(report["requests"]) + " requests with " + str(report["loads"]) + " loads and " + str(report["evictions"]) + " evictions.")
@@ -0,0 +1,228 @@
+import os, sys, json, time, shutil, hashlib, argparse, threading, subprocess, http.client, urllib.request, urllib.error
+from llm_layers.layers import LayersFile, printerr, get_devices
+from llm_layers.launch import Backend, backendCommand, findModel, settingOrDefault, addBackendArguments, splitExtra, default_host, freePort
+from llm_layers.fit import modelEstimate, ALL_LAYERS, context_step
+from llm_layers.cache import JsonCache, getCacheDir
+
+# the same prompt every time, so numbers are comparable between runs
+tune_prompt = "Below is a list of the planets of the solar system, ordered by their distance to the sun, with a short description of each one.\n\n1. Mercury:"
+tune_predict = 64
+
+# columns written to the layers file along with gpu_layers and context
+tune_fields = "tuned_load_s tuned_pp_tps tuned_tg_tps tuned_vram_mb".split(" ")
+
+def hardwareFingerprint(devices=None):
+    """Returns a string identifying the GPUs of this machine, by name and total memory."""
+    if devices is None:
+        devices = get_devices()
+    if devices == []:
+        return "cpu"
+    return ",".join([d["name"] + "/" + str(d["total_mb"]) for d in devices])
+
+def backendVersion(executable):
+    """Returns a string identifying the version of the backend, from its --version output. Falls back to the executable's size and mtime if it has no such option."""
+    try:
+        p = subprocess.run([executable, "--version"], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=10)
+        lines = [line for line in p.stdout.decode("utf-8", errors="replace").split("\n") if "version" in line.lower()]
+        if p.returncode == 0 and lines != []:
+            return lines[0].strip()
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+    path = executable if os.path.isfile(executable) else shutil.which(executable)
+    if path is None:
+        return "unknown"
+    st = os.stat(path)
+    return "size " + str(st.st_size) + " mtime " + str(st.st_mtime_ns)
+
+def tuneKey(model, fingerprint, version, settings):
+    """Cache key for the tuning result of model, a scanned model dictionary, on hardware fingerprint with backend version. settings is a string with everything else that affects the result, like context and backend arguments."""
+    st = os.stat(model["file"])
+    w = "\n".join([os.path.abspath(model["file"]), str(st.st_size), str(st.st_mtime_ns), fingerprint, version, settings])
+    return hashlib.sha256(w.encode("utf-8")).hexdigest()
+
+class MemorySampler(object):
+    """Samples device memory in a background thread while a trial runs. peak_mb is the largest drop in free vram, summed over devices, compared to before the trial."""
+    def __init__(self, probe=get_devices, interval=0.2):
+        self.probe = probe
+        self.interval = interval
+        self.peak_mb = 0
+        self.stopped = threading.Event()
+        self.baseline = {d["index"] : d["free_mb"] for d in probe()}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not(self.stopped.is_set()):
+            used = sum([self.baseline.get(d["index"], d["free_mb"]) - d["free_mb"] for d in self.probe()])
+            self.peak_mb = max(self.peak_mb, used)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+def peakRssMb(pid):
+    """Returns the peak resident memory of process pid in MB, or 0 if unknown."""
+    try:
+        for line in open("/proc/" + str(pid) + "/status", "r"):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) // 1000
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+def complete(host, port, prompt, n_predict, timeout):
+    """Sends prompt to the llama.cpp style /completion endpoint. Returns a pair (pp, tg) of prompt processing and generation speed in tokens per second."""
+    body = json.dumps({"prompt" : prompt, "n_predict" : n_predict, "cache_prompt" : False}).encode("utf-8")
+    request = urllib.request.Request("http://" + host + ":" + str(port) + "/completion", data=body, headers={"Content-Type" : "application/json"})
+    start = time.monotonic()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        result = json.loads(response.read().decode("utf-8"))
+    elapsed = time.monotonic() - start
+    timings = result.get("timings", {})
+    pp = timings.get("prompt_per_second", 0.0)
+    # without timings, the wall clock is all we have
+    tg = timings.get("predicted_per_second", result.get("tokens_predicted", n_predict) / elapsed)
+    return (pp, tg)
+
+def trial(model, gpu_layers, context, args, extra=[]):
+    """Starts the backend with gpu_layers and context, sends it the tune prompt and stops it again. Returns a dictionary with keys gpu_layers, context, ok, reason, load_s, pp_tps, tg_tps and vram_mb."""
+    port = args.port or freePort()
+    cmd = backendCommand(os.path.expanduser(args.executable), model["file"], gpu_layers, context, mmproj=model["mmproj"], additional_arguments=args.additional_arguments, host=default_host, port=port, extra=extra)
+    backend = Backend(model["name"] + ".tune", cmd, os.path.expanduser(args.log_directory), host=default_host, port=port)
+    result = {"gpu_layers" : gpu_layers, "context" : context, "ok" : False, "reason" : "", "load_s" : 0, "pp_tps" : 0, "tg_tps" : 0, "vram_mb" : 0}
+    sampler = MemorySampler().start()
+    try:
+        backend.start()
+        status = backend.waitReady(timeout=args.timeout)
+        if status != "ready":
+            result["reason"] = status + ": " + backend.reason
+            return result
+        result["load_s"] = round(backend.time_to_ready, 2)
+        (pp, tg) = complete(default_host, port, tune_prompt, tune_predict, args.timeout)
+        # the backend may have run out of memory while generating
+        if backend.poll() == "failed":
+            result["reason"] = "failed: " + backend.reason
+            return result
+        result.update({"ok" : True, "pp_tps" : round(pp, 2), "tg_tps" : round(tg, 2), "vram_mb" : sampler.peak_mb})
+        if sampler.peak_mb == 0:
+            # no vram numbers, so this is at least something
+            result["vram_mb"] = peakRssMb(backend.process.pid)
+        return result
+    except OSError as e:
+        result["reason"] = "failed: " + str(e)
+        return result
+    except (ValueError, http.client.HTTPException):
+        # not json, or cut off, which a backend dying halfway through an answer does
+        result["reason"] = "failed: bad response"
+        return result
+    finally:
+        sampler.stop()
+        backend.stop()
+
+def tuneModel(model, context, args, extra=[], max_context=0, report=printerr):
+    """Finds the largest gpu_layers that the backend survives at context by binary search, treating crashes and out of memory errors as upper bounds. With max_context, the largest context up to that is searched for afterwards, at the found gpu_layers.
+    Returns a pair (best, trials), where best is the fastest successful trial (see trial) at the largest context that worked, or None, and trials is a list of all of them. Without max_context, all trials share one context, so best is simply the fastest. With it, the larger context is what was asked for and wins over the few percent of speed a smaller one gains."""
+    estimate = modelEstimate(model["facts"], size=os.path.getsize(model["file"]) if model["facts"] is None else None)
+    total = estimate["block_count"] + 1
+    trials = []
+    def run(layers, ctx):
+        t = trial(model, ALL_LAYERS if layers >= total else layers, ctx, args, extra=extra)
+        trials.append(t)
+        if t["ok"]:
+            report("  -ngl " + str(t["gpu_layers"]) + " -c " + str(ctx) + ": loaded in " + str(t["load_s"]) + "s, " + str(t["pp_tps"]) + " t/s prompt, " + str(t["tg_tps"]) + " t/s generation, " + str(t["vram_mb"]) + "MB")
+        else:
+            report("  -ngl " + str(t["gpu_layers"]) + " -c " + str(ctx) + ": " + t["reason"])
+        return t["ok"]
+
+    # the common case is that everything fits, so that's tried first
+    if not(run(total, context)):
+        lo = -1
+        hi = total
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if run(mid, context):
+                lo = mid
+            else:
+                hi = mid
+        if lo < 0:
+            return (None, trials)
+        layers = lo
+    else:
+        layers = total
+
+    if max_context > context:
+        lo = context // context_step
+        hi = max_context // context_step + 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if run(layers, mid * context_step):
+                lo = mid
+            else:
+                hi = mid
+
+    ok = [t for t in trials if t["ok"]]
+    # largest context first, then speed
+    best = max(ok, key=lambda t: (int(t["context"]), t["tg_tps"], t["pp_tps"]))
+    return (best, trials)
+
+def applyTuning(lf, model, best):
+    """Writes the result of tuneModel into the LayersFile lf, adding a row for model if it has none. Returns lf."""
+    if model["name"] not in lf:
+        lf.merge([model], "filesystem")
+    lf.set(model["name"], "gpu_layers", best["gpu_layers"])
+    lf.set(model["name"], "context", best["context"])
+    for field in tune_fields:
+        lf.set(model["name"], field, best[field[len("tuned_"):]])
+    return lf
+
+def getTuneCache():
+    return JsonCache(getCacheDir() + "/tune.json")
+
+def main(argv):
+    from llm_layers.generate import writeLayersConfig
+    parser = argparse.ArgumentParser(prog="llm-layers tune", description="Find the best gpu_layers for a model by actually starting the backend with different -ngl values and measuring it. The result is written to the layers file, along with load time, prompt processing and generation speed, and peak memory.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("model", help="Name of the model in the layers file, or path to a gguf file.")
+    addBackendArguments(parser)
+    parser.add_argument("-c", "--context", type=int, default=0, help="Context to tune at. Defaults to the context in the layers file.")
+    parser.add_argument("--max_context", type=int, default=0, help="After finding gpu_layers, also search for the largest context up to this that still works.")
+    parser.add_argument("--port", type=int, default=None, help="Port for the backend. By default, a free one is picked.")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for the backend to load or to answer.")
+    parser.add_argument("--force", action=argparse.BooleanOptionalAction, default=False, help="Tune even if there is a cached result for this model, hardware and backend version.")
+    parser.add_argument("--dry", action=argparse.BooleanOptionalAction, default=False, help="Only report the result, don't write it to the layers file.")
+    parser.epilog = "Arguments after -- are passed on to the backend."
+    (argv, extra) = splitExtra(argv)
+    args = parser.parse_args(argv)
+
+    layersfile = os.path.expanduser(args.layers_file)
+    (model, row) = findModel(args.model, layersfile, os.path.expanduser(args.model_directory))
+    if model is None:
+        printerr("error: Could not find a gguf file for " + args.model + " in " + args.model_directory)
+        sys.exit(1)
+    context = args.context if args.context else int(settingOrDefault(row, "context", "LLM_MAX_CONTEXT_LENGTH", 2048))
+
+    cache = getTuneCache()
+    key = tuneKey(model, hardwareFingerprint(), backendVersion(os.path.expanduser(args.executable)), str(context) + "-" + str(args.max_context) + " " + args.additional_arguments + " " + " ".join(extra))
+    best = None if args.force else cache.get(key)
+    if best is not None:
+        printerr("Using cached result for " + model["name"] + ", nothing changed since it was tuned. Use --force to tune again.")
+    else:
+        printerr("Tuning " + model["name"] + " at context " + str(context))
+        (best, trials) = tuneModel(model, context, args, extra=extra, max_context=args.max_context)
+        if best is None:
+            printerr("error: " + model["name"] + " didn't run with any number of layers. See the logs in " + args.log_directory)
+            sys.exit(1)
+        cache.put(key, best)
+        cache.save()
+
+    print(model["name"] + ": gpu_layers " + str(best["gpu_layers"]) + ", context " + str(best["context"]) + ", " + str(best["tg_tps"]) + " t/s generation, " + str(best["pp_tps"]) + " t/s prompt, loaded in " + str(best["load_s"]) + "s, " + str(best["vram_mb"]) + "MB")
+    if args.dry:
+        return
+    lf = LayersFile.read(layersfile) if os.path.isfile(layersfile) else LayersFile()
+    if writeLayersConfig(layersfile, applyTuning(lf, model, best), cmd="llm-layers tune " + " ".join(argv)):
+        printerr("error: Could not write " + layersfile)
+        sys.exit(1)
+    printerr("Wrote " + layersfile)
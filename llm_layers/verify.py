@@ -0,0 +1,257 @@
+import os, re, sys, mmap, hashlib
+from llm_layers.cache import JsonCache, getCacheDir, getResolutionCache, printerr
+from llm_layers.profile import count, getProfiler
+
+hash_chunk_bytes = 64 * 2**20
+sha256_pattern = re.compile(r"^[0-9a-f]{64}$")
+
+def fileSha256(path, chunk=hash_chunk_bytes):
+    """Returns the sha256 hex digest of the file at path. The file is memory mapped and hashed in large slices, so nothing is copied through read buffers, and hashlib releases the GIL while it works on them."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return h.hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(buf, "madvise"):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(buf)
+            try:
+                for offset in range(0, size, chunk):
+                    h.update(view[offset:offset+chunk])
+            finally:
+                view.release()
+    return h.hexdigest()
+
+def getHashCache():
+    return JsonCache(getCacheDir() + "/sha256.json")
+
+def cachedSha256(path, cache):
+    """Returns the sha256 of path from cache if the file hasn't changed since it was hashed, None otherwise. Files are keyed by their real path, so a snapshot file and its blob share an entry."""
+    real = os.path.realpath(path)
+    st = os.stat(real)
+    cached = cache.get(real)
+    if cached is not None and cached["mtime"] == st.st_mtime_ns and cached["size"] == st.st_size:
+        return cached["sha256"]
+    return None
+
+def hashFiles(paths, jobs=None, cache=None):
+    """Returns a dictionary mapping each of paths to its sha256, or to None if it can't be read. Hashes are cached by path, mtime and size. The rest is hashed on a pool of jobs threads, by default one per cpu, biggest files first, so the pool isn't left waiting on one huge file at the end. Threads suffice since hashlib releases the GIL, and unlike forked processes they are safe to start from the download scheduler's worker threads. Call save() on the cache to persist the hashes."""
+    if cache is None:
+        cache = getHashCache()
+    hashes = {}
+    todo = {}
+    for path in dict.fromkeys(paths):
+        try:
+            sha = cachedSha256(path, cache)
+        except OSError:
+            hashes[path] = None
+            continue
+        if sha is not None:
+            hashes[path] = sha
+        else:
+            todo.setdefault(os.path.realpath(path), []).append(path)
+    if todo != {}:
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+        reals = sorted(todo.keys(), key=lambda real: os.stat(real).st_size, reverse=True)
+        with ThreadPoolExecutor(jobs or os.cpu_count() or 1) as pool:
+            futures = {pool.submit(fileSha256, real) : (real, os.stat(real)) for real in reals}
+            for future in as_completed(futures):
+                (real, st) = futures[future]
+                try:
+                    sha = future.result()
+                except OSError:
+                    sha = None
+                else:
+                    cache.put(real, {"mtime" : st.st_mtime_ns, "size" : st.st_size, "sha256" : sha})
+                    count("files hashed")
+                    count("bytes hashed", st.st_size)
+                for path in todo[real]:
+                    hashes[path] = sha
+    getProfiler().cache("sha256", cache)
+    return hashes
+
+def blobSha256(path):
+    """Returns the sha256 that huggingface_hub expects the file at path to have, if path is a file in a huggingface cache snapshot. Large files are stored as blobs named after the lfs sha256 the hub gave for them when they were downloaded. None otherwise."""
+    real = os.path.realpath(path)
+    name = os.path.basename(real)
+    if os.path.basename(os.path.dirname(real)) == "blobs" and sha256_pattern.match(name):
+        return name
+    return None
+
+def expectedHashes(model, resolutions=None):
+    """Returns a dictionary mapping each file of model, a scanned model dictionary, to a pair (size, sha256) of what the hub says it should be. The blob name in the huggingface cache is asked first, since it belongs to the repository the file actually came from, then the resolution cache. size may be None, files nobody knows anything about are left out."""
+    if resolutions is None:
+        resolutions = getResolutionCache()
+    entry = resolutions.lookup(model["name"], offline=True)
+    expected = {}
+    for file in model["shards"]:
+        name = os.path.basename(file)
+        (size, sha) = (None, None)
+        if entry is not None and entry["repo"]:
+            if entry.get("shards", None):
+                info = entry["shards"].get(name, {})
+                (size, sha) = (info.get("size", None), info.get("sha256", None))
+            elif name == model["name"]:
+                (size, sha) = (entry["size"], entry["sha256"])
+        blob = blobSha256(file)
+        if blob is not None:
+            if blob != sha:
+                # the resolution is for some other repository's copy
+                size = None
+            sha = blob
+        if sha is not None:
+            expected[file] = (size, sha)
+    return expected
+
+def verifyModels(models, jobs=None, cache=None, resolutions=None):
+    """Checks the files of models, a list of scanned model dictionaries, against the sizes and lfs sha256 the hub has for them. Sizes are compared first, which catches truncated files without reading them.
+    Returns a list of dictionaries with keys name, file, status and problems, one per model. status is 'ok', 'corrupt' or 'unverified' if nothing is known about the files, and problems is a list of pairs (file, reason)."""
+    results = []
+    checks = {}
+    for model in models:
+        result = {"name" : model["name"], "file" : model["file"], "status" : "unverified", "problems" : [], "checks" : []}
+        expected = expectedHashes(model, resolutions)
+        for file in model["shards"]:
+            if file not in expected:
+                continue
+            (size, sha) = expected[file]
+            result["status"] = "ok"
+            try:
+                actual = os.path.getsize(file)
+            except OSError:
+                result["problems"].append((file, "missing"))
+                continue
+            if size is not None and actual != size:
+                result["problems"].append((file, ("truncated, " if actual < size else "") + "has " + str(actual) + " bytes instead of " + str(size)))
+                continue
+            result["checks"].append((file, sha))
+            checks[file] = sha
+        results.append(result)
+
+    hashes = hashFiles(list(checks.keys()), jobs=jobs, cache=cache)
+    for result in results:
+        for (file, sha) in result.pop("checks"):
+            if hashes[file] is None:
+                result["problems"].append((file, "unreadable"))
+            elif hashes[file] != sha:
+                result["problems"].append((file, "sha256 is " + hashes[file] + " instead of " + sha))
+        if result["problems"] != []:
+            result["status"] = "corrupt"
+    count("models verified", len([r for r in results if r["status"] != "unverified"]))
+    count("models corrupt", len([r for r in results if r["status"] == "corrupt"]))
+    return results
+
+def removeFile(path):
+    """Removes path and, if it's a link into the huggingface cache, the blob behind it, so the next download fetches it again."""
+    real = os.path.realpath(path)
+    for p in dict.fromkeys([path, real]):
+        try:
+            os.remove(p)
+        except FileNotFoundError:
+            pass
+
+def findDuplicates(paths, jobs=None, cache=None):
+    """Returns a list of groups of files with identical contents, among paths. Symlinks are followed, so a snapshot file counts as the blob behind it, and files that are already hardlinked count once. Only files with the same size on the same filesystem are hashed, since only those can be linked."""
+    files = {}
+    for path in paths:
+        try:
+            real = os.path.realpath(path)
+            st = os.stat(real)
+        except OSError:
+            continue
+        files.setdefault((st.st_dev, st.st_ino), (real, st))
+    bySize = {}
+    for (real, st) in files.values():
+        if st.st_size > 0:
+            bySize.setdefault((st.st_dev, st.st_size), []).append(real)
+    candidates = [real for group in bySize.values() if len(group) > 1 for real in group]
+    hashes = hashFiles(candidates, jobs=jobs, cache=cache)
+    groups = {}
+    for (key, group) in bySize.items():
+        for real in group:
+            if len(group) > 1 and hashes[real] is not None:
+                groups.setdefault(key + (hashes[real],), []).append(real)
+    return [sorted(group) for group in groups.values() if len(group) > 1]
+
+def linkDuplicates(groups, cache=None, dry=False, report=printerr):
+    """Replaces all but one file of every group from findDuplicates with a hardlink to the one that is kept, which is the one with the most links already. Files that changed since they were hashed are left alone. Returns the number of bytes freed."""
+    if cache is None:
+        cache = getHashCache()
+    freed = 0
+    for group in groups:
+        keep = max(group, key=lambda path: os.stat(path).st_nlink)
+        sha = cachedSha256(keep, cache)
+        for path in group:
+            if path == keep:
+                continue
+            st = os.stat(path)
+            if sha is None or cachedSha256(path, cache) != sha:
+                report("warning: " + path + " changed since it was hashed, not linking it.")
+                continue
+            report(("Would link " if dry else "Linking ") + path + " to " + keep)
+            if dry:
+                freed += st.st_size if st.st_nlink == 1 else 0
+                continue
+            # the rename is atomic, so there is never a moment without the file
+            tmp = path + ".llm-layers-link"
+            os.link(keep, tmp)
+            os.replace(tmp, path)
+            kept = os.stat(keep)
+            cache.put(path, {"mtime" : kept.st_mtime_ns, "size" : kept.st_size, "sha256" : sha})
+            freed += st.st_size if st.st_nlink == 1 else 0
+    count("bytes deduplicated", freed)
+    return freed
+
+def formatProblems(result):
+    return "; ".join([os.path.basename(file) + " " + reason for (file, reason) in result["problems"]])
+
+def main(argv):
+    import argparse
+    from llm_layers.launch import findModel
+    from llm_layers.layers import getLayersFile
+    from llm_layers.scan import scanModels
+    parser = argparse.ArgumentParser(prog="llm-layers verify", description="Check downloaded models against the sizes and sha256 sums the huggingface hub has for them, and with --dedup, replace identical copies of a model in different repositories with hardlinks. Hashes are cached, so only new or changed files are read.", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("models", nargs="*", help="Names of models, or paths to gguf files. By default, all models in the model directory are checked.")
+    parser.add_argument("--model_directory", type=str, default="~/.cache/huggingface", help="Directory with the gguf files.")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="Number of threads hashing in parallel. Defaults to the number of cpus.")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=False, help="Find byte-identical gguf files in the model directory and replace all but one with hardlinks. Try it with --dry first.")
+    parser.add_argument("--remove", action=argparse.BooleanOptionalAction, default=False, help="Delete the files of corrupt models, so the next llm-layers run downloads them again.")
+    parser.add_argument("--dry", action=argparse.BooleanOptionalAction, default=False, help="Only report what would be linked or removed.")
+    args = parser.parse_args(argv)
+    mdir = os.path.expanduser(args.model_directory)
+
+    if args.models == []:
+        models = scanModels(mdir)
+    else:
+        models = []
+        for name in args.models:
+            (model, row) = findModel(name, getLayersFile(), mdir)
+            if model is None:
+                printerr("error: Could not find a gguf file for " + name + " in " + args.model_directory)
+                continue
+            models.append(model)
+
+    cache = getHashCache()
+    try:
+        results = verifyModels(models, jobs=args.jobs, cache=cache)
+        for result in results:
+            print(result["name"] + ": " + result["status"] + (", " + formatProblems(result) if result["problems"] != [] else ""))
+        corrupt = [result for result in results if result["status"] == "corrupt"]
+        if args.remove:
+            for model in [model for model in models if model["name"] in [result["name"] for result in corrupt]]:
+                for file in model["shards"]:
+                    printerr(("Would remove " if args.dry else "Removing ") + file)
+                    if not(args.dry):
+                        removeFile(file)
+
+        if args.dedup:
+            paths = [file for model in models for file in model["shards"] if model["name"] not in [result["name"] for result in corrupt]]
+            freed = linkDuplicates(findDuplicates(paths, jobs=args.jobs, cache=cache), cache=cache, dry=args.dry)
+            if freed:
+                printerr(("Would free " if args.dry else "Freed ") + str(round(freed / 1e6)) + "MB by linking identical files.")
+    finally:
+        cache.save()
+    printerr(str(len([r for r in results if r["status"] == "ok"])) + " ok, " + str(len(corrupt)) + " corrupt, " + str(len([r for r in results if r["status"] == "unverified"])) + " unverified.")
+    if corrupt != []:
+        sys.exit(1)
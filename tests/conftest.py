@@ -0,0 +1,35 @@
+import os, sys, shlex, socket
+import pytest
+
+stub_server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stub_server.py")
+
+@pytest.fixture
+def stubExecutable(tmp_path):
+    """Returns the path of an executable running tests/stub_server.py, which stands in for the llama.cpp server."""
+    path = tmp_path / "server"
+    path.write_text("#!/bin/sh\nexec " + shlex.quote(sys.executable) + " " + shlex.quote(stub_server) + " \"$@\"\n")
+    path.chmod(0o755)
+    return str(path)
+
+@pytest.fixture
+def port():
+    """Returns a port on 127.0.0.1 that nothing listens on right now."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def makeModel():
+    """Returns a function making a scanned model dictionary (see llm_layers.scan.scanModels) for a model of block_count blocks of layer_mb each, with gguf facts like llm_layers.gguf.ggufFacts returns them. The file doesn't exist."""
+    def makeModel(block_count=32, layer_mb=200, context_length=8192, name="test.gguf"):
+        facts = {"block_count" : block_count,
+                 "layer_bytes" : [layer_mb * 10**6] * block_count,
+                 "other_bytes" : 500 * 10**6,
+                 "output_bytes" : 250 * 10**6,
+                 "embedding_length" : 4096,
+                 "head_count" : 32,
+                 "head_count_kv" : 8,
+                 "context_length" : context_length,
+                 "size" : (block_count * layer_mb + 500) * 10**6}
+        return {"name" : name, "file" : "/nonexistent/" + name, "mmproj" : "", "facts" : facts}
+    return makeModel
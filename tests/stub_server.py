@@ -0,0 +1,68 @@
+"""Stands in for the llama.cpp server in tests. Takes the same -m, -c, -ngl, --host and --port arguments, ignores the rest, and answers /health, /completion and the OpenAI style /v1 endpoints. The environment changes how it behaves:
+STUB_MAX_LAYERS: with more -ngl than this, it runs out of memory while loading and exits.
+STUB_DELAY: seconds to load before listening.
+STUB_COMPLETION: 'garbage' answers /completion with something that isn't json.
+STUB_STATUS: http status of the /v1 answers, 200 by default."""
+import os, sys, json, time, argparse, http.server
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-m", "--model", default="")
+parser.add_argument("-c", "--ctx-size", default="2048")
+parser.add_argument("-ngl", "--n-gpu-layers", default="0")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8080)
+(args, rest) = parser.parse_known_args()
+
+if int(args.n_gpu_layers) > int(os.environ.get("STUB_MAX_LAYERS", "999999")):
+    sys.stderr.write("CUDA error: out of memory\n")
+    sys.exit(1)
+time.sleep(float(os.environ.get("STUB_DELAY", "0")))
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def answer(self, status, data, content_type="application/json"):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.answer(200, {"status" : "ok"})
+        else:
+            self.answer(404, {"error" : "not found"})
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        if self.path == "/completion":
+            if os.environ.get("STUB_COMPLETION", "") == "garbage":
+                return self.answer(200, b"<html>oops", content_type="text/html")
+            return self.answer(200, {"content" : "x" * request.get("n_predict", 1), "tokens_predicted" : request.get("n_predict", 1),
+                                     "timings" : {"prompt_per_second" : 1000.0 / (1 + int(args.ctx_size) // 1024), "predicted_per_second" : 10.0 + int(args.n_gpu_layers) % 1000}})
+        status = int(os.environ.get("STUB_STATUS", "200"))
+        if status != 200:
+            return self.answer(status, {"error" : {"message" : "stub failure", "code" : status}})
+        # echoes what arrived, so tests can see what was passed on
+        reply = {"model" : os.path.basename(args.model), "path" : self.path, "request" : request, "headers" : {key.lower() : value for (key, value) in self.headers.items()}}
+        if not(request.get("stream", False)):
+            return self.answer(200, reply)
+        # server sent events without a length, ending with the connection, like llama.cpp streams
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, 3):
+            self.wfile.write(("data: " + json.dumps({"model" : reply["model"], "chunk" : i}) + "\n\n").encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+server = http.server.ThreadingHTTPServer((args.host, args.port), Handler)
+print("main: server is listening on http://" + args.host + ":" + str(args.port), flush=True)
+server.serve_forever()
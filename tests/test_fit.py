@@ -0,0 +1,43 @@
+from llm_layers.fit import fitModel, fitDevices, deviceLayers, modelEstimate, vramNeeded, effectiveVramMb, fixed_overhead_bytes, ALL_LAYERS
+
+def test_no_vram(makeModel):
+    facts = makeModel()["facts"]
+    assert fitModel(facts, 0) == (0, 2048)
+    assert fitDevices(facts, [0, 0])["gpu_layers"] == 0
+
+def test_everything_fits(makeModel):
+    facts = makeModel()["facts"]
+    assert fitModel(facts, 48000, context=2048, max_context=8192) == (ALL_LAYERS, 8192)
+    fitted = fitDevices(facts, [24000, 24000], context=2048, max_context=8192)
+    assert fitted["gpu_layers"] == ALL_LAYERS
+    assert fitted["context"] == 8192
+    assert sum([int(n) for n in fitted["tensor_split"].split(",")]) == 32
+
+def test_context_capped_by_training(makeModel):
+    assert fitModel(makeModel(context_length=4096)["facts"], 48000, context=2048, max_context=32768) == (ALL_LAYERS, 4096)
+
+def test_partial_offload(makeModel):
+    facts = makeModel()["facts"]
+    (layers, context) = fitModel(facts, 4000, context=2048)
+    assert context == 2048
+    assert 0 < layers < 32
+    assert vramNeeded(modelEstimate(facts), layers, 2048) <= 4000 * 10**6
+    assert vramNeeded(modelEstimate(facts), layers + 1, 2048) > 4000 * 10**6
+
+def test_devices_main_gpu(makeModel):
+    fitted = fitDevices(makeModel()["facts"], [2000, 4000], context=2048)
+    assert fitted["main_gpu"] == 1
+    counts = [int(n) for n in fitted["tensor_split"].split(",")]
+    assert fitted["gpu_layers"] == sum(counts) < 32
+    assert counts[1] > counts[0] > 0
+
+def test_device_layers_contiguous(makeModel):
+    estimate = modelEstimate(makeModel()["facts"])
+    (counts, output) = deviceLayers(estimate, [10**12, 10**12], 2048)
+    # the first device takes everything it can before the next one gets any
+    assert counts == [32, 0]
+    assert output
+
+def test_effective_vram():
+    assert effectiveVramMb([8000]) == 8000
+    assert effectiveVramMb([8000, 8000]) == 16000 - fixed_overhead_bytes // 10**6
@@ -0,0 +1,140 @@
+import pytest
+from llm_layers import launch
+from llm_layers.launch import adaptToFreeVram, freeVramMb, backendCommand, splitExtra, Backend
+from llm_layers.fit import modelEstimate, vramNeeded, splitNeeded, ALL_LAYERS, context_step
+
+def test_backend_command():
+    argv = backendCommand("server", "m.gguf", 999, 4096, mmproj="p.gguf", additional_arguments="-fa --parallel 1", port=9000, extra=["--foo"])
+    assert argv[:7] == ["server", "-c", "4096", "-m", "m.gguf", "-ngl", "999"]
+    assert argv[7:9] == ["--mmproj", "p.gguf"]
+    assert "--host" not in argv
+    assert argv[-3:] == ["--port", "9000", "--foo"]
+
+def test_backend_command_tensor_split():
+    argv = backendCommand("server", "m.gguf", 999, 4096, tensor_split="10,20", main_gpu="1")
+    assert argv[7:] == ["--tensor-split", "10,20", "--main-gpu", "1"]
+    assert backendCommand("server", "m.gguf", 999, 4096, tensor_split="10,20")[-1] == "0"
+
+def test_backend_command_memory():
+    argv = backendCommand("server", "m.gguf", 999, 4096, additional_arguments="-fa --mlock", memory="no-mmap")
+    # the memory strategy replaces the memory options of additional_arguments
+    assert "--mlock" not in argv and "--no-mmap" in argv and "-fa" in argv
+
+def test_split_extra():
+    assert splitExtra(["m", "--wait", "--", "-t", "8"]) == (["m", "--wait"], ["-t", "8"])
+    assert splitExtra(["m"]) == (["m"], [])
+
+def runBackend(tmp_path, script, timeout=10):
+    (tmp_path / "backend.sh").write_text(script + "\n")
+    backend = Backend("test", ["sh", str(tmp_path / "backend.sh")], str(tmp_path / "logs"), health=False)
+    try:
+        return (backend.start().waitReady(timeout=timeout, interval=0.05), backend)
+    finally:
+        backend.stop()
+
+def test_backend_ready(tmp_path):
+    (status, backend) = runBackend(tmp_path, "echo 'main: server is listening on 127.0.0.1:8080'; sleep 30")
+    assert status == "ready"
+    assert backend.time_to_ready is not None
+    assert not(backend.alive())
+    with open(backend.logs[1]) as f:
+        log = f.read()
+    assert log.startswith("# llm-layers run model=unknown")
+    assert "# llm-layers ready load_s=" in log
+
+def test_backend_failed(tmp_path):
+    (status, backend) = runBackend(tmp_path, "echo 'CUDA error: out of memory' >&2; sleep 30")
+    assert status == "failed"
+    assert backend.reason == "CUDA error: out of memory"
+    (status, backend) = runBackend(tmp_path, "exit 3")
+    assert status == "failed"
+    assert backend.reason == "exited with code 3"
+    # the logs of the first run were kept
+    assert (tmp_path / "logs" / "test.2.log.1").is_file()
+
+def test_backend_timeout(tmp_path):
+    (status, backend) = runBackend(tmp_path, "sleep 30", timeout=0.3)
+    assert status == "timeout"
+
+def test_backend_health(tmp_path, stubExecutable, port):
+    argv = backendCommand(stubExecutable, "m.gguf", 10, 2048, host="127.0.0.1", port=port)
+    backend = Backend("test", argv, str(tmp_path / "logs"), port=port)
+    try:
+        assert backend.start().waitReady(timeout=10, interval=0.05) == "ready"
+    finally:
+        backend.stop()
+    assert not(backend.alive())
+
+def neededMb(model, layers, context):
+    return vramNeeded(modelEstimate(model["facts"]), layers, context) / 1e6
+
+def test_no_gpu():
+    assert freeVramMb(probe=lambda: []) is None
+    assert freeVramMb(probe=lambda: [{"free_mb" : 1000}, {"free_mb" : 2000}]) == [1000, 2000]
+
+def test_everything_fits(makeModel):
+    model = makeModel()
+    assert adaptToFreeVram(model, ALL_LAYERS, 4096, 24000) == (ALL_LAYERS, 4096, "")
+    assert adaptToFreeVram(model, ALL_LAYERS, 4096, [12000, 12000]) == (ALL_LAYERS, 4096, "")
+
+def test_gives_up_layers(makeModel):
+    model = makeModel()
+    (layers, context, reason) = adaptToFreeVram(model, ALL_LAYERS, 4096, 4000, margin_mb=500)
+    assert context == 4096
+    assert 0 < layers < 32
+    assert neededMb(model, layers, context) <= 3500
+    assert neededMb(model, layers + 1, context) > 3500
+    assert reason.startswith("gpu_layers 999 -> " + str(layers))
+
+def test_shrinks_context_first(makeModel):
+    model = makeModel()
+    # all layers fit at a small context, but not at 4096
+    free = round(neededMb(model, 33, 1024)) + 500 + 1
+    assert neededMb(model, 33, 4096) > free - 500
+    (layers, context, reason) = adaptToFreeVram(model, ALL_LAYERS, 4096, free, margin_mb=500, prefer="context")
+    assert layers == ALL_LAYERS
+    assert 1024 <= context < 4096
+    assert context % context_step == 0
+    assert reason.startswith("context 4096 -> " + str(context))
+
+def test_min_context_floor(makeModel):
+    model = makeModel()
+    (layers, context, reason) = adaptToFreeVram(model, ALL_LAYERS, 4096, 4000, margin_mb=500, prefer="context", min_context=512)
+    assert context == 512
+    assert 0 < layers < 32
+    assert neededMb(model, layers, 512) <= 3500
+
+def test_per_device(makeModel):
+    model = makeModel()
+    # plenty of vram in total, but an even split puts half the model on a nearly full device
+    assert adaptToFreeVram(model, ALL_LAYERS, 4096, 24600)[0] == ALL_LAYERS
+    (layers, context, reason) = adaptToFreeVram(model, ALL_LAYERS, 4096, [24000, 600], tensor_split="1,1")
+    assert layers == 0
+    # without a tensor split, the share follows free vram
+    (layers, context, reason) = adaptToFreeVram(model, ALL_LAYERS, 4096, [8000, 8000], margin_mb=500)
+    assert layers == ALL_LAYERS
+
+def test_split_needed(makeModel):
+    estimate = modelEstimate(makeModel()["facts"])
+    assert splitNeeded(estimate, 33, 4096, [1]) == [vramNeeded(estimate, 33, 4096)]
+    (first, second) = splitNeeded(estimate, 33, 4096, [1, 1])
+    # the second device holds the output layer, the first the scratch buffers
+    assert first + second > vramNeeded(estimate, 33, 4096)
+    assert splitNeeded(estimate, 0, 4096, [1, 1]) == [0, 0]
+
+def test_launch_ignores_other_servers(tmp_path, stubExecutable, port, monkeypatch):
+    # another server answers /health on the port backends listen on by default
+    other = Backend("other", backendCommand(stubExecutable, "other.gguf", 10, 2048, host="127.0.0.1", port=port), str(tmp_path / "logs"), port=port)
+    monkeypatch.setattr(launch, "default_port", port)
+    (tmp_path / "m.gguf").write_bytes(b"GGUF")
+    try:
+        assert other.start().waitReady(timeout=10, interval=0.05) == "ready"
+        # and the backend of the launch fails
+        monkeypatch.setenv("STUB_MAX_LAYERS", "0")
+        with pytest.raises(SystemExit) as e:
+            launch.main([str(tmp_path / "m.gguf"), "-x", stubExecutable, "-f", str(tmp_path / "nolayers"), "--log_directory", str(tmp_path / "logs"), "--wait", "--timeout", "10"])
+        assert e.value.code == 1
+    finally:
+        other.stop()
+    with open(tmp_path / "logs" / "m.gguf.2.log") as f:
+        assert "out of memory" in f.read()
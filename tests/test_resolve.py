@@ -0,0 +1,64 @@
+import os, sys
+import pytest
+from llm_layers.layers import RepoResolver
+from llm_layers.cache import ResolutionCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from fakehub import FakeHub
+
+def repo(repo_id, files, downloads=0, likes=0, gated=False):
+    return {"id" : repo_id, "author" : repo_id.split("/")[0], "downloads" : downloads, "likes" : likes, "gated" : gated,
+            "files" : [{"path" : path, "size" : 1000, "sha256" : "sha-" + path} for path in files]}
+
+quants = ["llama-7b.Q4_K_M.gguf", "llama-7b.Q5_K_M.gguf", "llama-7b.Q8_0.gguf"]
+manifest = {"repos" : [repo("someone/llama-7b-GGUF", quants, downloads=100),
+                       repo("popular/llama-7b-GGUF", quants[:2], downloads=1000, likes=50),
+                       repo("TheBloke/llama-7b-GGUF", quants[:1]),
+                       repo("locked/mistral-7b-GGUF", ["mistral-7b.Q4_K_M.gguf"], gated=True)]}
+
+@pytest.fixture
+def hub():
+    """A FakeHub on manifest that records the queries it was searched for."""
+    hub = FakeHub(manifest, latency=0.05)
+    hub.queries = []
+    search = hub.search
+    def recordingSearch(query):
+        hub.queries.append(query)
+        return search(query)
+    hub.search = recordingSearch
+    return hub
+
+def resolver(hub, tmp_path):
+    return RepoResolver(hub=hub, cache=ResolutionCache(file=str(tmp_path / "resolution.json")))
+
+def test_shared_prefixes_are_searched_once(hub, tmp_path):
+    resolver(hub, tmp_path).resolve_many(quants)
+    # all quants search for llama, llama-, llama-7b and so on at the same time, but each is sent only once
+    assert hub.queries.count("llama") == 1
+    assert sorted(hub.queries) == sorted(set(hub.queries))
+
+def test_winner(hub, tmp_path):
+    first = resolver(hub, tmp_path)
+    results = first.resolve_many(quants)
+    first.cache.save()
+    assert results["llama-7b.Q4_K_M.gguf"]["repo"] == "TheBloke/llama-7b-GGUF"
+    assert results["llama-7b.Q5_K_M.gguf"]["repo"] == "popular/llama-7b-GGUF"
+    assert sorted(results["llama-7b.Q5_K_M.gguf"]["candidates"]) == ["popular/llama-7b-GGUF", "someone/llama-7b-GGUF"]
+    assert results["llama-7b.Q8_0.gguf"]["repo"] == "someone/llama-7b-GGUF"
+    assert results["llama-7b.Q8_0.gguf"]["sha256"] == "sha-llama-7b.Q8_0.gguf"
+    # a second resolver on the saved cache doesn't ask the hub again
+    calls = hub.calls
+    assert resolver(hub, tmp_path).resolve_many(quants) == results
+    assert hub.calls == calls
+
+def test_negative_results_are_cached(hub, tmp_path):
+    first = resolver(hub, tmp_path)
+    results = first.resolve_many(["nothing-like-it.gguf", "mistral-7b.Q4_K_M.gguf"])
+    first.cache.save()
+    assert results["nothing-like-it.gguf"]["repo"] == ""
+    assert results["nothing-like-it.gguf"]["reason"] == "missing"
+    assert results["mistral-7b.Q4_K_M.gguf"]["reason"] == "gated"
+    assert results["mistral-7b.Q4_K_M.gguf"]["candidates"] == ["locked/mistral-7b-GGUF"]
+    calls = hub.calls
+    assert resolver(hub, tmp_path).resolve("mistral-7b.Q4_K_M.gguf")["reason"] == "gated"
+    assert hub.calls == calls
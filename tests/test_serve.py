@@ -0,0 +1,185 @@
+import os, json, time, threading, http.client
+import pytest
+from llm_layers.serve import ModelPool, ModelError, Router
+from llm_layers.launch import Backend, backendCommand, default_host
+
+class FakeBackend(object):
+    """Stands in for llm_layers.launch.Backend. waitReady returns status once the event ready is set, right away if it is None."""
+    def __init__(self, name, status="ready", ready=None):
+        self.name = name
+        self.status = status
+        self.reason = "" if status == "ready" else "out of memory"
+        self.ready = ready
+        self.started = False
+        self.stopped = False
+        self.time_to_ready = 0.0
+
+    def start(self):
+        self.started = True
+
+    def waitReady(self, timeout=600):
+        if self.ready is not None:
+            self.ready.wait(timeout)
+        return self.status
+
+    def stop(self, timeout=10):
+        self.stopped = True
+
+def makePool(vram, budget_mb=10000, statuses={}, raises=[], pinned=[], ready=None):
+    """Returns a pair (pool, backends) for models named by vram, a dictionary of names to MB. backends collects the fake backends in the order they were made."""
+    models = {name : ({"name" : name, "file" : "/nonexistent/" + name, "facts" : None}, {"tuned_vram_mb" : str(mb)}) for (name, mb) in vram.items()}
+    backends = []
+    def makeBackend(name, model, row, port):
+        if name in raises:
+            raise OSError("no such executable")
+        backend = FakeBackend(name, statuses.get(name, "ready"), ready=ready)
+        backends.append(backend)
+        return backend
+    return (ModelPool(models, budget_mb, makeBackend, pinned=pinned, timeout=5), backends)
+
+def use(pool, name):
+    pool.release(pool.acquire(name))
+
+def test_load_and_reuse():
+    (pool, backends) = makePool({"a" : 4000})
+    use(pool, "a")
+    use(pool, "a")
+    assert [b.name for b in backends] == ["a"]
+    report = pool.report()
+    assert report["requests"] == 2
+    assert report["loads"] == 1
+
+def test_evicts_least_recently_used():
+    (pool, backends) = makePool({"a" : 4000, "b" : 4000, "c" : 4000})
+    use(pool, "a")
+    use(pool, "b")
+    use(pool, "a")
+    use(pool, "c")
+    assert sorted(pool.slots.keys()) == ["a", "c"]
+    assert [b.name for b in backends if b.stopped] == ["b"]
+    assert pool.report()["evictions"] == 1
+
+def test_pinned_and_busy_are_not_evicted():
+    (pool, backends) = makePool({"a" : 4000, "b" : 4000, "c" : 4000}, pinned=["a"])
+    use(pool, "a")
+    busy = pool.acquire("b")
+    done = []
+    waiter = threading.Thread(target=lambda: done.append(pool.acquire("c")))
+    waiter.start()
+    time.sleep(0.2)
+    # a is pinned and b is busy, so c has to wait
+    assert done == []
+    pool.release(busy)
+    waiter.join(5)
+    assert not(waiter.is_alive())
+    assert sorted(pool.slots.keys()) == ["a", "c"]
+
+def test_too_large():
+    (pool, backends) = makePool({"a" : 20000})
+    with pytest.raises(ModelError) as e:
+        pool.acquire("a")
+    assert e.value.status == 507
+    assert backends == []
+
+def test_failed_load():
+    (pool, backends) = makePool({"a" : 4000, "b" : 4000}, statuses={"a" : "failed"}, raises=["b"])
+    for name in ["a", "b"]:
+        with pytest.raises(ModelError):
+            pool.acquire(name)
+    assert pool.slots == {}
+    assert backends[0].stopped
+    assert pool.report()["failed_loads"] == 2
+    # nothing is left behind, so the next request tries again
+    with pytest.raises(ModelError):
+        pool.acquire("b")
+    assert pool.report()["failed_loads"] == 3
+
+def test_failed_load_wakes_waiters():
+    ready = threading.Event()
+    (pool, backends) = makePool({"a" : 4000}, statuses={"a" : "failed"}, ready=ready)
+    errors = []
+    def request():
+        try:
+            pool.acquire("a")
+        except ModelError as e:
+            errors.append(e)
+    first = threading.Thread(target=request)
+    first.start()
+    while backends == []:
+        time.sleep(0.01)
+    second = threading.Thread(target=request)
+    second.start()
+    time.sleep(0.2)
+    ready.set()
+    first.join(5)
+    second.join(5)
+    assert not(first.is_alive()) and not(second.is_alive())
+    assert len(errors) == 2
+    assert len(backends) == 1
+
+def test_unreadable_model():
+    (pool, backends) = makePool({"a" : 4000})
+    pool.models["b"] = ({"name" : "b", "file" : "/nonexistent/b", "facts" : None}, None)
+    pool.models["c"] = ({"name" : "c", "file" : "/nonexistent/c", "facts" : None}, {"tuned_vram_mb" : "lots"})
+    for name in ["b", "c"]:
+        with pytest.raises(ModelError) as e:
+            pool.acquire(name)
+        assert e.value.status == 500
+    assert pool.slots == {}
+
+@pytest.fixture
+def router(stubExecutable, tmp_path):
+    """Serves the models a.gguf and broken.gguf through a Router to stub backends, see tests/stub_server.py. broken.gguf answers every request with an error. Returns the router's port."""
+    models = {name : ({"name" : name, "file" : "/nonexistent/" + name, "mmproj" : "", "facts" : None}, {"tuned_vram_mb" : "1000"}) for name in ["a.gguf", "broken.gguf"]}
+    def makeBackend(name, model, row, port):
+        env = dict(os.environ, STUB_STATUS="500") if name == "broken.gguf" else None
+        return Backend(name, backendCommand(stubExecutable, model["file"], 10, 2048, host=default_host, port=port), str(tmp_path / "logs"), port=port, env=env)
+    pool = ModelPool(models, 10000, makeBackend, timeout=10)
+    server = Router((default_host, 0), pool)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        yield server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+        pool.shutdown()
+        thread.join(5)
+
+def post(port, path, body, headers={}):
+    """Returns the pair (status, body) of posting body to the router."""
+    connection = http.client.HTTPConnection(default_host, port, timeout=10)
+    try:
+        connection.request("POST", path, body=body, headers=headers)
+        response = connection.getresponse()
+        return (response.status, response.read())
+    finally:
+        connection.close()
+
+def test_router_forwards(router):
+    (status, body) = post(router, "/v1/chat/completions", json.dumps({"model" : "a", "messages" : []}), headers={"Proxy-Authorization" : "secret", "X-Request-Id" : "42"})
+    assert status == 200
+    reply = json.loads(body)
+    assert reply["model"] == "a.gguf"
+    assert reply["path"] == "/v1/chat/completions"
+    assert reply["request"]["model"] == "a"
+    # hop by hop headers stay with the router, the others reach the backend
+    assert "proxy-authorization" not in reply["headers"]
+    assert reply["headers"]["x-request-id"] == "42"
+
+def test_router_streams(router):
+    (status, body) = post(router, "/v1/completions", json.dumps({"model" : "a.gguf", "stream" : True}))
+    assert status == 200
+    events = [w for w in body.decode("utf-8").split("\n\n") if w]
+    assert [json.loads(w[len("data: "):])["chunk"] for w in events[:-1]] == [0, 1, 2]
+    assert events[-1] == "data: [DONE]"
+
+def test_router_errors(router):
+    (status, body) = post(router, "/v1/completions", json.dumps({"model" : "broken"}))
+    # errors of the backend are passed on as they are
+    assert status == 500
+    assert json.loads(body)["error"]["message"] == "stub failure"
+    (status, body) = post(router, "/v1/completions", json.dumps({"model" : "missing"}))
+    assert status == 404
+    (status, body) = post(router, "/v1/completions", "{}", headers={"Content-Length" : "lots"})
+    assert status == 400
@@ -0,0 +1,91 @@
+import argparse
+import pytest
+from llm_layers import tune
+from llm_layers.fit import ALL_LAYERS
+
+@pytest.fixture
+def fakeTrial(monkeypatch):
+    """Replaces the backend with a model that loads up to max_layers at up to max_context, and gets faster with more layers and smaller contexts."""
+    limits = {"max_layers" : ALL_LAYERS, "max_context" : 2**20}
+    def trial(model, gpu_layers, context, args, extra=[]):
+        ok = gpu_layers <= limits["max_layers"] and context <= limits["max_context"]
+        speed = min(gpu_layers, 33) + 1000 / context
+        return {"gpu_layers" : gpu_layers, "context" : context, "ok" : ok, "reason" : "" if ok else "failed: out of memory",
+                "load_s" : 1, "pp_tps" : 10 * speed, "tg_tps" : speed, "vram_mb" : 0}
+    monkeypatch.setattr(tune, "trial", trial)
+    return limits
+
+def tuneModel(model, context=2048, max_context=0, args=None):
+    return tune.tuneModel(model, context, args, max_context=max_context, report=lambda w: None)
+
+def test_everything_fits(fakeTrial, makeModel):
+    (best, trials) = tuneModel(makeModel())
+    assert best["gpu_layers"] == ALL_LAYERS
+    assert len(trials) == 1
+
+def test_finds_layer_bound(fakeTrial, makeModel):
+    fakeTrial["max_layers"] = 20
+    (best, trials) = tuneModel(makeModel())
+    assert best["gpu_layers"] == 20
+    assert best["ok"]
+    assert any([t["gpu_layers"] == 21 and not(t["ok"]) for t in trials])
+    # a binary search, not one trial per layer
+    assert len(trials) <= 8
+
+def test_nothing_fits(fakeTrial, makeModel):
+    fakeTrial["max_layers"] = -1
+    (best, trials) = tuneModel(makeModel())
+    assert best is None
+    assert trials != [] and not(any([t["ok"] for t in trials]))
+
+def test_zero_layers(fakeTrial, makeModel):
+    fakeTrial["max_layers"] = 0
+    (best, trials) = tuneModel(makeModel())
+    assert best["gpu_layers"] == 0
+
+def test_largest_context(fakeTrial, makeModel):
+    fakeTrial["max_layers"] = 20
+    fakeTrial["max_context"] = 5000
+    (best, trials) = tuneModel(makeModel(), context=2048, max_context=8192)
+    assert best["gpu_layers"] == 20
+    assert best["context"] == 4864
+
+def test_memory_sampler():
+    free = [[8000, 4000], [7000, 4000], [5000, 3500], [6000, 4000]]
+    def probe():
+        values = free.pop(0) if len(free) > 1 else free[0]
+        return [{"index" : i, "free_mb" : mb} for (i, mb) in enumerate(values)]
+    sampler = tune.MemorySampler(probe=probe, interval=0.01).start()
+    while len(free) > 1:
+        sampler.stopped.wait(0.01)
+    sampler.stop()
+    assert sampler.peak_mb == 3500
+
+def stubArgs(executable, tmp_path):
+    return argparse.Namespace(port=None, executable=executable, additional_arguments="-fa --parallel 1", log_directory=str(tmp_path / "logs"), timeout=20)
+
+def test_trial_against_stub(stubExecutable, tmp_path, makeModel):
+    t = tune.trial(makeModel(), 20, 2048, stubArgs(stubExecutable, tmp_path))
+    assert t["ok"], t["reason"]
+    # what the stub reports for -ngl 20 -c 2048
+    assert t["tg_tps"] == 30.0
+    assert t["pp_tps"] == round(1000 / 3, 2)
+    assert t["load_s"] > 0
+
+def test_trial_out_of_memory(stubExecutable, tmp_path, makeModel, monkeypatch):
+    monkeypatch.setenv("STUB_MAX_LAYERS", "10")
+    t = tune.trial(makeModel(), 20, 2048, stubArgs(stubExecutable, tmp_path))
+    assert not(t["ok"])
+    assert "out of memory" in t["reason"]
+
+def test_tune_against_stub(stubExecutable, tmp_path, makeModel, monkeypatch):
+    monkeypatch.setenv("STUB_MAX_LAYERS", "5")
+    (best, trials) = tuneModel(makeModel(block_count=8), args=stubArgs(stubExecutable, tmp_path))
+    assert best["gpu_layers"] == 5
+    assert best["tg_tps"] == 15.0
+
+def test_trial_bad_response(stubExecutable, tmp_path, makeModel, monkeypatch):
+    monkeypatch.setenv("STUB_COMPLETION", "garbage")
+    t = tune.trial(makeModel(), 20, 2048, stubArgs(stubExecutable, tmp_path))
+    assert not(t["ok"])
+    assert t["reason"] == "failed: bad response"